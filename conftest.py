@@ -0,0 +1,304 @@
+#
+# Copyright (c) 2013 Citrix Systems, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+
+"""Test fixtures shared by the test modules"""
+
+import os
+from errno import EIO
+from hashlib import md5
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from re import match
+from urllib.parse import urlsplit
+from urllib.request import parse_http_list, parse_keqv_list
+from threading import Event, Lock, Thread
+
+import pytest
+
+import pysynchronizer.icbinn
+from sync_client import client
+
+class FakeIcbinnServer(object):
+    """An icbinn server serving the directory root, counting the calls made
+    to it. fail maps call names to the number of times they should raise
+    EIO before working again. Calls on the handles in dead raise EIO, as if
+    the link to the server had gone."""
+    def __init__(self, root):
+        self.root = str(root)
+        self.calls = {}
+        self.fail = {}
+        self.handles = 0
+        self.dead = set()
+        self.destroyed = []
+        self.lock = Lock()
+
+    def count(self, name, handle=None):
+        with self.lock:
+            self.calls[name] = self.calls.get(name, 0) + 1
+            if handle in self.dead:
+                raise OSError(EIO, 'link to server gone')
+            if self.fail.get(name):
+                self.fail[name] -= 1
+                raise OSError(EIO, 'injected failure')
+
+    def drop_links(self):
+        """Make every handle connected so far stop working"""
+        with self.lock:
+            self.dead.update(('handle', x) for x in range(1, self.handles + 1))
+
+    def path(self, path):
+        return os.path.join(self.root, path)
+
+    def clnt_create_argo(self, domain, port):
+        self.count('create')
+        with self.lock:
+            self.handles += 1
+            return ('handle', self.handles)
+
+    def clnt_destroy(self, handle):
+        self.destroyed.append(handle)
+
+    def open(self, handle, path, mode):
+        self.count('open', handle)
+        try:
+            return os.open(self.path(path), mode, 0o644)
+        except OSError:
+            return -1
+
+    def close(self, handle, fd):
+        self.count('close', handle)
+        os.close(fd)
+        return 0
+
+    def lock_file(self, handle, fd, ltype):
+        self.count('lock', handle)
+        return 0
+
+    def mkdir(self, handle, path):
+        self.count('mkdir', handle)
+        try:
+            os.mkdir(self.path(path))
+        except OSError:
+            return -1
+        return 0
+
+    def pwrite(self, handle, fd, data, offset):
+        self.count('pwrite', handle)
+        assert len(data) <= pysynchronizer.icbinn.ICBINN_MAXDATA
+        return os.pwrite(fd, data, offset)
+
+    def pread(self, handle, fd, size, offset):
+        self.count('pread', handle)
+        return os.pread(fd, min(size, pysynchronizer.icbinn.ICBINN_MAXDATA),
+                        offset)
+
+    def rand(self, handle, src, size):
+        self.count('rand', handle)
+        return os.urandom(size)
+
+    def readent(self, handle, path, index):
+        self.count('readent', handle)
+        names = sorted(os.listdir(self.path(path)))
+        if index >= len(names):
+            return None
+        kind = (pysynchronizer.icbinn.ICBINN_DIRECTORY
+                if os.path.isdir(os.path.join(self.path(path), names[index]))
+                else pysynchronizer.icbinn.ICBINN_FILE)
+        return (names[index], kind)
+
+    def rename(self, handle, src, dst):
+        self.count('rename', handle)
+        try:
+            os.rename(self.path(src), self.path(dst))
+        except OSError:
+            return -1
+        return 0
+
+    def stat(self, handle, path):
+        self.count('stat', handle)
+        res = os.stat(self.path(path))
+        return (res.st_size, pysynchronizer.icbinn.ICBINN_DIRECTORY
+                if os.path.isdir(self.path(path))
+                else pysynchronizer.icbinn.ICBINN_FILE)
+
+    def unlink(self, handle, path):
+        self.count('unlink', handle)
+        try:
+            os.unlink(self.path(path))
+        except OSError:
+            return -1
+        return 0
+
+@pytest.fixture
+def icbinn_server(tmp_path, monkeypatch):
+    """A FakeIcbinnServer which the icbinn client code talks to"""
+    server = FakeIcbinnServer(tmp_path)
+    for name in ['clnt_create_argo', 'clnt_destroy', 'open', 'close',
+                 'mkdir', 'pwrite', 'pread', 'rand', 'readent', 'rename',
+                 'stat', 'unlink']:
+        monkeypatch.setattr(pysynchronizer.icbinn, 'icbinn_' + name,
+                            getattr(server, name))
+    monkeypatch.setattr(pysynchronizer.icbinn, 'icbinn_lock',
+                        server.lock_file)
+    monkeypatch.setattr(pysynchronizer.icbinn, 'sleep', lambda _: None)
+    return server
+
+@pytest.fixture
+def storage(icbinn_server, monkeypatch):
+    """client.ICBINN_STORAGE on a fake icbinn server"""
+    icbinn = client.Icbinn('/storage')
+    monkeypatch.setattr(client, 'ICBINN_STORAGE', icbinn)
+    return icbinn
+
+class FakeHTTPHandler(BaseHTTPRequestHandler):
+    """Serve the documents of a FakeHTTPServer, with byte ranges"""
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def record(self):
+        with self.server.lock:
+            self.server.requests.append((self.command, self.path,
+                                         dict(self.headers)))
+            self.server.clients.append(self.client_address)
+
+    def authorized(self):
+        """Return whether the request has the digest authorization the
+        server wants, if it wants any, otherwise send a challenge"""
+        if not self.server.digest:
+            return True
+        realm, user, password = self.server.digest
+        fields = self.headers.get('Authorization', '').partition(' ')[2]
+        answer = parse_keqv_list(parse_http_list(fields)) if fields else {}
+        hash_text = lambda text: md5(text.encode('utf-8')).hexdigest()
+        if answer.get('nonce') == self.server.nonce and answer.get(
+            'username') == user and answer.get('uri') == self.path:
+            expected = hash_text(':'.join([
+                        hash_text('%s:%s:%s' % (user, realm, password)),
+                        answer['nonce'], answer.get('nc', ''),
+                        answer.get('cnonce', ''), 'auth',
+                        hash_text('%s:%s' % (self.command, self.path))]))
+            if answer.get('response') == expected:
+                return True
+        self.send_response(401)
+        self.send_header('WWW-Authenticate', 'Digest realm="%s", nonce="%s", '
+                         'qop="auth"' % (realm, self.server.nonce))
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+        return False
+
+    def do_CONNECT(self):
+        self.record()
+        self.send_error(502)
+
+    def do_GET(self):
+        server = self.server
+        # a request to a proxy names the server as well as the path
+        path = self.path
+        if path.startswith('http://'):
+            path = urlsplit(path).path
+        self.record()
+        if path in server.redirects:
+            self.send_response(302)
+            self.send_header('Location', server.redirects[path])
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        body = server.documents.get(path)
+        if body is None:
+            self.send_error(404)
+            return
+        if not self.authorized():
+            return
+        start, end, status = 0, len(body), 200
+        found = match(r'bytes=(\d+)-(\d*)$', self.headers.get('Range', ''))
+        if found:
+            start = int(found.group(1))
+            end = int(found.group(2) or len(body) - 1) + 1
+            status = 206
+        with server.lock:
+            key = (path, start)
+            cut = server.cut.pop(key if key in server.cut else path, None)
+            stall = server.stall.pop((path, start), None)
+        self.send_response(status)
+        self.send_header('Content-Length', str(end - start))
+        if status == 206:
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (
+                    start, end - 1, len(body)))
+        self.end_headers()
+        if stall is not None:
+            # send part of the body, then wait until released
+            self.wfile.write(body[start:start + stall])
+            self.wfile.flush()
+            server.release.wait(30)
+        if cut is not None:
+            # drop the connection part way through the body
+            self.wfile.write(body[start:min(start + cut, end)])
+            self.close_connection = True
+            return
+        self.wfile.write(body[start:end])
+        # close the connection without saying so
+        self.close_connection = server.drop_idle
+
+class FakeHTTPServer(ThreadingHTTPServer):
+    """An HTTP server on localhost serving documents, which maps paths to
+    their contents, and recording the requests made to it.
+
+    cut maps paths, or (path, start of range) for range requests, to the
+    number of bytes of the body to send, the next time they are requested,
+    before dropping the connection. stall maps (path, start of range) to
+    the number of bytes to send before waiting for release to be set. If
+    drop_idle is set, connections are closed after each response, without
+    telling the client.
+
+    redirects maps paths to the locations they redirect to.
+
+    If digest is set to (realm, user, password), requests must have digest
+    authorization. The server acts as an HTTP proxy for requests naming a
+    server, and refuses CONNECT requests.
+
+    requests lists (method, path, headers) for each request, and clients
+    the address each one came from."""
+    daemon_threads = True
+
+    def __init__(self):
+        ThreadingHTTPServer.__init__(self, ('127.0.0.1', 0), FakeHTTPHandler)
+        self.url = 'http://127.0.0.1:%d/' % self.server_port
+        self.documents = {}
+        self.cut = {}
+        self.stall = {}
+        self.release = Event()
+        self.drop_idle = False
+        self.redirects = {}
+        self.digest = None
+        self.nonce = 'abcdef'
+        self.requests = []
+        self.clients = []
+        self.lock = Lock()
+
+@pytest.fixture
+def http_server():
+    """A FakeHTTPServer running until the test is over"""
+    server = FakeHTTPServer()
+    thread = Thread(target=server.serve_forever, args=(0.05,))
+    thread.daemon = True
+    thread.start()
+    yield server
+    server.release.set()
+    server.shutdown()
+    server.server_close()
@@ -112,15 +112,17 @@ class XenMgrCmd(BaseCmd):
             print('unable to find vm: %s\n' % ref)
 
     def help_upgrade(self):
-        print('Usage: upgrade "URL"\n')
-        print('Upgrade OpenXT using repo file located at "URL"\n')
+        print('Usage: upgrade "URL" [SHA256]\n')
+        print('Upgrade OpenXT using repo file located at "URL", checking it')
+        print('against SHA256 if given\n')
 
     def do_upgrade(self, arg_str):
         if not arg_str:
             self.help_upgrade()
             return
 
-        if not self.xenmgr.upgrade(arg_str.split()[0]):
+        args = arg_str.split()
+        if not self.xenmgr.upgrade(args[0], args[1] if len(args) > 1 else None):
             print('upgrade failed\n')
 
 class VmCmd(BaseCmd):
@@ -224,7 +226,7 @@ class VmCmd(BaseCmd):
     def help_disk(self):
         print('Usage: disk {command}\n')
         print('Available commands:')
-        print('  replace "URL": replace backing disk image with that from "URL"\n')
+        print('  replace "URL" [SHA256]: replace backing disk image with that from "URL"\n')
 
     def do_disk(self, arg_str):
         args = arg_str.split()
@@ -247,7 +249,8 @@ class VmCmd(BaseCmd):
                 print('Download from "URL" and replace disk with image\n')
                 return
 
-            phy_path = self.disk.replace(url)
+            checksum = args[1] if len(args) > 1 else None
+            phy_path = disk.replace(url, checksum)
             if phy_path:
                 print('Replaced %s\n' % phy_path)
             else:
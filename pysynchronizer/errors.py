@@ -52,6 +52,14 @@ class IcbinnError(Error):
     """Other icbinn error"""
     exit_code = 11
 
+class IcbinnWriteError(IcbinnError):
+    """icbinn_pwrite failed; offsets lists where"""
+    def __init__(self, path, offsets):
+        super().__init__("error writing to icbinn file '%s': icbinn_pwrite "
+                         "failed at offsets %s" %
+                         (path, ", ".join(str(x) for x in offsets)))
+        self.offsets = offsets
+
 class MissingDownload(Error):
     """stat failed on a file after download"""
     exit_code = 12
@@ -75,3 +83,7 @@ class EncryptionKeyLengthWrong(Error):
 class VhdUtilSnapshotFailed(Error):
     """Running vhd-util snapshot did not create a file"""
     exit_code = 17
+
+class ChecksumMismatch(Error):
+    """A download did not match its expected checksum"""
+    exit_code = 18
@@ -0,0 +1,72 @@
+#
+# Copyright (c) 2021 Daniel P. Smith, Apertus Solutions LLC
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+
+from hashlib import sha256
+from queue import Queue
+from threading import Thread
+
+HASH_QUEUE_CHUNKS = 8
+
+class StreamHasher:
+    """SHA-256 of a stream of data, computed on a thread of its own so that
+    the thread receiving the data is not held up by it.
+
+    update() queues a copy of the data, since it may be in a buffer which
+    is reused for the next chunk, and waits once queue_chunks chunks are
+    waiting to be hashed, so memory use stays bounded if hashing falls
+    behind. close() stops the thread, and must be called if hexdigest()
+    is not."""
+    def __init__(self, queue_chunks=HASH_QUEUE_CHUNKS):
+        self.sha = sha256()
+        self.queue = Queue(queue_chunks)
+        self.closed = False
+        self.thread = Thread(target=self.__hash_queued__)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def __hash_queued__(self):
+        while True:
+            data = self.queue.get()
+            if data is None:
+                return
+            self.sha.update(data)
+
+    def update(self, data):
+        self.queue.put(bytes(data))
+
+    def close(self):
+        """Wait for the data queued so far to be hashed, and stop the
+        thread"""
+        if not self.closed:
+            self.closed = True
+            self.queue.put(None)
+            self.thread.join()
+
+    def hexdigest(self):
+        self.close()
+        return self.sha.hexdigest()
+
+class HashingWriter:
+    """File-like wrapper that hashes everything written through it"""
+    def __init__(self, file_handle, hasher):
+        self.file_handle = file_handle
+        self.hasher = hasher
+
+    def write(self, data):
+        self.hasher.update(data)
+        self.file_handle.write(data)
@@ -18,64 +18,151 @@
 
 import os
 import ssl
-import urllib.request, urllib.error, urllib.parse
-
-from .utils import disable_argo_inet, enable_argo_inet
+import http.client
+
+from threading import Lock
+from urllib.parse import urljoin, urlsplit, urlunsplit
+from .errors import ConfigError, HTTPError
+from .http_pool import ConnectionPool
+from .ratelimit import RateLimiter
+from .singleton import Singleton
 from tempfile import NamedTemporaryFile, TemporaryFile
 from .oxt_dbus import OXTDBusApi
 
-class HttpFetcher:
+MAX_REDIRECTS = 10
+FETCH_CHUNK_SIZE = 64 * 1024
+
+class HttpFetcher(Singleton):
     def __init__(self):
         db = OXTDBusApi.open_db()
 
         self.cacert = db.read("cacert")
         self.cert = db.read("device-cert")
         self.key = db.read("device-key")
+        self.rate_limiter = RateLimiter(
+            self.__read_int__(db, "download-rate-limit"),
+            self.__read_int__(db, "download-transfer-rate-limit"),
+            db.read("download-rate-schedule"))
+
+        # The context and a connection pool for each (scheme, host, port)
+        # are kept for the life of the process
+        self.sslcont = self.setup_ssl_context()
+        self.pools = {}
+        self.lock = Lock()
+
+    def __read_int__(self, db, key):
+        value = db.read(key)
+        try:
+            return int(value or 0)
+        except ValueError:
+            raise ConfigError("domstore key '%s' value '%s' is not an "
+                              "integer" % (key, value))
 
-    def __setup_cert__(self):
-        if self.cert != "":
-            with open("/tmp/id", "w+") as crt:
-                crt.write("%s\n" % self.cert)
-            with open("/tmp/key", "w+") as key:
-                key.write("%s\n" % self.key)
+    def __load_cert_chain__(self, sslcont):
+        """Load the device certificate and key from memory.
 
-    def __cleanup_cert__(self):
+        ssl can only load them from a file, so hand it an anonymous memory
+        backed one rather than writing the key to the filesystem."""
+        pem = "%s\n%s\n" % (self.cert, self.key)
         try:
-            os.remove("/tmp/id")
-            os.remove("/tmp/key")
-        except:
-            pass
+            fd = os.memfd_create("device-id", os.MFD_CLOEXEC)
+        except (AttributeError, OSError):
+            with NamedTemporaryFile("w+") as crt:
+                crt.write(pem)
+                crt.flush()
+                sslcont.load_cert_chain(certfile=crt.name)
+            return
+        with os.fdopen(fd, "w+") as crt:
+            crt.write(pem)
+            crt.flush()
+            sslcont.load_cert_chain(certfile="/proc/self/fd/%d" % fd)
 
     def setup_ssl_context(self):
         sslcont = ssl.create_default_context(ssl.Purpose.SERVER_AUTH)
         if self.cacert != "":
             sslcont.load_verify_locations(cadata=self.cacert)
 
-            self.__setup_cert__()
-
-            sslcont.load_cert_chain(certfile="/tmp/id", keyfile="/tmp/key")
+            if self.cert != "":
+                self.__load_cert_chain__(sslcont)
 
         return sslcont
 
-    def fetch(self, url, offset=-1, size=-1):
-        sslcont = self.setup_ssl_context()
-        request = urllib.request.Request(url)
+    def __pool__(self, key):
+        """Return the connection pool for key, making it if need be"""
+        with self.lock:
+            pool = self.pools.get(key)
+            if pool is None:
+                scheme, host, port = key
+                pool = ConnectionPool(scheme, host, port, self.sslcont)
+                self.pools[key] = pool
+            return pool
+
+    def __request__(self, url, headers):
+        """Send a GET request for url, following redirects, and return the
+        connection pool, the connection and the response with its body
+        unread"""
+        for _ in range(MAX_REDIRECTS + 1):
+            parts = urlsplit(url)
+            pool = self.__pool__((parts.scheme, parts.hostname, parts.port))
+            path = urlunsplit(("", "", parts.path or "/", parts.query, ""))
+
+            try:
+                conn, response = pool.request("GET", path, headers=headers)
+            except (http.client.HTTPException, OSError) as err:
+                raise HTTPError("GET %s failed: %s" % (url, err)) from err
+
+            if response.status in (301, 302, 303, 307, 308):
+                location = response.getheader("location")
+                response.read()
+                pool.put(conn, response)
+                if location is None:
+                    raise HTTPError("GET %s: redirect without location" % url)
+                url = urljoin(url, location)
+                continue
+
+            if response.status >= 400:
+                response.read()
+                pool.put(conn, response)
+                raise HTTPError("GET %s: HTTP response code %d" %
+                                (url, response.status))
+
+            return pool, conn, response
+
+        raise HTTPError("GET %s: too many redirects" % url)
+
+    def fetch(self, url, offset=-1, size=-1, callback=None,
+              chunk_size=FETCH_CHUNK_SIZE, max_size=None):
+        """Fetch url, or size bytes of it from offset, and return the range
+        and total size from its content-range header (or "" for each if it
+        has none) and its content.
+
+        If callback is set, the content is passed to it in chunks of up to
+        chunk_size bytes as it arrives, and the number of bytes is returned
+        in place of the content. Each chunk is in the same buffer, so
+        callback must be done with it when it returns, and memory use does
+        not depend on the size of the document. Otherwise the content is
+        returned, and if max_size is set, an HTTPError is raised instead if
+        it is over max_size bytes."""
+        headers = {}
 
         # Add the header to specify the range to download.
         if offset != -1:
             if size != -1:
-                request.add_header("range", "bytes=%d-%d" % (offset, offset + size - 1))
+                headers["range"] = "bytes=%d-%d" % (offset, offset + size - 1)
             else:
-                request.add_header("range", "bytes=%d-" % offset)
-
-        disable_argo_inet()
-        response = urllib.request.urlopen(request, context=sslcont)
+                headers["range"] = "bytes=%d-" % offset
 
-        # SSL Context has been used, clean up temporary cert files
-        self.__cleanup_cert__()
+        pool, conn, response = self.__request__(url, headers)
 
-        data = response.read()
-        enable_argo_inet()
+        try:
+            if callback:
+                data = self.__stream_body__(response, callback, chunk_size)
+            else:
+                data = self.__read_body__(url, response, max_size)
+        except:
+            conn.close()
+            raise
+        pool.put(conn, response)
 
         # If a content-range header is present, partial retrieval worked.
         if "content-range" in response.headers:
@@ -89,29 +176,64 @@ class HttpFetcher:
         else:
             return "", "", data
 
+    def __read_body__(self, url, response, max_size):
+        """Read the body of response as bytes, in one read of its
+        Content-Length if it has one, refusing any over max_size bytes if
+        it is set"""
+        length = response.getheader("content-length", "")
+        if (max_size is not None and length.isdigit() and
+            int(length) > max_size):
+            raise HTTPError("GET %s: %s bytes is more than the %d allowed" %
+                            (url, length, max_size))
+        if not length.isdigit() and max_size is not None:
+            data = response.read(max_size + 1)
+            if len(data) > max_size:
+                raise HTTPError("GET %s: more than the %d bytes allowed" %
+                                (url, max_size))
+            return data
+        try:
+            return response.read()
+        except http.client.IncompleteRead as err:
+            raise HTTPError("GET %s: connection closed after %d of %s "
+                            "bytes" % (url, len(err.partial), length)) from err
+
+    def __stream_body__(self, response, callback, chunk_size):
+        """Pass the body of response to callback in chunks of up to
+        chunk_size bytes, all received into the same buffer, at the rate
+        allowed, and return its length"""
+        buf = memoryview(bytearray(chunk_size))
+        throttle = self.rate_limiter.transfer()
+        total = 0
+        while True:
+            n = response.readinto(buf)
+            if not n:
+                return total
+            callback(buf[:n])
+            throttle(n)
+            total += n
+
     def stream(self, url, file_handle=None, offset=-1, chunk_size=1024):
         if file_handle == None:
             file_handle = TemporaryFile()
 
-        sslcont = self.setup_ssl_context()
-        request = urllib.request.Request(url)
+        headers = {}
 
         # Add the header to specify the range to download.
         if offset != -1:
-            request.add_header("range", "bytes=%d-" % offset)
+            headers["range"] = "bytes=%d-" % offset
 
-        disable_argo_inet()
-        response = urllib.request.urlopen(request, context=sslcont)
+        pool, conn, response = self.__request__(url, headers)
 
-        # SSL Context has been used, clean up temporary cert files
-        self.__cleanup_cert__()
+        if offset > 0 and response.status != 206:
+            conn.close()
+            raise HTTPError("GET %s: server ignored range request" % url)
 
-        while True:
-            chunk = response.read(chunk_size)
-            if not chunk:
-                break
-            file_handle.write(chunk)
+        try:
+            self.__stream_body__(response, file_handle.write, chunk_size)
+        except:
+            conn.close()
+            raise
 
-        enable_argo_inet()
+        pool.put(conn, response)
 
         return file_handle
@@ -0,0 +1,147 @@
+#
+# Copyright (c) 2021 Daniel P. Smith, Apertus Solutions LLC
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+
+from http.client import HTTPConnection, HTTPException, HTTPSConnection
+from logging import getLogger
+from ssl import create_default_context
+from threading import Lock
+from .utils import inet_not_argo, proxy_for
+
+class PooledHTTPConnection(HTTPConnection):
+    """HTTP connection belonging to a ConnectionPool, to the pool's proxy if
+    it has one"""
+    def __init__(self, pool, timeout):
+        host, port = pool.proxy or (pool.host, pool.port)
+        HTTPConnection.__init__(self, host, port, timeout=timeout)
+        self.pool = pool
+        self.reused = False
+
+    def connect(self):
+        with inet_not_argo():
+            HTTPConnection.connect(self)
+
+class PooledHTTPSConnection(HTTPSConnection):
+    """HTTPS connection belonging to a ConnectionPool, which resumes the
+    pool's last TLS session. If the pool has a proxy, the connection is
+    tunnelled through it with CONNECT."""
+    def __init__(self, pool, timeout):
+        host, port = pool.proxy or (pool.host, pool.port)
+        HTTPSConnection.__init__(self, host, port, timeout=timeout,
+                                 context=pool.context)
+        if pool.proxy:
+            self.set_tunnel(pool.host, pool.port, pool.proxy_headers)
+        self.pool = pool
+        self.reused = False
+
+    def connect(self):
+        with inet_not_argo():
+            HTTPConnection.connect(self)
+        self.sock = self.pool.context.wrap_socket(
+            self.sock, server_hostname=self.pool.host,
+            session=self.pool.session)
+        self.pool.log.debug('TLS connection to %s %s session', self.pool.host,
+                            'resumed' if self.sock.session_reused
+                            else 'started new')
+
+class ConnectionPool(object):
+    """Persistent connections to host and port over scheme, which is http or
+    https, using context for https, or a default context if it is None.
+
+    The proxy set for scheme by the http_proxy or https_proxy environment
+    variables is used unless no_proxy excludes host. Requests through a
+    proxy for http are sent to it with the target origin before the path,
+    and proxy_headers; https connections are tunnelled through it.
+
+    sync_client subclasses this, so the logger used is an attribute which
+    it can replace with its own."""
+    log = getLogger(__name__)
+
+    def __init__(self, scheme, host, port=None, context=None):
+        self.host = host
+        self.port = port or (443 if scheme == 'https' else 80)
+        if scheme == 'https':
+            self.context = context or create_default_context()
+            self.connection_class = PooledHTTPSConnection
+        else:
+            self.context = None
+            self.connection_class = PooledHTTPConnection
+        self.proxy = None
+        self.proxy_headers = {}
+        self.origin = ''
+        proxy = proxy_for(scheme, host)
+        if proxy:
+            self.proxy, self.proxy_headers = proxy[:2], proxy[2]
+            if self.context is None:
+                self.origin = 'http://%s:%d' % (self.host, self.port)
+            self.log.info('connecting to %s through proxy %s:%d', self.host,
+                          *self.proxy)
+        self.session = None
+        self.idle = []
+        self.lock = Lock()
+
+    def get(self, timeout=None):
+        """Return an idle connection, or a new one if there are none"""
+        with self.lock:
+            if self.idle:
+                conn = self.idle.pop()
+                conn.reused = True
+                conn.timeout = timeout
+                if conn.sock is not None:
+                    conn.sock.settimeout(timeout)
+                return conn
+        return self.connection_class(self, timeout)
+
+    def put(self, conn, response):
+        """Return conn to the pool if response has been read to the end and
+        the server will keep the connection open, otherwise close it"""
+        if conn.sock is None or not response.isclosed() or response.will_close:
+            conn.close()
+            return
+        with self.lock:
+            if self.context is not None:
+                self.session = conn.sock.session
+            self.idle.append(conn)
+
+    def close(self):
+        """Close all idle connections"""
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for conn in idle:
+            conn.close()
+
+    def request(self, method, path, body=None, headers=None, timeout=None):
+        """Send a request for path, and return the connection and the
+        response with its body unread, for put once the body has been read.
+
+        A request which fails on a kept-alive connection is retried on
+        another connection, in case the server had closed it; otherwise the
+        HTTPException or OSError is raised."""
+        headers = dict(headers or {})
+        if self.origin:
+            headers.update(self.proxy_headers)
+        while True:
+            conn = self.get(timeout)
+            try:
+                conn.request(method, self.origin + path, body, headers)
+                return conn, conn.getresponse()
+            except (HTTPException, OSError) as exc:
+                conn.close()
+                if not conn.reused:
+                    raise
+                self.log.info('%s request for %s failed on kept-alive '
+                              'connection: %s; retrying', method, path, exc)
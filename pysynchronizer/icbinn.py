@@ -18,16 +18,25 @@
 #
 
 
-from os.path import join
+from errno import ECONNRESET, EIO, ENOENT, ENOTCONN, EPIPE, ETIMEDOUT
+from itertools import takewhile
+from logging import getLogger
+from os import O_CREAT, O_EXCL, O_RDONLY, O_TRUNC, O_WRONLY, strerror
+from os.path import basename, dirname, join, normpath
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from queue import Queue
+from threading import Lock, RLock
+from time import sleep
 
-from .errors import InsufficientIcbinnPaths, IcbinnConnectError, PlatformError, IcbinnError, TargetStateError
+from .errors import InsufficientIcbinnPaths, IcbinnConnectError, PlatformError, IcbinnError, IcbinnWriteError, TargetStateError
 from .xenstore import Xenstore
 from .oxt_dbus import OXTDBusApi
 from .singleton import Singleton
 from .utils import uuid_to_dbus_path
 
-from pyicbinn import icbinn_clnt_create_argo, icbinn_close, icbinn_lock
+from pyicbinn import icbinn_clnt_create_argo, icbinn_clnt_destroy
+from pyicbinn import icbinn_close, icbinn_lock
 from pyicbinn import icbinn_mkdir, icbinn_open, icbinn_pwrite, icbinn_rand
 from pyicbinn import icbinn_readent, icbinn_rename, icbinn_stat, icbinn_pread
 from pyicbinn import icbinn_unlink
@@ -43,6 +52,14 @@ ICBINN_LTYPE_WRLCK = 1
 ICBINN_LTYPE_UNLCK = 2
 ICBINN_RANDOM = 0
 ICBINN_URANDOM = 1
+LISTDIR_CONNECTIONS = 4
+DEFAULT_ICBINN_CHANNELS = 4
+ICBINN_CHANNEL_MAX_FAILURES = 3
+# errno values with which icbinn calls fail when the server cannot be reached
+ICBINN_TRANSPORT_ERRNOS = (EIO, ECONNRESET, ENOTCONN, EPIPE, ETIMEDOUT)
+ICBINN_RETRIES = 3
+ICBINN_RETRY_BACKOFF = 1 # seconds, doubling on each retry
+LISTDIR_BATCH = 16
 
 DISK_DIR = 'disks'
 ENCRYPT_SNAPSHOTS = 'encrypt_snapshots'
@@ -56,6 +73,7 @@ DISK_TYPE_ISO = 'iso'
 DISK_TYPE_VHD = 'vhd'
 DISK_TYPES = [DISK_TYPE_ISO, DISK_TYPE_VHD]
 RPC_PREFIX = 'rpc:'
+ZEROS = bytes(ICBINN_MAXDATA)
 
 class Icbinn(Singleton):
     def __init__(self):
@@ -74,45 +92,299 @@ class Icbinn(Singleton):
         # Unused at this time, commenting out to save on unnecessary Argo connections
         #self.config = IcbinnRemote(paths[1], server_port=ICBINN_SERVER_PORT + 1)
 
+def is_transport_error(exc):
+    """Is exc, raised by an icbinn call, a failure to reach the server
+    rather than an error reported by its file system?"""
+    return (not isinstance(exc, OSError) or exc.errno is None or
+            exc.errno in ICBINN_TRANSPORT_ERRNOS)
+
+class IcbinnChannel(object):
+    """A client handle for an icbinn server. Handles are not safe for
+    concurrent use, so every call on one holds its lock."""
+    def __init__(self, handle):
+        self.handle = handle
+        self.lock = RLock()
+        # counts reconnections, after which fds opened before are gone
+        self.epoch = 0
+        # callers and open files currently using this channel
+        self.users = 0
+        # consecutive calls which failed in icbinn itself, rather than
+        # reporting an error from the file system
+        self.failures = 0
+
+    def healthy(self):
+        return self.failures < ICBINN_CHANNEL_MAX_FAILURES
+
+    def call(self, function, *args):
+        """Return function(handle, *args)"""
+        with self.lock:
+            try:
+                res = function(self.handle, *args)
+            except Exception as exc:
+                if is_transport_error(exc):
+                    self.failures += 1
+                raise
+            self.failures = 0
+            return res
+
+    def alive(self):
+        """Does the server still answer on this channel?"""
+        try:
+            self.call(icbinn_stat, '.')
+        except Exception:
+            return False
+        return True
+
 class IcbinnRemote(object):
+    """An icbinn server, whose files are at mount_point in dom0.
+
+    sync_client subclasses this, so the errors raised and the logger used
+    are attributes which it can replace with its own."""
+    connect_error = IcbinnConnectError
+    error = IcbinnError
+    write_error = IcbinnWriteError
+    platform_error = PlatformError
+    target_state_error = TargetStateError
+    log = getLogger(__name__)
+
     def __init__(self, mount_point,
                  server_domain_id=ICBINN_SERVER_DOMAIN_ID,
-                 server_port=ICBINN_SERVER_PORT):
+                 server_port=ICBINN_SERVER_PORT,
+                 max_channels=DEFAULT_ICBINN_CHANNELS):
         self.mount_point = mount_point
-
+        self.server_domain_id = server_domain_id
+        self.server_port = server_port
+        # callers share up to max_channels connections to the server, more
+        # being made as they are needed; see acquire_channel
+        self.max_channels = max_channels
+        self.channels = []
+        self.channels_lock = Lock()
+        # stat and listdir results keyed by normalised path, with missing
+        # paths cached as the OSError icbinn_stat raised. Our own changes
+        # invalidate the paths they touch; clear_cache drops the rest.
+        # generation counts invalidations, so that results fetched while
+        # one happened are not cached.
+        self.lock = RLock()
+        self.stat_cache = {}
+        self.listdir_cache = {}
+        self.generation = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+        self.log.info("calling icbinn at (%d, %d)", server_domain_id,
+                      server_port)
+        self.channels.append(IcbinnChannel(self.connect()))
+        self.log.info("successfully contacted icbinn server for %s",
+                      mount_point)
+
+    def connect(self):
+        """Return a new client handle for our icbinn server"""
         try:
-            self.icbinn = icbinn_clnt_create_argo(server_domain_id,
-                                                 server_port)
+            icbinn = icbinn_clnt_create_argo(self.server_domain_id,
+                                             self.server_port)
         except Exception as exc:
-            raise IcbinnConnectError("failed to connect to icbinn server at "
+            raise self.connect_error("failed to connect to icbinn server at "
                                      "(%d, %d): icbinn_clnt_create_argo "
-                                     "failed: %r" % (server_domain_id,
-                                                     server_port, exc))
-        if self.icbinn is None:
-            raise IcbinnConnectError("failed to connect to icbinn server at "
+                                     "failed: %r" % (self.server_domain_id,
+                                                     self.server_port, exc))
+        if icbinn is None:
+            raise self.connect_error("failed to connect to icbinn server at "
                                      "(%d, %d): icbinn_clnt_create_argo "
-                                     "failed" % (server_domain_id,
-                                                 server_port))
+                                     "failed" % (self.server_domain_id,
+                                                 self.server_port))
+        return icbinn
+
+    def acquire_channel(self, exclude=()):
+        """Return the channel, other than those in exclude, with fewest
+        users, preferring healthy ones. A new one is connected instead if
+        all are in use and there are fewer than max_channels, or if every
+        channel is excluded. The caller must release_channel it."""
+        with self.channels_lock:
+            candidates = [x for x in self.channels if x not in exclude]
+            channel = min([x for x in candidates if x.healthy()] or
+                          candidates, key=lambda x: x.users, default=None)
+            if channel is None or (channel.users and
+                                   len(self.channels) < self.max_channels):
+                channel = IcbinnChannel(self.connect())
+                self.channels.append(channel)
+            channel.users += 1
+            return channel
+
+    def release_channel(self, channel):
+        with self.channels_lock:
+            channel.users -= 1
+
+    def call(self, function, *args, idempotent=True):
+        """Return function(handle, *args) for the handle of a channel,
+        retrying as described for retry"""
+        channel = self.acquire_channel()
+        try:
+            return self.retry(channel, function, *args, idempotent=idempotent)
+        finally:
+            self.release_channel(channel)
+
+    def retry(self, channel, function, *args, idempotent=True):
+        """Return channel.call(function, *args).
+
+        If that raises, other than with an error from the file system, or
+        returns a negative number, and channel then fails to stat '.', the
+        link to the server has gone. The channel is reconnected and, if the
+        call is idempotent, it is made again, up to ICBINN_RETRIES times
+        with exponential backoff. Otherwise the failure is passed on."""
+        for attempt in range(ICBINN_RETRIES + 1):
+            epoch = channel.epoch
+            failure = None
+            try:
+                res = channel.call(function, *args)
+            except Exception as exc:
+                if not is_transport_error(exc):
+                    raise
+                failure = exc
+            else:
+                if not isinstance(res, int) or res >= 0:
+                    return res
+            if attempt == ICBINN_RETRIES or channel.alive():
+                break
+            self.log.warning("icbinn server at (%d, %d) stopped answering; "
+                             "reconnecting", self.server_domain_id,
+                             self.server_port)
+            sleep(ICBINN_RETRY_BACKOFF * 2 ** attempt)
+            try:
+                self.reconnect(channel, epoch)
+            except self.connect_error as exc:
+                self.log.warning("%s", exc)
+                continue
+            if not idempotent:
+                break
+        if failure is not None:
+            raise failure
+        return res
+
+    def reconnect(self, channel, epoch):
+        """Give channel a new client handle, unless it has been reconnected
+        since epoch, and close the old one"""
+        with channel.lock:
+            if channel.epoch == epoch:
+                handle = channel.handle
+                channel.handle = self.connect()
+                channel.epoch += 1
+                channel.failures = 0
+                try:
+                    icbinn_clnt_destroy(handle)
+                except Exception as exc:
+                    # the link it used has gone anyway
+                    self.log.info("closing old icbinn handle failed: %r",
+                                  exc)
+
+    def invalidate(self, path):
+        """Forget cached metadata for path, anything below it and the
+        listing of its directory"""
+        key = normpath(str(path))
+        below = key + '/'
+        with self.lock:
+            self.generation += 1
+            for cache in (self.stat_cache, self.listdir_cache):
+                for cached in [x for x in cache
+                               if x == key or x.startswith(below)]:
+                    del cache[cached]
+            self.listdir_cache.pop(dirname(key) or '.', None)
+
+    def clear_cache(self):
+        """Forget all cached metadata"""
+        with self.lock:
+            self.generation += 1
+            self.stat_cache.clear()
+            self.listdir_cache.clear()
+
+    def log_cache_stats(self):
+        self.log.info("icbinn %s metadata cache: %d hits, %d misses",
+                      self.mount_point, self.cache_hits, self.cache_misses)
 
     def exists(self, path):
         try:
             res = self.stat(path)
-        except IcbinnError:
+        except self.error:
             return False
         return res[1] in [ICBINN_FILE, ICBINN_DIRECTORY]
 
     def listdir(self, path):
+        key = normpath(str(path))
+        with self.lock:
+            if key in self.listdir_cache:
+                self.cache_hits += 1
+                return list(self.listdir_cache[key])
+            self.cache_misses += 1
+            generation = self.generation
         files = []
         while True:
-            entry = icbinn_readent(self.icbinn, str(path), len(files))
+            entry = self.call(icbinn_readent, str(path), len(files))
             if entry is None:
                 break
             files.append(entry[0])
-        return files
+        with self.lock:
+            if self.generation == generation:
+                self.listdir_cache[key] = files
+        return list(files)
+
+    def listdir_attrs(self, path):
+        """Return (name, size, type) for each entry in directory path.
+
+        icbinn returns one entry per call, so the icbinn_readent calls for
+        LISTDIR_BATCH entries at a time, and then the icbinn_stat calls for
+        the entries, are spread over up to LISTDIR_CONNECTIONS channels.
+        The results are cached for listdir and stat too."""
+        key = normpath(str(path))
+        with self.lock:
+            names = self.listdir_cache.get(key)
+            if names is not None:
+                stats = [self.stat_cache.get(join(key, name))
+                         for name in names]
+                if not any(x is None or isinstance(x, OSError)
+                           for x in stats):
+                    self.cache_hits += 1
+                    return [(name, res[0], res[1])
+                            for name, res in zip(names, stats)]
+            self.cache_misses += 1
+            generation = self.generation
+
+        def stat(name):
+            try:
+                return self.call(icbinn_stat, join(str(path), name))
+            except OSError as exc:
+                if exc.errno == ENOENT:
+                    # removed since it was listed
+                    return None
+                raise self.error("error statting icbinn file '%s': "
+                                 "icbinn_stat failed: %s" %
+                                 (join(str(path), name), exc))
+
+        with ThreadPoolExecutor(LISTDIR_CONNECTIONS) as executor:
+            if names is None:
+                names = []
+                while True:
+                    batch = executor.map(
+                        lambda x: self.call(icbinn_readent, str(path), x),
+                        range(len(names), len(names) + LISTDIR_BATCH))
+                    entries = list(takewhile(lambda x: x is not None, batch))
+                    names.extend(entry[0] for entry in entries)
+                    if len(entries) < LISTDIR_BATCH:
+                        break
+            stats = list(executor.map(stat, names))
+
+        attrs = [(name, res[0], res[1]) for name, res in zip(names, stats)
+                 if res is not None]
+        with self.lock:
+            if self.generation == generation:
+                self.listdir_cache[key] = [name for name, _, _ in attrs]
+                for name, size, kind in attrs:
+                    self.stat_cache[join(key, name)] = (size, kind)
+        return attrs
 
     def mkdir(self, path):
-        if icbinn_mkdir(self.icbinn, str(path)) < 0:
-            raise PlatformError("error creating icbinn directory '%s': "
+        self.invalidate(path)
+        if self.call(icbinn_mkdir, str(path),
+                     idempotent=False) < 0:
+            raise self.platform_error("error creating icbinn directory '%s': "
                                 "icbinn_mkdir failed" % path)
 
     def makedirs(self, path, timeout=10):
@@ -124,41 +396,90 @@ class IcbinnRemote(object):
                 continue
             try:
                 self.mkdir(here)
-            except PlatformError:
+            except self.platform_error:
                 pass
         if not self.stat(path)[1] == ICBINN_DIRECTORY:
-            raise PlatformError("unable to create %s over icbinn"
-                                % (here))
-
-    def open(self, path, mode):
-        return IcbinnFile(self.icbinn, path, mode)
+            raise self.platform_error("unable to create %s over icbinn"
+                                      % (here))
+
+    def open(self, path, mode, window=1, holes_from=None):
+        """Open path on a channel, which the file keeps until it is closed.
+        If window is more than 1, writes to the file are spread over that
+        many channels, so that up to window icbinn_pwrite calls are
+        outstanding at once.
+
+        holes_from, if set, is where the file reads as zeros from, such as
+        its size when opened; write() skips all-zero data beyond it, and
+        close() makes the file long enough to hold what was skipped."""
+        if mode != O_RDONLY:
+            self.invalidate(path)
+        channels = []
+        try:
+            while len(channels) < window:
+                channels.append(self.acquire_channel(exclude=channels))
+        except:
+            for channel in channels:
+                self.release_channel(channel)
+            raise
+        return IcbinnFile(self, path, mode, channels, holes_from)
 
     def rename(self, src, dst):
-        if icbinn_rename(self.icbinn, str(src), str(dst)) < 0:
-            raise IcbinnError("error renaming icbinn file '%s' to '%s': "
+        self.invalidate(src)
+        self.invalidate(dst)
+        if self.call(icbinn_rename, str(src), str(dst),
+                     idempotent=False) < 0:
+            raise self.error("error renaming icbinn file '%s' to '%s': "
                               "icbinn_rename failed" % (src, dst))
 
     def stat(self, path):
-        try:
-            return icbinn_stat(self.icbinn, str(path))
-        except OSError as exc:
-            raise IcbinnError("error statting icbinn file '%s': icbinn_stat "
-                              "failed: %s" % (path, exc))
+        key = normpath(str(path))
+        parent = dirname(key) or '.'
+        with self.lock:
+            if key in self.stat_cache:
+                self.cache_hits += 1
+                res = self.stat_cache[key]
+            elif (parent != key and parent in self.listdir_cache and
+                  basename(key) not in self.listdir_cache[parent]):
+                self.cache_hits += 1
+                res = OSError(ENOENT, strerror(ENOENT))
+            else:
+                self.cache_misses += 1
+                res = None
+                generation = self.generation
+        if res is None:
+            self.log.info("statting %s on icbinn %s", path, self.mount_point)
+            try:
+                res = self.call(icbinn_stat, str(path))
+            except OSError as exc:
+                self.log.info("stat %s failed", path)
+                res = exc
+            else:
+                self.log.info("stat %s returned %r", path, res)
+            with self.lock:
+                if (self.generation == generation and
+                    (not isinstance(res, OSError) or res.errno == ENOENT)):
+                    self.stat_cache[key] = res
+        if isinstance(res, OSError):
+            raise self.error("error statting icbinn file '%s': icbinn_stat "
+                              "failed: %s" % (path, res))
+        return res
 
     def unlink(self, path):
-        if icbinn_unlink(self.icbinn, str(path)) < 0:
-            raise IcbinnError("error unlinking icbinn file '%s': "
+        self.invalidate(path)
+        if self.call(icbinn_unlink, str(path),
+                     idempotent=False) < 0:
+            raise self.error("error unlinking icbinn file '%s': "
                               "icbinn_unlink failed" % path)
 
     def rand(self, src, size):
-        data = ""
+        data = b''
         while True:
             if len(data) == size:
                 break
             try:
-                data += icbinn_rand(self.icbinn, src, size - len(data))
+                data += self.call(icbinn_rand, src, size - len(data))
             except IOError as exc:
-                raise IcbinnError("error reading random data from icbinn: "
+                raise self.error("error reading random data from icbinn: "
                                   "icbinn_rand failed: %s" % exc)
         return data
 
@@ -167,76 +488,218 @@ class IcbinnRemote(object):
         file_obj.pwrite(content, 0)
         file_obj.close()
 
+    def read_file(self, name):
+        with self.open(name, O_RDONLY) as file_obj:
+            size = self.stat(name)[0]
+            content = b''
+            while len(content) < size:
+                data = file_obj.pread(min(size - len(content), ICBINN_MAXDATA),
+                                      len(content))
+                if not data:
+                    break
+                content += data
+        return content
+
     def mounted_path(self, path):
         components = path.split('/')
         if '.' in components or '..' in components:
-            raise TargetStateError('invalid components in %s' % (path))
+            raise self.target_state_error('invalid components in %s' % (path))
         return join(self.mount_point, path)
 
 class IcbinnFile(object):
-    def __init__(self, icbinn, path, mode):
+    def __init__(self, icbinn, path, mode, channels, holes_from=None):
+        """Open path with icbinn on channels, the first of which is used
+        for everything but writes. The channels are released to icbinn on
+        close, or if opening fails."""
         self.icbinn = icbinn
         self.path = path
+        self.channel = channels[0]
+        # if a channel is reconnected, the file is opened again on it with
+        # this mode, unless we hold an icbinn lock, which went with the old
+        # handle
+        self.reopen_mode = mode & ~(O_EXCL | O_TRUNC)
+        self.locked = False
         self.write_offset = 0
+        # if set, the file reads as zeros from here on, so write() skips
+        # all-zero data beyond it
+        self.holes_from = holes_from
+        # the end of the data write() has been given, and of what it wrote
+        self.data_end = self.written_end = 0
+        # channels we write on at once, a queue of those not in use, and
+        # our (fd, channel epoch) on each
+        self.channels = list(channels)
+        self.idle_channels = Queue()
+        self.executor = None
+        self.fds = {}
 
-        self.fd = icbinn_open(self.icbinn, str(self.path), mode)
-        if self.fd < 0:
-            raise IcbinnError("error opening icbinn file '%s': icbinn_open "
-                              "failed" % self.path)
+        try:
+            for channel in self.channels:
+                fd = self.icbinn.retry(channel, icbinn_open, str(self.path),
+                                       mode)
+                if fd < 0:
+                    raise self.icbinn.error("error opening icbinn file '%s': "
+                                      "icbinn_open failed" % self.path)
+                self.fds[channel] = fd, channel.epoch
+        except:
+            self.close()
+            raise
+        for channel in self.channels:
+            self.idle_channels.put(channel)
+        if len(self.channels) > 1:
+            self.executor = ThreadPoolExecutor(len(self.channels))
+
+    def fd_on(self, channel, handle):
+        """Return our fd on channel, whose handle is handle, opening the
+        file again if the channel has been reconnected since, or failing if
+        we had locked it, since the lock has been lost"""
+        fd, epoch = self.fds[channel]
+        if epoch != channel.epoch:
+            if self.locked:
+                raise self.icbinn.error("lock on icbinn file '%s' lost when "
+                                        "its channel was reconnected" %
+                                        self.path)
+            fd = icbinn_open(handle, str(self.path), self.reopen_mode)
+            if fd < 0:
+                raise self.icbinn.error("error reopening icbinn file '%s': "
+                                  "icbinn_open failed" % self.path)
+            self.fds[channel] = fd, channel.epoch
+        return fd
+
+    def call(self, channel, function, *args):
+        """Return function(handle, fd, *args) for our fd on channel,
+        retrying as described for Icbinn.retry"""
+        return self.icbinn.retry(
+            channel, lambda handle: function(handle,
+                                             self.fd_on(channel, handle),
+                                             *args))
 
     def close(self):
-        if icbinn_close(self.icbinn, self.fd) < 0:
-            raise IcbinnError("error closing icbinn file '%s': icbinn_close "
+        try:
+            if self.channels:
+                self.extend()
+        finally:
+            if self.executor:
+                self.executor.shutdown()
+            res = self.close_channels()
+        if res < 0:
+            raise self.icbinn.error("error closing icbinn file '%s': icbinn_close "
                               "failed" % self.path)
 
+    def close_channels(self):
+        """Close our fds, release our channels, and return -1 if closing the
+        fd on the main channel failed, otherwise 0"""
+        res = 0
+        try:
+            for channel in self.channels:
+                fd, epoch = self.fds.get(channel, (-1, None))
+                # fds from before a reconnection went with the old handle
+                if epoch == channel.epoch:
+                    if (channel.call(icbinn_close, fd) < 0 and
+                        channel is self.channel):
+                        res = -1
+        finally:
+            for channel in self.channels:
+                self.icbinn.release_channel(channel)
+            self.channels = []
+        return res
+
     def get_read_lock(self):
-        if icbinn_lock(self.icbinn, self.fd, ICBINN_LTYPE_RDLCK) < 0:
-            raise IcbinnError("error getting read lock on icbinn file '%s': "
+        if self.call(self.channel, icbinn_lock, ICBINN_LTYPE_RDLCK) < 0:
+            raise self.icbinn.error("error getting read lock on icbinn file '%s': "
                               "icbinn_lock failed" % self.path)
+        self.locked = True
 
     def get_write_lock(self):
-        if icbinn_lock(self.icbinn, self.fd, ICBINN_LTYPE_WRLCK) < 0:
-            raise IcbinnError("error getting write lock on icbinn file '%s': "
+        if self.call(self.channel, icbinn_lock, ICBINN_LTYPE_WRLCK) < 0:
+            raise self.icbinn.error("error getting write lock on icbinn file '%s': "
                               "icbinn_lock failed" % self.path)
+        self.locked = True
 
     def seek(self, offset):
         self.write_offset = offset
 
     def write(self, data):
         try:
-            self.pwrite(data, self.write_offset)
-        except IcbinnError as e:
+            self.pwrite(data, self.write_offset, self.holes_from)
+        except self.icbinn.error as e:
             raise e
 
         self.write_offset += len(data)
-
-    def pwrite(self, data, offset):
-        data_len = len(data)
-        written = 0
-        while written < data_len:
-            n = icbinn_pwrite(self.icbinn, self.fd,
-                              data[written:written + ICBINN_MAXDATA],
+        self.data_end = max(self.data_end, self.write_offset)
+
+    def extend(self):
+        """Write the last byte given to write(), if it was skipped as part
+        of all-zero data past holes_from, so that the file is as long as
+        the data"""
+        if (self.holes_from is not None and
+            self.data_end > max(self.holes_from, self.written_end)):
+            self.pwrite(b'\0', self.data_end - 1)
+            self.written_end = self.data_end
+
+    def pwrite(self, data, offset, holes_from=None):
+        """Write data at offset, skipping all-zero ICBINN_MAXDATA slices at
+        or beyond holes_from, if set, where the file reads as zeros.
+
+        If the file was opened with a window, the slices are written on all
+        its channels at once. Either way this returns once they have all
+        been written, or raises IcbinnWriteError with the offsets of those
+        which failed."""
+        view = memoryview(data).toreadonly()
+        slices = []
+        for written in range(0, len(view), ICBINN_MAXDATA):
+            chunk = view[written:written + ICBINN_MAXDATA]
+            if (holes_from is None or offset + written < holes_from or
+                not ZEROS.startswith(chunk)):
+                slices.append((chunk, offset + written))
+        try:
+            if self.executor and len(slices) > 1:
+                results = list(self.executor.map(
+                        lambda x: self.__write_slice__(*x), slices))
+                failed = [at for (_, at), ok in zip(slices, results) if not ok]
+                if failed:
+                    raise self.icbinn.write_error(self.path, failed)
+            else:
+                for chunk, at in slices:
+                    if not self.__write_slice__(chunk, at):
+                        raise self.icbinn.write_error(self.path, [at])
+            if slices:
+                self.written_end = max(self.written_end,
+                                       slices[-1][1] + len(slices[-1][0]))
+        finally:
+            if slices:
+                self.icbinn.invalidate(self.path)
+
+    def __write_slice__(self, data, offset):
+        """Write data at offset on an idle channel, returning whether it
+        succeeded"""
+        channel = self.idle_channels.get()
+        try:
+            written = 0
+            while written < len(data):
+                n = self.call(channel, icbinn_pwrite, data[written:],
                               offset + written)
-            if n < 0:
-                raise IcbinnError("error writing to icbinn file '%s': "
-                                  "icbinn_pwrite failed" % self.path)
-            written += n
+                if n < 0:
+                    return False
+                written += n
+            return True
+        finally:
+            self.idle_channels.put(channel)
 
     def pread(self, size, offset):
         try:
-            return icbinn_pread(self.icbinn, self.fd, size, offset)
+            return self.call(self.channel, icbinn_pread, size, offset)
         except IOError as exc:
-            raise IcbinnError("error reading icbinn file '%s': icbinn_pwrite "
+            raise self.icbinn.error("error reading icbinn file '%s': icbinn_pwrite "
                               "failed: %s" % (self.path, exc))
 
     def unlock(self):
-        if icbinn_lock(self.icbinn, self.fd, ICBINN_LTYPE_UNLCK) < 0:
-            raise IcbinnError("error unlocking icbinn file '%s': icbinn_lock "
+        if self.call(self.channel, icbinn_lock, ICBINN_LTYPE_UNLCK) < 0:
+            raise self.icbinn.error("error unlocking icbinn file '%s': icbinn_lock "
                               "failed" % self.path)
+        self.locked = False
 
     def __enter__(self):
         return self
 
     def __exit__(self, *_):
         self.close()
-
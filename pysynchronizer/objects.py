@@ -21,7 +21,7 @@ import os.path
 from .utils import is_valid_uuid, dbus_path_to_uuid, uuid_to_dbus_path
 from .errors import ConnectionError, ConfigError
 from .storage import Storage
-from .oxt_dbus import OXTDBusApi
+from .oxt_dbus import OXTDBusApi, forget_proxies
 
 class XenMgr:
     def __init__(self):
@@ -71,11 +71,11 @@ class XenMgr:
 
         return None
 
-    def upgrade(self, url):
+    def upgrade(self, url, checksum=None):
         """Takes a url, downloads it, and moves it for the upgrade manager to find"""
         storage = Storage()
         try:
-            src = storage.stage_oxt_repo(url)
+            src = storage.stage_oxt_repo(url, checksum)
             storage.apply_oxt_repo(src)
             return True
         except:
@@ -99,6 +99,7 @@ class VM:
         """Attempts to delete the VM ref, returns True if successful"""
         if self.connected:
             self.proxy_object.delete()
+            forget_proxies(self.path)
             self.uuid = None
             self.proxy_object = None
             self.connected = False
@@ -163,13 +164,20 @@ class VMDisk:
     def __init__(self, path):
             self.id = path.rsplit('/',1)[1]
             self.proxy_object = OXTDBusApi.open_disk(path)
+            # all the disk's properties, fetched at once on first use
+            self.snapshot = None
 
     def get_property(self, name):
         """Retrieve a DBus object property, returning "" for when it does not exist"""
+        if self.snapshot is None:
+            self.snapshot = self.proxy_object.get_all_properties()
+        if name in self.snapshot:
+            return self.snapshot[name]
         return self.proxy_object.get_property(name)
 
     def set_property(self, name, value):
         """Set the value of a DBus object property, returning value if successful"""
+        self.snapshot = None
         return self.proxy_object.set_property(name, value)
 
     def name(self):
@@ -182,10 +190,10 @@ class VMDisk:
 
         return os.path.basename(path)
 
-    def replace(self, url):
+    def replace(self, url, checksum=None):
         """Downloads a file located at "url" and overwrites the backing disk"""
         storage = Storage()
         try:
-            return storage.download_disk(self.name(), url)
+            return storage.download_disk(self.name(), url, checksum)
         except:
             return None
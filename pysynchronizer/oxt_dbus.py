@@ -16,8 +16,8 @@
 # Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
 #
 
-from dbus import SystemBus, Interface
-import collections
+from dbus import SystemBus, Interface, DBusException
+from threading import Lock
 
 # DBus Services
 XENMGR_SERVICE = 'com.citrix.xenclient.xenmgr'
@@ -31,25 +31,92 @@ XENMGR_VM_INTF = 'com.citrix.xenclient.xenmgr.vm'
 DISK_INTF = 'com.citrix.xenclient.vmdisk'
 INPUT_INTF = 'com.citrix.xenclient.input'
 DB_INTF = 'com.citrix.xenclient.db'
+PROPERTIES_INTF = 'org.freedesktop.DBus.Properties'
+
+# Errors meaning a cached proxy refers to an object or service owner which
+# has gone, so that a new proxy should be made
+STALE_PROXY_ERRORS = [
+    'org.freedesktop.DBus.Error.ServiceUnknown',
+    'org.freedesktop.DBus.Error.NameHasNoOwner',
+    'org.freedesktop.DBus.Error.UnknownObject']
+
+# Object proxies by (service, path) and interface proxies by (service, path,
+# interface), reused for the life of the process
+_objects = {}
+_proxies = {}
+_proxies_lock = Lock()
+
+def get_proxy(service, obj_path, intf):
+    """Return a proxy for intf on the object at obj_path of service,
+    reusing the one made last time"""
+    with _proxies_lock:
+        proxy = _proxies.get((service, obj_path, intf))
+        if proxy is None:
+            obj = _objects.get((service, obj_path))
+            if obj is None:
+                obj = _objects[(service, obj_path)] = SystemBus().get_object(
+                    service, obj_path)
+            proxy = _proxies[(service, obj_path, intf)] = Interface(
+                obj, dbus_interface=intf)
+        return proxy
+
+def forget_proxies(obj_path):
+    """Drop the proxies for the object at obj_path and those below it,
+    which have gone or are about to"""
+    with _proxies_lock:
+        for cache in (_objects, _proxies):
+            for key in [x for x in cache if x[1] == obj_path or
+                        x[1].startswith(obj_path.rstrip('/') + '/')]:
+                del cache[key]
+
+def call_proxy(service, obj_path, intf, call):
+    """Return call(proxy) for the proxy for intf on the object at obj_path
+    of service. If the proxy turns out to be stale, try once more with a
+    new one."""
+    try:
+        return call(get_proxy(service, obj_path, intf))
+    except DBusException as exc:
+        if exc.get_dbus_name() not in STALE_PROXY_ERRORS:
+            raise
+        forget_proxies(obj_path)
+        return call(get_proxy(service, obj_path, intf))
 
 class ServiceObject:
     def __init__(self, service, intf, obj_path):
-        obj = SystemBus().get_object(service, obj_path)
-        self.intf = Interface(obj, dbus_interface=intf)
-        self.propi = Interface(obj, dbus_interface='org.freedesktop.DBus.Properties')
+        self.service = service
+        self.obj_path = obj_path
+        self.intf_name = intf
+        # make the proxies now, so that an unreachable object fails here
+        get_proxy(service, obj_path, intf)
+        get_proxy(service, obj_path, PROPERTIES_INTF)
 
     def __getattr__(self, name):
         # if wrapped dbus intf has it, call it
-        if isinstance(getattr(self.intf, name, None), collections.Callable):
-            return getattr(self.intf, name)
+        intf = get_proxy(self.service, self.obj_path, self.intf_name)
+        if callable(getattr(intf, name, None)):
+            return lambda *args, **kwargs: self.__call_proxy__(
+                self.intf_name,
+                lambda proxy: getattr(proxy, name)(*args, **kwargs))
+
+    def __call_proxy__(self, intf, call):
+        """Return call(proxy) for our proxy for intf, as call_proxy does"""
+        return call_proxy(self.service, self.obj_path, intf, call)
 
     def get_property(self, key):
         """Lookup key on interface at path"""
-        return self.propi.Get(self.intf.dbus_interface, key)
+        return self.__call_proxy__(
+            PROPERTIES_INTF, lambda propi: propi.Get(self.intf_name, key))
+
+    def get_all_properties(self):
+        """Return all the properties on interface at path with one call"""
+        return self.__call_proxy__(
+            PROPERTIES_INTF, lambda propi: propi.GetAll(self.intf_name))
 
     def set_property(self, key, value):
         """Set key to value on interface at path"""
-        return str(self.propi.Set(self.intf.dbus_interface, key, value))
+        return str(self.__call_proxy__(
+            PROPERTIES_INTF,
+            lambda propi: propi.Set(self.intf_name, key, value)))
 
 class OXTDBusApi:
     @staticmethod
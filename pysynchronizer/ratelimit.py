@@ -0,0 +1,131 @@
+#
+# Copyright (c) 2021 Daniel P. Smith, Apertus Solutions LLC
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+
+from logging import getLogger
+from re import match
+from threading import Lock
+from time import localtime, monotonic, sleep
+from .errors import ConfigError
+
+RATE_LIMIT_BURST_SECONDS = 1
+RATE_SCHEDULE_INTERVAL = 10
+
+def parse_rate_schedule(text, error=ConfigError):
+    """Parse a download rate schedule of comma separated HH:MM-HH:MM=RATE
+    entries, each giving a rate limit in bytes per second (0 for none) for
+    a time of day, into a list of (start minute, end minute, rate). An
+    entry whose end is before its start runs over midnight.
+
+    error is the exception raised if text is not valid."""
+    schedule = []
+    for entry in [x.strip() for x in text.split(',') if x.strip()]:
+        found = match(r'^(\d\d?):(\d\d)-(\d\d?):(\d\d)=(\d+)$', entry)
+        if not found:
+            raise error("invalid download rate schedule entry %r" % entry)
+        start_hour, start_minute, end_hour, end_minute, rate = [
+            int(x) for x in found.groups()]
+        if max(start_hour, end_hour) > 23 or max(start_minute, end_minute) > 59:
+            raise error("invalid time in download rate schedule entry %r" %
+                        entry)
+        schedule.append((start_hour * 60 + start_minute,
+                         end_hour * 60 + end_minute, rate))
+    return schedule
+
+class TokenBucket:
+    """Limit a flow of bytes, which may be shared by several threads, to
+    rate bytes per second, or not at all if rate is 0. Bytes are reserved as
+    they are consumed, so concurrent consumers between them get the rate."""
+    def __init__(self, rate=0):
+        self.lock = Lock()
+        self.rate = 0
+        self.tokens = 0
+        self.stamp = monotonic()
+        self.set_rate(rate)
+
+    def set_rate(self, rate):
+        with self.lock:
+            self.__refill__()
+            self.rate = rate
+
+    def consume(self, nbytes):
+        """Wait until nbytes may be passed on"""
+        with self.lock:
+            if self.rate <= 0:
+                return
+            self.__refill__()
+            self.tokens -= nbytes
+            delay = -self.tokens / self.rate
+        if delay > 0:
+            sleep(delay)
+
+    def __refill__(self):
+        now = monotonic()
+        if self.rate > 0:
+            self.tokens = min(self.tokens + (now - self.stamp) * self.rate,
+                              self.rate * RATE_LIMIT_BURST_SECONDS)
+        else:
+            self.tokens = 0
+        self.stamp = now
+
+class RateLimiter:
+    """Bandwidth limits for downloads: rate is shared by every transfer,
+    except at times of day covered by schedule, and transfer_rate applies to
+    each transfer. Rates are in bytes per second, and 0 means no limit.
+
+    sync_client subclasses this, so the error raised for an invalid
+    schedule and the logger used are attributes which it replaces."""
+    config_error = ConfigError
+    log = getLogger(__name__)
+
+    def __init__(self, rate=0, transfer_rate=0, schedule=""):
+        self.rate = rate
+        self.transfer_rate = transfer_rate
+        self.schedule = parse_rate_schedule(schedule, self.config_error)
+        self.bucket = TokenBucket()
+        self.set_rate(self.current_rate())
+        self.checked = monotonic()
+
+    def set_rate(self, rate):
+        """Share rate between every transfer from now on"""
+        if rate != self.bucket.rate:
+            self.log.info("download rate limit %d bytes per second", rate)
+        self.bucket.set_rate(rate)
+
+    def current_rate(self):
+        """Return the rate shared by every transfer at this time of day"""
+        now = localtime()
+        minute = now.tm_hour * 60 + now.tm_min
+        for start, end, rate in self.schedule:
+            if (start <= minute < end if start <= end else
+                minute >= start or minute < end):
+                return rate
+        return self.rate
+
+    def transfer(self):
+        """Return a function to call with the size of each chunk of a new
+        transfer, which waits until the chunk may be passed on"""
+        bucket = TokenBucket(self.transfer_rate)
+
+        def throttle(nbytes):
+            if self.schedule and monotonic() > (self.checked +
+                                                RATE_SCHEDULE_INTERVAL):
+                self.checked = monotonic()
+                self.set_rate(self.current_rate())
+            bucket.consume(nbytes)
+            self.bucket.consume(nbytes)
+        return throttle
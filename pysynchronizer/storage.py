@@ -19,10 +19,13 @@
 
 import uuid
 
-from os import O_CREAT, O_WRONLY
+from os import O_CREAT, O_RDONLY, O_WRONLY
 from os.path import join, split
+from .errors import ChecksumMismatch, ConfigError
+from .hashing import HashingWriter, StreamHasher
 from .http_fetcher import HttpFetcher
-from .icbinn import Icbinn
+from .icbinn import Icbinn, ICBINN_FILE, ICBINN_MAXDATA
+from .oxt_dbus import OXTDBusApi
 
 DOWNLOAD_BLOCK_SIZE = 512 * 1024
 REPO_DOWNLOAD_DIR = 'repo-download'
@@ -32,40 +35,88 @@ DISKS_DIR = 'disks'
 class Storage:
     def __init__(self, block_size=DOWNLOAD_BLOCK_SIZE):
         self.storage = Icbinn().storage
+        # the connection outlives us, and others may have changed the tree
+        # since it last cached anything
+        self.storage.clear_cache()
         self.block_size = block_size
-
-    def fetch_using_partial(self, url, file_path):
+        # how many icbinn_pwrite calls a download keeps outstanding
+        window = OXTDBusApi.open_db().read("icbinn-write-window")
+        try:
+            self.write_window = max(int(window or 1), 1)
+        except ValueError:
+            raise ConfigError("domstore key 'icbinn-write-window' value '%s' "
+                              "is not an integer" % window)
+
+    def fetch_using_partial(self, url, file_path, checksum=None):
+        """Download url to file_path, resuming from any existing .partial
+        file. If checksum is set, the SHA-256 of the whole file, including
+        any resumed part, is computed on another thread as it downloads and
+        must match it."""
         partial = file_path + '.partial'
         offset = 0
         fetcher = HttpFetcher()
-
-        if self.storage.exists(partial):
-            offset = self.storage.stat(partial)[0]
-
-        partial_handle = self.storage.open(partial, O_CREAT | O_WRONLY)
-        if offset != 0:
-            partial_handle.seek(offset)
-
-        fetcher.stream(url, partial_handle, offset, self.block_size)
-
-        partial_handle.close()
+        hasher = StreamHasher() if checksum else None
+
+        try:
+            if self.storage.exists(partial):
+                offset = self.storage.stat(partial)[0]
+
+            if hasher and offset != 0:
+                self.hash_existing(partial, offset, hasher)
+
+            # whatever is past the resumed part reads as zeros, so all-zero
+            # blocks need not be written
+            partial_handle = self.storage.open(partial, O_CREAT | O_WRONLY,
+                                               self.write_window,
+                                               holes_from=offset)
+            if offset != 0:
+                partial_handle.seek(offset)
+
+            if hasher:
+                fetcher.stream(url, HashingWriter(partial_handle, hasher),
+                               offset, self.block_size)
+            else:
+                fetcher.stream(url, partial_handle, offset, self.block_size)
+            partial_handle.close()
+        finally:
+            if hasher:
+                hasher.close()
+
+        if hasher:
+            digest = hasher.hexdigest()
+            if digest != checksum.lower():
+                self.storage.unlink(partial)
+                raise ChecksumMismatch("%s has SHA-256 %s, expected %s" %
+                                       (url, digest, checksum))
 
         if self.storage.exists(file_path):
             self.storage.unlink(file_path)
 
         self.storage.rename(partial, file_path)
 
-    def download_disk(self, disk_name, url):
+    def hash_existing(self, path, size, hasher):
+        """Pass the first size bytes of path to hasher"""
+        with self.storage.open(path, O_RDONLY) as handle:
+            offset = 0
+            while offset < size:
+                data = handle.pread(min(size - offset, ICBINN_MAXDATA), offset)
+                if not data:
+                    break
+                hasher.update(data)
+                offset += len(data)
+
+    def download_disk(self, disk_name, url, checksum=None):
         disk_file = join(DISKS_DIR, disk_name)
 
-        self.fetch_using_partial(url, disk_file)
+        self.fetch_using_partial(url, disk_file, checksum)
 
         return disk_file
 
     def list_disks(self):
-        return self.storage.listdir(DISKS_DIR)
+        return [name for name, _, kind in self.storage.listdir_attrs(DISKS_DIR)
+                if kind == ICBINN_FILE]
 
-    def stage_oxt_repo(self, url):
+    def stage_oxt_repo(self, url, checksum=None):
         repo_uuid = uuid.uuid5(uuid.NAMESPACE_URL, url)
         repo_name = str(repo_uuid) + '.tar'
 
@@ -73,7 +124,7 @@ class Storage:
 
         download_file = join(REPO_DOWNLOAD_DIR, repo_name)
 
-        self.fetch_using_partial(url, download_file)
+        self.fetch_using_partial(url, download_file, checksum)
 
         return repo_name
 
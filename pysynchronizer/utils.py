@@ -1,8 +1,15 @@
 
 import os
 
+from base64 import b64encode
+from contextlib import contextmanager
+from threading import Lock
+from urllib.parse import unquote, urlsplit
+from urllib.request import getproxies, proxy_bypass
 from uuid import UUID, uuid4
 
+ARGO_INET_LOCK = Lock() # held while INET_IS_ARGO is unset to open a socket
+
 def is_valid_uuid(uuid_to_test):
     try:
         uuid_obj = UUID(uuid_to_test)
@@ -30,9 +37,31 @@ def dbus_path_to_uuid(path):
 def uuid_to_dbus_path(prefix, uuid):
     return prefix + uuid.replace('-','_')
 
-def disable_argo_inet():
-    if 'INET_IS_ARGO' in os.environ:
-        del os.environ['INET_IS_ARGO']
+@contextmanager
+def inet_not_argo():
+    """Unset INET_IS_ARGO while a socket is created, so that it goes to the
+    network rather than over argo"""
+    with ARGO_INET_LOCK:
+        saved = os.environ.pop('INET_IS_ARGO', None)
+        try:
+            yield
+        finally:
+            if saved is not None:
+                os.environ['INET_IS_ARGO'] = saved
 
-def enable_argo_inet():
-    os.environ['INET_IS_ARGO'] = "1"
+def proxy_for(scheme, host):
+    """Return the (host, port, headers) of the proxy which the http_proxy or
+    https_proxy environment variable sets for scheme, where headers has any
+    Proxy-Authorization from credentials in its URL, or None if there is
+    none or no_proxy excludes host"""
+    proxy = getproxies().get(scheme)
+    if not proxy or proxy_bypass(host):
+        return None
+    url = urlsplit(proxy if '//' in proxy else '//' + proxy)
+    headers = {}
+    if url.username is not None:
+        credentials = '%s:%s' % (unquote(url.username),
+                                 unquote(url.password or ''))
+        headers['Proxy-Authorization'] = 'Basic ' + b64encode(
+            credentials.encode('utf-8')).decode('ascii')
+    return url.hostname, url.port or 80, headers
@@ -21,39 +21,50 @@ from sys import path
 path.append('/usr/lib/python2.6/site-packages/requests-0.11.1-py2.6.egg')
 from json import loads, dumps
 from sys import argv
-from dbus import SystemBus, Interface, DBusException, String, Boolean, Int32
+from dbus import DBusException, String, Boolean, Int32
 from subprocess import call, check_call, Popen, PIPE, check_output
 from subprocess import CalledProcessError
 from os.path import basename, dirname, join, split
+from http.client import HTTPException
+from ssl import create_default_context
+from socket import SHUT_RDWR
+from urllib.parse import urlsplit
+from urllib.request import parse_http_list, parse_keqv_list
+from hashlib import md5, sha256
 from argparse import ArgumentParser
 from logging import DEBUG, Formatter, getLogger, INFO, StreamHandler
 from logging.handlers import SysLogHandler
 from traceback import format_exc
-from time import sleep, time
+from time import monotonic, sleep, time
 from uuid import uuid4
+from functools import partial
+from threading import BoundedSemaphore, Lock, Thread
+from queue import Queue, Empty
+from concurrent.futures import FIRST_COMPLETED, FIRST_EXCEPTION
+from concurrent.futures import ThreadPoolExecutor, wait
+from heapq import heapify, heappop, heappush
+from contextlib import contextmanager, ExitStack, nullcontext
 from tempfile import NamedTemporaryFile
 from os import unlink, O_CREAT, O_RDONLY, O_WRONLY, environ
-from pyicbinn import icbinn_clnt_create_argo, icbinn_close, icbinn_lock
-from pyicbinn import icbinn_mkdir, icbinn_open, icbinn_pwrite, icbinn_rand
-from pyicbinn import icbinn_readent, icbinn_rename, icbinn_stat, icbinn_pread
-from pyicbinn import icbinn_unlink
+from pysynchronizer.icbinn import IcbinnRemote, DEFAULT_ICBINN_CHANNELS
+from pysynchronizer.icbinn import ICBINN_DIRECTORY, ICBINN_MAXDATA
+from pysynchronizer.icbinn import ICBINN_RANDOM, ICBINN_SERVER_PORT
+from pysynchronizer.icbinn import ICBINN_URANDOM
+from pysynchronizer import http_pool, ratelimit
+from pysynchronizer.oxt_dbus import call_proxy, forget_proxies, get_proxy
 from re import match
+from struct import unpack
+from zlib import decompressobj
 from itertools import zip_longest
+try:
+    from zstandard import ZstdDecompressor, frame_header_size
+    from zstandard import get_frame_parameters
+except ImportError:
+    ZstdDecompressor = None
 
 # TODO: revisit info messages, convert most to debug messages or remove?
 # TODO: ICBINN_MAXDATA, O_WRONLY etc. should come from pyicbinn
 
-ICBINN_SERVER_PORT = 4878
-ICBINN_SERVER_DOMAIN_ID = 0
-ICBINN_MAXDATA = 65536
-ICBINN_FILE = 0
-ICBINN_DIRECTORY = 1
-ICBINN_UNKNOWN = 2
-ICBINN_LTYPE_RDLCK = 0
-ICBINN_LTYPE_WRLCK = 1
-ICBINN_LTYPE_UNLCK = 2
-ICBINN_RANDOM = 0
-ICBINN_URANDOM = 1
 DISK_DIR = 'disks'
 REPO_DOWNLOAD_DIR = 'repo-download'
 REPO_HANDOVER_DIR = 'repo'
@@ -62,8 +73,28 @@ STATUS_OKAY = 0
 STATUS_INTERNAL_EXCEPTION = 1
 STATUS_FAILED = 2
 DOWNLOAD_BLOCK_SIZE = 512 * 1024
+DEFAULT_DOWNLOAD_SEGMENTS = 1
+DEFAULT_DOWNLOAD_CONCURRENCY = 1
+DEFAULT_DOWNLOAD_CONNECTIONS = 0 # no limit
+DEFAULT_RECONCILE_CONCURRENCY = 1
+DEFAULT_ICBINN_WRITE_WINDOW = 1
+MIN_SEGMENT_SIZE = 16 * 1024 * 1024
+SEGMENT_CHECKPOINT_BYTES = 16 * 1024 * 1024
+SEGMENTS_SUFFIX = '.partial.segments'
+MANIFEST_SUFFIX = '.manifest'
+MANIFEST_TIMEOUT = 60
+HASH_CATCH_UP_BYTES = 8 * DOWNLOAD_BLOCK_SIZE
+DECOMPRESS_QUEUE_BLOCKS = 8
+WRITE_QUEUE_BLOCKS = 8
+COMPRESSION_GZIP = 'gzip'
+COMPRESSION_ZSTD = 'zstd'
+ZSTD_MAGIC = 0xFD2FB528
+ZSTD_SKIPPABLE_MAGIC = 0x184D2A50 # the low four bits are free
+COMPRESSION_SUFFIXES = {COMPRESSION_GZIP: '.gz', COMPRESSION_ZSTD: '.zst'}
+ZEROS = bytes(ICBINN_MAXDATA)
 ENCRYPTION_KEY_BYTES = 64
 PROGRESS_INTERVAL = 1
+DEFAULT_DOWNLOAD_RATE_LIMIT = 0 # bytes per second; no limit
 DISK_TYPE_ISO = 'iso'
 DISK_TYPE_VHD = 'vhd'
 DISK_TYPES = [DISK_TYPE_ISO, DISK_TYPE_VHD]
@@ -72,9 +103,27 @@ SYNC_ROLE_REALM = 'realm'
 SYNC_ROLES = [SYNC_ROLE_PLATFORM, SYNC_ROLE_REALM]
 RPC_PREFIX = 'rpc:'
 
+DIGEST_ALGORITHMS = {'MD5': md5, 'SHA-256': sha256}
+
 ICBINN_STORAGE = None # set to the icbinn object for storage by setup_icbinn
 ICBINN_CONFIG = None # set to the icbinn object for config by setup_icbinn
 
+# during a pass, the properties of each (service, path, interface) from one
+# GetAll call, or None where that failed; see property_snapshots
+PROPERTY_SNAPSHOTS = None
+# properties which change under us, such as a VM's state when the user
+# starts it, so that get_property always reads them live
+LIVE_PROPERTIES = ['state']
+# a lock for each (service, path), held while its snapshots are taken or
+# changed, and the lock held while making those locks
+PROPERTY_SNAPSHOT_LOCKS = {}
+PROPERTY_SNAPSHOTS_LOCK = Lock()
+# a lock for each snapshot VHD path, held while it is checked for and made,
+# since VMs sharing a disk share its snapshot, and the lock held while
+# making those locks
+SNAPSHOT_LOCKS = {}
+SNAPSHOT_LOCKS_LOCK = Lock()
+
 # VM properties set at template top level rather than config
 VM_TOP_PROPERTIES = [
     'amt-pt', 'auto-s3-wake', 'control-platform-power-state', 'cpuid',
@@ -102,6 +151,28 @@ VM_NO_HYPHEN_PROPERTIES = [
 VM_CENSORED_PROPERTIES = [
     'realm', 'sync-uuid', 'crypto-key-dirs', 'ready', 'download-progress']
 
+# sync-client configuration items and their defaults; the target state may
+# set them with daemon 'sync-client'
+MYCONFIG_DEFAULTS = {
+    'use-pseudorandomness': False,
+    'download-segments': DEFAULT_DOWNLOAD_SEGMENTS,
+    'download-concurrency': DEFAULT_DOWNLOAD_CONCURRENCY,
+    'download-connections': DEFAULT_DOWNLOAD_CONNECTIONS,
+    'download-rate-limit': DEFAULT_DOWNLOAD_RATE_LIMIT,
+    'download-transfer-rate-limit': DEFAULT_DOWNLOAD_RATE_LIMIT,
+    'download-rate-schedule': '',
+    'icbinn-write-window': DEFAULT_ICBINN_WRITE_WINDOW,
+    'icbinn-channels': DEFAULT_ICBINN_CHANNELS,
+    'reconcile-concurrency': DEFAULT_RECONCILE_CONCURRENCY}
+
+# sync-client configuration items whose defaults may be set by domstore keys
+# of the same name
+DOMSTORE_CONFIG_KEYS = [
+    'download-segments', 'download-concurrency', 'download-connections',
+    'download-rate-limit', 'download-transfer-rate-limit',
+    'download-rate-schedule', 'icbinn-write-window', 'icbinn-channels',
+    'reconcile-concurrency']
+
 log = getLogger(basename(argv[0]))
 
 class Error(Exception):
@@ -135,6 +206,14 @@ class IcbinnError(Error):
     """Other icbinn error"""
     exit_code = 10
 
+class IcbinnWriteError(IcbinnError):
+    """icbinn_pwrite failed; offsets lists where"""
+    def __init__(self, path, offsets):
+        IcbinnError.__init__(self, "error writing to icbinn file '%s': "
+                             "icbinn_pwrite failed at offsets %s" % (
+                path, ', '.join(str(x) for x in offsets)))
+        self.offsets = offsets
+
 class MissingDownload(Error):
     """stat failed on a file after download"""
     exit_code = 11
@@ -159,6 +238,10 @@ class VhdUtilSnapshotFailed(Error):
     """Running vhd-util snapshot did not create a file"""
     exit_code = 16
 
+class ChecksumMismatch(Error):
+    """A download did not match the checksum in the target state"""
+    exit_code = 17
+
 def setup_icbinn():
     """Setup icbinn paths and objects module level variables"""
     global ICBINN_CONFIG, ICBINN_STORAGE
@@ -177,167 +260,91 @@ def setup_icbinn():
     ICBINN_STORAGE, ICBINN_CONFIG = instances[:2]
 
 
-# TODO: consider moving Icbinn and IcbinnFile into pyicbinn
-
-class Icbinn(object):
-    def __init__(self, mount_point, 
-                 server_domain_id=ICBINN_SERVER_DOMAIN_ID,
-                 server_port=ICBINN_SERVER_PORT):
-        self.mount_point = mount_point
-        log.info("calling icbinn at (%d, %d)", server_domain_id, server_port)
-        try:
-            self.icbinn = icbinn_clnt_create_argo(server_domain_id,
-                                                 server_port)
-        except Exception as exc:
-            raise IcbinnConnectError("failed to connect to icbinn server at "
-                                     "(%d, %d): icbinn_clnt_create_argo "
-                                     "failed: %r" % (server_domain_id,
-                                                     server_port, exc))
-        if self.icbinn is None:
-            raise IcbinnConnectError("failed to connect to icbinn server at "
-                                     "(%d, %d): icbinn_clnt_create_argo "
-                                     "failed" % (server_domain_id,
-                                                 server_port))
-        log.info("successfully contacted icbinn server for %s" % (mount_point))
-
-    def exists(self, path):
-        log.info("statting %s on icbinn %s" % (path, self.mount_point))
-        try:
-            res = self.stat(path)
-        except IcbinnError:
-            log.info("stat %s failed" % (path))
+class Icbinn(IcbinnRemote):
+    """An icbinn server, raising the errors of this module and logging to
+    its log"""
+    connect_error = IcbinnConnectError
+    error = IcbinnError
+    write_error = IcbinnWriteError
+    platform_error = PlatformError
+    target_state_error = TargetStateError
+    log = log
+
+class RateLimiter(ratelimit.RateLimiter):
+    """Bandwidth limits for downloads, raising the errors of this module and
+    logging to its log"""
+    config_error = ConfigError
+    log = log
+
+class DigestAuth(object):
+    """HTTP digest authentication (RFC 2617), remembering the server's last
+    challenge so that later requests can be authenticated without first
+    being refused"""
+    def __init__(self, user, password):
+        self.user = user
+        self.password = password
+        self.challenge = None
+        self.nonce_count = 0
+        self.lock = Lock()
+
+    def update(self, www_authenticate):
+        """Take a new challenge from a WWW-Authenticate header, returning
+        False if it is not a digest challenge we can answer"""
+        scheme, _, params = www_authenticate.partition(' ')
+        if scheme.lower() != 'digest':
             return False
-        log.info("stat %s returned %r" % (path, res))
-        return res[1] in [ICBINN_FILE, ICBINN_DIRECTORY]
-
-    def listdir(self, path):
-        files = []
-        while True:
-            entry = icbinn_readent(self.icbinn, str(path), len(files))
-            if entry is None:
-                break
-            files.append(entry[0])
-        return files
-
-    def mkdir(self, path):
-        if icbinn_mkdir(self.icbinn, str(path)) < 0:
-            raise PlatformError("error creating icbinn directory '%s': "
-                                "icbinn_mkdir failed" % path)
-
-    def makedirs(self, path, timeout=10):
-        # avoid leading and trailing slash confusion
-        segs = [x for x in path.split() if x] 
-        for here in [join(*segs[0:y]) for y in range(1, len(segs) + 1)]:
-            try:
-                self.mkdir(here)
-            except PlatformError:
-                pass
-        if not self.stat(path)[1] == ICBINN_DIRECTORY:
-            raise PlatformError("unable to create %s over icbinn" 
-                                % (here))
-
-    def open(self, path, mode):
-        return IcbinnFile(self.icbinn, path, mode)
-
-    def rename(self, src, dst):
-        if icbinn_rename(self.icbinn, str(src), str(dst)) < 0:
-            raise IcbinnError("error renaming icbinn file '%s' to '%s': "
-                              "icbinn_rename failed" % (src, dst))
-
-    def stat(self, path):
-        try:
-            return icbinn_stat(self.icbinn, str(path))
-        except OSError as exc:
-            raise IcbinnError("error statting icbinn file '%s': icbinn_stat "
-                              "failed: %s" % (path, exc))
-
-    def unlink(self, path):
-        if icbinn_unlink(self.icbinn, str(path)) < 0:
-            raise IcbinnError("error unlinking icbinn file '%s': "
-                              "icbinn_unlink failed" % path)
-    
-    def rand(self, src, size):
-        data = ""
-        while True:
-            log.info("read %d of %d bytes of random data from icbinn",
-                     len(data), size)
-            if len(data) == size:
-                break
-            try:
-                data += icbinn_rand(self.icbinn, src, size - len(data))
-            except IOError as exc:
-                raise IcbinnError("error reading random data from icbinn: "
-                                  "icbinn_rand failed: %s" % exc)
-        return data
-
-    def write_file(self, name, content):
-        file_obj = self.open(name, O_WRONLY | O_CREAT)
-        file_obj.pwrite(content, 0)
-        file_obj.close()
-
-    def mounted_path(self, path):
-        components = path.split('/')
-        if '.' in components or '..' in components:
-            raise TargetStateError('invalid components in %s' % (path))
-        return join(self.mount_point, path)
-
-class IcbinnFile(object):
-    def __init__(self, icbinn, path, mode):
-        self.icbinn = icbinn
-        self.path = path
-
-        self.fd = icbinn_open(self.icbinn, str(self.path), mode)
-        if self.fd < 0:
-            raise IcbinnError("error opening icbinn file '%s': icbinn_open "
-                              "failed" % self.path)
-
-    def close(self):
-        if icbinn_close(self.icbinn, self.fd) < 0:
-            raise IcbinnError("error closing icbinn file '%s': icbinn_close "
-                              "failed" % self.path)
-
-    def get_read_lock(self):
-        if icbinn_lock(self.icbinn, self.fd, ICBINN_LTYPE_RDLCK) < 0:
-            raise IcbinnError("error getting read lock on icbinn file '%s': "
-                              "icbinn_lock failed" % self.path)
-
-    def get_write_lock(self):
-        if icbinn_lock(self.icbinn, self.fd, ICBINN_LTYPE_WRLCK) < 0:
-            raise IcbinnError("error getting write lock on icbinn file '%s': "
-                              "icbinn_lock failed" % self.path)
-
-    def pwrite(self, data, offset):
-        data_len = len(data)
-        written = 0
-        while written < data_len:
-            n = icbinn_pwrite(self.icbinn, self.fd,
-                              data[written:written + ICBINN_MAXDATA],
-                              offset + written)
-            if n < 0:
-                raise IcbinnError("error writing to icbinn file '%s': "
-                                  "icbinn_pwrite failed" % self.path)
-            written += n
-
-    def pread(self, size, offset):
-        try:
-            return icbinn_pread(self.icbinn, self.fd, size, offset)
-        except IOError as exc:
-            raise IcbinnError("error reading icbinn file '%s': icbinn_pwrite "
-                              "failed: %s" % (self.path, exc))
-
-    def unlock(self):
-        if icbinn_lock(self.icbinn, self.fd, ICBINN_LTYPE_UNLCK) < 0:
-            raise IcbinnError("error unlocking icbinn file '%s': icbinn_lock "
-                              "failed" % self.path)
-
-    def __enter__(self):
-        return self
+        challenge = parse_keqv_list(parse_http_list(params))
+        algorithm = challenge.get('algorithm', 'MD5').upper()
+        if ('nonce' not in challenge or
+            algorithm.replace('-SESS', '') not in DIGEST_ALGORITHMS):
+            return False
+        with self.lock:
+            self.challenge = challenge
+            self.nonce_count = 0
+        return True
 
-    def __exit__(self, *_):
-        self.close()
+    def header(self, method, path):
+        """Return an Authorization header value for a request, or None if we
+        have not been challenged yet"""
+        with self.lock:
+            if self.challenge is None:
+                return None
+            challenge = self.challenge
+            self.nonce_count += 1
+            nonce_count = '%08x' % self.nonce_count
+        algorithm = challenge.get('algorithm', 'MD5')
+        digest = DIGEST_ALGORITHMS[algorithm.upper().replace('-SESS', '')]
+        hash_text = lambda text: digest(text.encode('utf-8')).hexdigest()
+        cnonce = uuid4().hex
+        ha1 = hash_text('%s:%s:%s' % (self.user, challenge.get('realm', ''),
+                                      self.password))
+        if algorithm.upper().endswith('-SESS'):
+            ha1 = hash_text('%s:%s:%s' % (ha1, challenge['nonce'], cnonce))
+        ha2 = hash_text('%s:%s' % (method, path))
+        qops = [x.strip() for x in challenge.get('qop', '').split(',')]
+        fields = [('username', self.user), ('realm', challenge.get('realm', '')),
+                  ('nonce', challenge['nonce']), ('uri', path)]
+        if 'auth' in qops:
+            response = hash_text('%s:%s:%s:%s:auth:%s' % (
+                ha1, challenge['nonce'], nonce_count, cnonce, ha2))
+            extra = 'qop=auth, nc=%s, cnonce="%s", ' % (nonce_count, cnonce)
+        else:
+            response = hash_text('%s:%s:%s' % (ha1, challenge['nonce'], ha2))
+            extra = ''
+        fields.append(('response', response))
+        if 'opaque' in challenge:
+            fields.append(('opaque', challenge['opaque']))
+        return 'Digest %s%s, algorithm=%s' % (
+            extra, ', '.join('%s="%s"' % x for x in fields), algorithm)
+
+class ConnectionPool(http_pool.ConnectionPool):
+    """Persistent connections to a server, logging to the log of this
+    module"""
+    log = log
 
 class HTTPServer(object):
-    """Encapsulate downloads from an HTTP server, using curl"""
+    """Encapsulate requests to an HTTP server, over a pool of persistent
+    connections"""
     def __init__(self, base_url, user=None, password=None, cacert=None):
         if not base_url.endswith('/'):
             base_url += '/'
@@ -345,154 +352,1199 @@ class HTTPServer(object):
         self.user = user
         self.password = password
         self.cacert = cacert
-        self.env = environ.copy()
-        try:
-            del self.env['INET_IS_ARGO']
-        except KeyError:
-            pass
+        url = urlsplit(base_url)
+        self.path = url.path
+        self.pool = ConnectionPool(
+            url.scheme, url.hostname, url.port,
+            create_default_context(cafile=cacert)
+            if url.scheme == 'https' else None)
+        self.auth = DigestAuth(user, password) if user is not None else None
+
+    def close(self):
+        """Close idle connections to the server"""
+        self.pool.close()
+
+    def request(self, method, document, timeout, headers=None, body=None):
+        """Send a request for document, answering a digest challenge if we
+        get one, and return the connection and the response with its body
+        unread.
+
+        A request which fails on a kept-alive connection is retried on
+        another connection, in case the server had closed it."""
+        url = self.base_url + document
+        path = self.path + document
+        challenged = False
+        while True:
+            request_headers = dict(headers or {})
+            authorization = self.auth and self.auth.header(
+                method, self.pool.origin + path)
+            if authorization:
+                request_headers['Authorization'] = authorization
+            try:
+                conn, response = self.pool.request(
+                    method, path, body, request_headers, timeout)
+            except (HTTPException, OSError) as exc:
+                raise HTTPError('%s request for %s failed: %s' % (
+                        method, url, exc))
+            if (response.status == 401 and self.auth and not challenged and
+                self.auth.update(response.getheader('WWW-Authenticate', ''))):
+                log.info('%s request for %s: answering digest challenge',
+                         method, url)
+                challenged = True
+                self.read_body(url, conn, response)
+                continue
+            return conn, response
 
-    def write_auth_file(self, stream):
-        """Write curl auth config to stream"""
-        stream.write('--digest\n')
-        stream.write('--cacert %s\n' % self.cacert)
-        stream.write('--user %s:%s\n' % (self.user, self.password))
-        stream.flush()
+    def read_body(self, url, conn, response):
+        """Return the rest of the body of response and release conn"""
+        try:
+            data = response.read()
+        except (HTTPException, OSError) as exc:
+            conn.close()
+            raise HTTPError('reading response for %s failed: %s' % (url, exc))
+        self.pool.put(conn, response)
+        return data
 
     def operation(self, method, document, timeout=5, **kex):
-        """Access document using curl"""
+        """Access document"""
         url = self.base_url + document
-        log.info('%s %s' % (method.upper(), url))
-        with NamedTemporaryFile(suffix='.cred', mode="w+") as cf:
-            self.write_auth_file(cf)
-            with NamedTemporaryFile(suffix='.'+method+'.out', mode="w+") as tf:
-                args = ['curl', '--silent', '--max-time', str(timeout), 
-                        '-K', cf.name, url]
-                if method.upper() == 'PUT':
-                    tf2 = file(tf.name, 'w')
-                    tf2.write(kex.get('data', ''))
-                    tf2.close()
-                    args += ['--upload-file', tf.name]
-                elif method.upper() == 'GET':
-                    args += ['--out', tf.name]
-                    args += ['--write-out', '%{http_code}']
-                curl = Popen(args, stdout=PIPE, stderr=PIPE, close_fds=True,
-                             env=self.env, text=True)
-                out, err = curl.communicate()
-                for line in out.split('\n'):
-                    if line != '{}':
-                        log.info('curl stdout %s' % line)
-                for line in err.split('\n'):
-                    if line:
-                        log.info('curl stderr %s' % line)
-
-                if method.upper() == 'GET':
-                    # parse HTTP response code and raise an error if in 400s
-                    if out.startswith('4'):
-                        raise HTTPError('%s request for %s: HTTP response code %s' % (method.upper(), url, out))
-
-                if curl.returncode != 0:
-                    raise HTTPError('%s request for %s failed: curl exit code '
-                                    '%d\n%s' % (method.upper(), url,
-                                                curl.returncode, err))
-                if method.upper() == 'GET':
-                    ofile = file(tf.name, 'rb')
-                    outb = ofile.read()
-                    ofile.close()
-                else:
-                    # TODO: do we want to record output for PUT operations?
-                    # is that even meaningful?
-                    outb = None
+        method = method.upper()
+        log.info('%s %s' % (method, url))
+        if method == 'PUT':
+            body = kex.get('data', '')
+            if not isinstance(body, bytes):
+                body = body.encode('utf-8')
+        else:
+            body = None
+        conn, response = self.request(method, document, timeout, body=body)
+        outb = self.read_body(url, conn, response)
+        log.info('%s %s: HTTP response code %d', method, url, response.status)
+
+        if method == 'GET':
+            # raise an error if the HTTP response code is in the 400s
+            if 400 <= response.status < 500:
+                raise HTTPError('%s request for %s: HTTP response code %d' % (
+                        method, url, response.status))
+        else:
+            # TODO: do we want to record output for PUT operations?
+            # is that even meaningful?
+            outb = None
         return outb
 
     def download(self, document, destination, size, desc, icbinn, timeout=3600,
-                 progress_callback=None):
-        """Download document to destination using curl.
-
-        Destination is an icbinn path"""
+                 progress_callback=None, segments=DEFAULT_DOWNLOAD_SEGMENTS,
+                 connection_slots=None, checksum=None, delta=False,
+                 rate_limiter=None, compression=None, write_window=1):
+        """Download document to destination.
+
+        Destination is an icbinn path. The part of the document we do not
+        have yet is split into up to segments byte ranges which are fetched
+        concurrently, each written to its own offsets in the .partial file.
+        The .partial file is only renamed once every range is complete.
+
+        If connection_slots is set, it is a semaphore shared between
+        downloads which each range holds while it is being fetched.
+
+        If checksum is set, it is the hexadecimal SHA-256 digest of the
+        document, which is computed as the data arrives and checked before
+        the .partial file is renamed.
+
+        If the server has a manifest for the document, data already in the
+        .partial file is checked against it. If delta is set, chunks listed
+        in the manifest are copied from other files in the destination
+        directory which have a saved manifest listing the same chunk, rather
+        than fetched, and the manifest is saved next to destination.
+
+        If rate_limiter is set, it is a RateLimiter shared between downloads
+        which paces the data fetched.
+
+        If compression is set, the document is fetched compressed instead;
+        see download_compressed.
+
+        Writes to the .partial file keep up to write_window icbinn_pwrite
+        calls outstanding at once."""
+
+        if compression:
+            return self.download_compressed(
+                document, destination, size, icbinn, compression, timeout,
+                progress_callback, connection_slots, checksum, rate_limiter,
+                write_window)
+        url = self.base_url + document
+        log.info('downloading URL %s timeout %d segments %d', url, timeout,
+                 segments)
+        icbinn.makedirs(dirname(destination))
+        partial_download = PartialDownload(icbinn, destination, size,
+                                           checksum, write_window)
+        manifest = None
+        if delta or partial_download.done_bytes():
+            manifest = self.fetch_manifest(document, size)
+        if manifest:
+            partial_download.apply_manifest(
+                manifest, index_local_chunks(icbinn, dirname(destination),
+                                             destination) if delta else None,
+                progress_callback)
+        partial_download.split(segments)
+        if progress_callback:
+            progress_callback(partial_download.done_bytes())
+        pending = partial_download.pending()
+        if pending:
+            self.fetch_segments(document, partial_download, pending,
+                                min(segments, len(pending)), time() + timeout,
+                                progress_callback, connection_slots,
+                                rate_limiter.transfer() if rate_limiter
+                                else None)
+        partial_download.extend()
+        partial_download.verify()
+        if progress_callback:
+            progress_callback(size)
+        partial_download.finish()
+        if delta and manifest:
+            icbinn.write_file(destination + MANIFEST_SUFFIX,
+                              dumps(manifest.record).encode('ascii'))
+        log.info('downloaded %s', destination)
 
+    def download_compressed(self, document, destination, size, icbinn,
+                            compression, timeout=3600, progress_callback=None,
+                            connection_slots=None, checksum=None,
+                            rate_limiter=None, write_window=1):
+        """Download document compressed with compression (gzip or zstd)
+        from document plus the matching suffix, decompressing it into
+        destination as it arrives.
+
+        The compressed stream is fetched over one connection, and is
+        decompressed and written on another thread. An interrupted download
+        carries on from the end of the last gzip member or zstd frame that
+        was written, so streams made of many members or frames resume
+        well."""
+        if compression not in COMPRESSION_SUFFIXES:
+            raise TargetStateError('unsupported compression %r for %s' % (
+                    compression, document))
+        if compression == COMPRESSION_ZSTD and ZstdDecompressor is None:
+            raise PlatformError('zstd compression for %s needs the python '
+                                'zstandard module' % document)
+        document += COMPRESSION_SUFFIXES[compression]
         url = self.base_url + document
-        log.info('downloading URL %s timeout %d', url, timeout)
-        partial_destination = destination + '.partial'
         icbinn.makedirs(dirname(destination))
-        try:
-            partial_size = icbinn.stat(partial_destination)[0]
-        except IcbinnError:
-            partial_size = 0
+        partial_download = CompressedPartialDownload(icbinn, destination, size,
+                                                     compression, checksum,
+                                                     write_window)
+        compressed = partial_download.compressed
+        log.info('downloading URL %s timeout %d from compressed offset %d',
+                 url, timeout, compressed)
         if progress_callback:
-            progress_callback(partial_size)
-        if partial_size < size:
-            with NamedTemporaryFile(suffix='.cred') as cf:
-                self.write_auth_file(cf)
-                curl = Popen(['curl', '--silent', '--fail',
-                              '--max-time', str(timeout), 
-                              '-K', cf.name,
-                              '--range', str(partial_size) + '-', url],
-                             stdout=PIPE, close_fds=True, env=self.env)
-                with icbinn.open(partial_destination,
-                                 O_WRONLY | O_CREAT) as icbinn_file:
-                    while True:
-                        data = curl.stdout.read(DOWNLOAD_BLOCK_SIZE)
-                        if data == '':
+            progress_callback(partial_download.done_bytes())
+        if partial_download.done_bytes() < size:
+            deadline = time() + timeout
+            throttle = rate_limiter.transfer() if rate_limiter else None
+            with connection_slots or nullcontext():
+                conn, response = self.request(
+                    'GET', document, timeout, headers={
+                        'Range': 'bytes=%d-' % compressed} if compressed
+                    else None)
+                blocks = Queue(DECOMPRESS_QUEUE_BLOCKS)
+                pool = BufferPool(DECOMPRESS_QUEUE_BLOCKS + 2,
+                                  DOWNLOAD_BLOCK_SIZE)
+                errors = []
+                thread = Thread(target=self.decompress,
+                                args=(partial_download, blocks, pool, errors))
+                thread.daemon = True
+                thread.start()
+                try:
+                    if response.status >= 400:
+                        raise HTTPError('failed to download %s: HTTP response '
+                                        'code %d' % (url, response.status))
+                    if response.status != 206 and compressed:
+                        raise HTTPError('failed to download %s: server '
+                                        'ignored request for bytes %d-' % (
+                                url, compressed))
+                    reported = time()
+                    while not errors:
+                        if time() > deadline:
+                            raise HTTPError('failed to download %s: timed out '
+                                            'at compressed offset %d' % (
+                                    url, compressed))
+                        buf = pool.get()
+                        length = response.readinto(buf)
+                        if not length:
+                            pool.put(buf)
                             break
-                        icbinn_file.pwrite(data, partial_size)
-                        partial_size += len(data)
-                        if progress_callback: 
-                            progress_callback(partial_size)
-                if curl.wait() != 0:
-                    raise HTTPError('failed to download %s to %s: curl exit '
-                                    'code %d' % (url, partial_size,
-                                                 curl.returncode))
+                        blocks.put((buf, length))
+                        compressed += length
+                        if throttle:
+                            throttle(length)
+                        if progress_callback and (time() > reported +
+                                                  PROGRESS_INTERVAL):
+                            progress_callback(partial_download.done_bytes())
+                            reported = time()
+                except (HTTPException, OSError) as exc:
+                    conn.close()
+                    errors.append(HTTPError(
+                            'failed to download %s at compressed offset %d: '
+                            '%s' % (url, compressed, exc)))
+                except Exception as exc:
+                    conn.close()
+                    errors.append(exc)
+                finally:
+                    blocks.put(None)
+                    thread.join()
+                    partial_download.save()
+                if errors:
+                    raise errors[0]
+                self.pool.put(conn, response)
+        partial_download.extend()
+        partial_download.verify()
         if progress_callback:
             progress_callback(size)
-        icbinn.rename(partial_destination, destination)
+        partial_download.finish()
         log.info('downloaded %s', destination)
 
+    def decompress(self, partial_download, blocks, pool, errors):
+        """Decompress (buffer, length) blocks from the blocks queue, until
+        None, into partial_download, returning the buffers to pool and
+        checkpointing at the end of each gzip member or zstd frame. Blocks
+        queued before a failure to fetch the rest are still written, so that
+        a resumed download need not fetch them again."""
+        item = ()
+        try:
+            decompressor = partial_download.decompressor()
+            splitter = (ZstdSplitter() if partial_download.compression ==
+                        COMPRESSION_ZSTD else None)
+            member_start = partial_download.compressed
+            fed = 0
+            with partial_download.open() as icbinn_file:
+                while True:
+                    item = blocks.get()
+                    if item is None:
+                        break
+                    buf, length = item
+                    pieces = [memoryview(buf)[:length]]
+                    if splitter:
+                        pieces = splitter.split(pieces[0])
+                    for data in pieces:
+                        fed += len(data)
+                        more = True
+                        while more:
+                            # gzip output is limited to a block at a time,
+                            # with the input left over kept in
+                            # unconsumed_tail; zstd output is limited by
+                            # the splitter
+                            if (partial_download.compression ==
+                                COMPRESSION_GZIP):
+                                out = decompressor.decompress(
+                                    data, DOWNLOAD_BLOCK_SIZE)
+                                data = decompressor.unconsumed_tail
+                                more = (data or
+                                        len(out) == DOWNLOAD_BLOCK_SIZE)
+                            else:
+                                out = decompressor.decompress(data)
+                                data = b''
+                                more = False
+                            partial_download.write_next(icbinn_file, out)
+                            if decompressor.eof:
+                                data = decompressor.unused_data
+                                member_start += fed - len(data)
+                                partial_download.checkpoint(member_start)
+                                decompressor = partial_download.decompressor()
+                                fed = len(data)
+                                more = bool(data)
+                    pool.put(buf)
+            if not errors and (fed or partial_download.done_bytes() !=
+                               partial_download.size):
+                raise HTTPError('%s is incomplete: compressed stream ends at '
+                                'offset %d with %d bytes unused, after %d of '
+                                '%d bytes' % (
+                        partial_download.partial, member_start + fed, fed,
+                        partial_download.done_bytes(), partial_download.size))
+        except Exception as exc:
+            errors.append(exc)
+        while item is not None:
+            if item:
+                pool.put(item[0])
+            item = blocks.get()
+
+    def fetch_manifest(self, document, size):
+        """Return the Manifest served next to document, or None if there is
+        no valid one"""
+        try:
+            content = self.operation('get', document + MANIFEST_SUFFIX,
+                                     timeout=MANIFEST_TIMEOUT)
+        except HTTPError as exc:
+            log.info('no manifest for %s: %s', document, exc)
+            return None
+        try:
+            return Manifest(loads(content), size)
+        except (ValueError, KeyError, TypeError) as exc:
+            log.warning('ignoring invalid manifest for %s: %s', document, exc)
+            return None
+
+    def fetch_segments(self, document, partial_download, pending, workers,
+                       deadline, progress_callback, connection_slots=None,
+                       throttle=None):
+        """Fetch the pending segments of document using workers concurrent
+        connections, reporting progress from this thread. throttle, if set,
+        is called with the size of each block fetched.
+
+        Blocks are received into buffers from a BufferPool, and passed
+        through a queue of up to WRITE_QUEUE_BLOCKS to a thread which writes
+        them to icbinn, so that receiving from the network and writing to
+        icbinn overlap.
+
+        Once a segment fails, the others are cancelled: their connections
+        are shut down, and those waiting for a connection slot give up."""
+        work = Queue()
+        for segment in pending:
+            work.put(segment)
+        errors = []
+        transfers = Transfers()
+        blocks = Queue(WRITE_QUEUE_BLOCKS)
+        pool = BufferPool(WRITE_QUEUE_BLOCKS + max(workers, 1) + 1,
+                          DOWNLOAD_BLOCK_SIZE)
+        stats = PipelineStats()
+        writer = Thread(target=self.write_blocks,
+                        args=(partial_download, blocks, pool, errors, stats))
+        writer.daemon = True
+        writer.start()
+
+        def worker():
+            while not errors:
+                try:
+                    segment = work.get_nowait()
+                except Empty:
+                    return
+                while connection_slots and not connection_slots.acquire(
+                    timeout=PROGRESS_INTERVAL):
+                    if errors:
+                        return
+                try:
+                    if not errors:
+                        self.fetch_segment(document, partial_download,
+                                           segment, deadline, errors, blocks,
+                                           pool, stats, throttle, transfers)
+                except Exception as exc:
+                    errors.append(exc)
+                    transfers.cancel()
+                finally:
+                    if connection_slots:
+                        connection_slots.release()
+
+        threads = [Thread(target=worker) for _ in range(max(workers, 1))]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        try:
+            for thread in threads:
+                while thread.is_alive():
+                    if errors:
+                        # the writer failed
+                        transfers.cancel()
+                    # hash anything the workers could not hash in order while
+                    # we wait for them
+                    if not partial_download.catch_up(HASH_CATCH_UP_BYTES):
+                        thread.join(PROGRESS_INTERVAL)
+                    if progress_callback:
+                        progress_callback(partial_download.done_bytes())
+        finally:
+            blocks.put(None)
+            writer.join()
+            partial_download.save()
+        stats.log(document)
+        if errors:
+            raise errors[0]
+
+    def write_blocks(self, partial_download, blocks, pool, errors, stats):
+        """Write (segment, buffer, length) blocks from the blocks queue,
+        until None, into partial_download, returning the buffers to pool"""
+        item = ()
+        try:
+            with partial_download.open() as icbinn_file:
+                while True:
+                    started = monotonic()
+                    item = blocks.get()
+                    stats.add('write_wait', monotonic() - started)
+                    if item is None:
+                        break
+                    segment, buf, length = item
+                    partial_download.write(icbinn_file, segment,
+                                           memoryview(buf)[:length])
+                    pool.put(buf)
+                    stats.add('written', length)
+        except Exception as exc:
+            errors.append(exc)
+        while item is not None:
+            if item:
+                pool.put(item[1])
+            item = blocks.get()
+
+    def fetch_segment(self, document, partial_download, segment, deadline,
+                      errors, blocks, pool, stats, throttle=None,
+                      transfers=None):
+        """Fetch one [start, end, done] segment of document, queueing its
+        blocks on blocks to be written to partial_download, and giving up
+        early if another segment has failed. The connection is added to
+        transfers, if set, while the body is read."""
+        url = self.base_url + document
+        start, end, done = partial_download.get(segment)
+        log.info('fetching bytes %d-%d of %s', done, end - 1, url)
+        conn, response = self.request(
+            'GET', document, max(deadline - time(), 1),
+            headers={'Range': 'bytes=%d-%d' % (done, end - 1)})
+        if transfers:
+            transfers.add(conn)
+        try:
+            if response.status >= 400:
+                raise HTTPError('failed to download %s: HTTP response code '
+                                '%d' % (url, response.status))
+            if response.status != 206 and done != 0:
+                raise HTTPError('failed to download %s: server ignored '
+                                'request for bytes %d-%d' % (url, done,
+                                                             end - 1))
+            while done < end and not errors:
+                if time() > deadline:
+                    raise HTTPError('failed to download %s: timed out at '
+                                    'offset %d' % (url, done))
+                started = monotonic()
+                buf = pool.get()
+                stats.add('read_wait', monotonic() - started)
+                try:
+                    length = response.readinto(memoryview(buf)[:min(
+                                DOWNLOAD_BLOCK_SIZE, end - done)])
+                except:
+                    pool.put(buf)
+                    raise
+                if not length:
+                    pool.put(buf)
+                    raise HTTPError('failed to download %s to %s: '
+                                    'connection closed at offset %d' % (
+                            url, partial_download.partial, done))
+                blocks.put((segment, buf, length))
+                done += length
+                if throttle:
+                    throttle(length)
+        except (HTTPException, OSError) as exc:
+            conn.close()
+            raise HTTPError('failed to download %s to %s at offset %d: %s' % (
+                    url, partial_download.partial, done, exc))
+        except:
+            conn.close()
+            raise
+        finally:
+            if transfers:
+                transfers.remove(conn)
+        self.pool.put(conn, response)
+
+class Transfers(object):
+    """The connections the segments of a download are being received on,
+    which cancel() shuts down so that segments blocked reading them fail at
+    once. Connections added after cancel() are shut down straight away."""
+    def __init__(self):
+        self.lock = Lock()
+        self.conns = set()
+        self.cancelled = False
+
+    def add(self, conn):
+        with self.lock:
+            self.conns.add(conn)
+            if self.cancelled:
+                self.shutdown(conn)
+
+    def remove(self, conn):
+        with self.lock:
+            self.conns.discard(conn)
+
+    def cancel(self):
+        with self.lock:
+            if not self.cancelled:
+                self.cancelled = True
+                for conn in self.conns:
+                    self.shutdown(conn)
+
+    def shutdown(self, conn):
+        # the reading thread closes the connection when its read fails
+        try:
+            if conn.sock is not None:
+                conn.sock.shutdown(SHUT_RDWR)
+        except OSError:
+            pass
+
+class BufferPool(object):
+    """A fixed set of reusable buffers of size bytes, which downloads
+    receive into, so that their memory use is bounded whatever their size
+    and blocks are not allocated and copied as they pass through"""
+    def __init__(self, count, size):
+        self.idle = Queue()
+        for _ in range(count):
+            self.idle.put(bytearray(size))
+
+    def get(self):
+        """Return an unused buffer, waiting for one if need be"""
+        return self.idle.get()
+
+    def put(self, buf):
+        """Return buf to the pool"""
+        self.idle.put(buf)
+
+class PipelineStats(object):
+    """Counters for a download pipeline: bytes written, time the network
+    side waited for the queue of blocks to drain, and time the writer
+    waited for blocks to arrive"""
+    def __init__(self):
+        self.lock = Lock()
+        self.started = monotonic()
+        self.counts = {'written': 0, 'read_wait': 0, 'write_wait': 0}
+
+    def add(self, key, value):
+        with self.lock:
+            self.counts[key] += value
+
+    def log(self, document):
+        elapsed = max(monotonic() - self.started, 0.001)
+        log.info('wrote %d bytes of %s in %.1fs (%.1f MiB/s); network waited '
+                 '%.1fs for icbinn writes, which waited %.1fs for network',
+                 self.counts['written'], document, elapsed,
+                 self.counts['written'] / elapsed / (1024 * 1024),
+                 self.counts['read_wait'], self.counts['write_wait'])
+
+class Manifest(object):
+    """SHA-256 digests of consecutive chunks of a document, as served in
+    <document>.manifest in the form
+
+      {"block_size": <bytes>, "blocks": [<hexadecimal digest>, ...]}
+
+    for fixed-size blocks, or
+
+      {"chunks": [[<offset>, <length>, <hexadecimal digest>], ...]}
+
+    for chunks of any size, such as content-defined chunks which line up
+    between versions of a disk image.
+
+    chunks is a list of (offset, length, digest) covering the document."""
+    def __init__(self, record, size):
+        self.record = record
+        if 'chunks' in record:
+            self.chunks = [(int(offset), int(length), str(digest).lower())
+                           for offset, length, digest in record['chunks']]
+            end = 0
+            for offset, length, _ in self.chunks:
+                if offset != end or length <= 0:
+                    raise ValueError('chunk at %d is not contiguous' % offset)
+                end += length
+            if end != size:
+                raise ValueError('chunks cover %d of %d bytes' % (end, size))
+            return
+        block_size = int(record['block_size'])
+        if block_size <= 0:
+            raise ValueError('block size %d is not valid' % block_size)
+        offsets = range(0, size, block_size)
+        if len(record['blocks']) != len(offsets):
+            raise ValueError('%d blocks of %d bytes do not cover %d bytes' % (
+                    len(record['blocks']), block_size, size))
+        self.chunks = [(offset, min(block_size, size - offset),
+                        str(digest).lower())
+                       for offset, digest in zip(offsets, record['blocks'])]
+
+def index_local_chunks(icbinn, directory, exclude=None):
+    """Return a dict mapping the digests of chunks of the files in directory
+    which have a saved manifest, other than exclude, to their path and
+    offset"""
+    index = {}
+    for name in icbinn.listdir(directory):
+        path = join(directory, name[:-len(MANIFEST_SUFFIX)])
+        if not name.endswith(MANIFEST_SUFFIX) or path == exclude:
+            continue
+        try:
+            manifest = Manifest(loads(icbinn.read_file(join(directory, name))),
+                                icbinn.stat(path)[0])
+        except (IcbinnError, ValueError, KeyError, TypeError) as exc:
+            log.info('not using %s for delta updates: %s', path, exc)
+            continue
+        for offset, _, digest in manifest.chunks:
+            index.setdefault(digest, (path, offset))
+    log.info('found %d distinct chunks in %s', len(index), directory)
+    return index
+
+def read_range(icbinn_file, offset, length):
+    """Read length bytes from offset of icbinn_file. Anything past the end
+    of the file reads as zeros, as all-zero blocks at the end of a .partial
+    file are not written until it is complete.
+
+    The data is read into a buffer of length bytes, which is returned."""
+    data = bytearray(length)
+    done = 0
+    while done < length:
+        more = icbinn_file.pread(min(length - done, ICBINN_MAXDATA),
+                                 offset + done)
+        if not more:
+            break
+        data[done:done + len(more)] = more
+        done += len(more)
+    return data
+
+class DownloadHasher(object):
+    """SHA-256 of a download, computed in file order.
+
+    Data passed to feed() at the offset the hash has reached is hashed
+    there and then, by the thread writing it to icbinn rather than those
+    receiving it, before its buffer is reused. Data that arrives out of
+    order is dropped and later read back from the file by catch_up()."""
+    def __init__(self):
+        self.sha = sha256()
+        self.offset = 0
+        self.lock = Lock()
+
+    def feed(self, offset, data):
+        """Hash data if it is at the offset the hash has reached"""
+        with self.lock:
+            if offset == self.offset:
+                self.sha.update(data)
+                self.offset += len(data)
+
+    def catch_up(self, icbinn_file, end, limit):
+        """Hash up to limit bytes of icbinn_file between the offset the hash
+        has reached and end, returning the number hashed"""
+        hashed = 0
+        with self.lock:
+            while self.offset < end and hashed < limit:
+                data = read_range(icbinn_file, self.offset,
+                                  min(end - self.offset, ICBINN_MAXDATA))
+                self.sha.update(data)
+                self.offset += len(data)
+                hashed += len(data)
+        return hashed
+
+    def hexdigest(self):
+        with self.lock:
+            return self.sha.hexdigest()
+
+class PartialDownload(object):
+    """Resumable state of a download into a .partial file.
+
+    Progress is kept as a list of [start, end, done] byte ranges covering
+    the whole document, where bytes start to done of each range have been
+    written. It is recorded in a .partial.segments file next to the
+    .partial file so that an interrupted download can carry on from where
+    each range got to."""
+    def __init__(self, icbinn, destination, size, checksum=None, write_window=1):
+        self.icbinn = icbinn
+        self.write_window = write_window
+        self.destination = destination
+        self.partial = destination + '.partial'
+        self.state_path = destination + SEGMENTS_SUFFIX
+        self.size = size
+        self.checksum = checksum
+        self.hasher = DownloadHasher() if checksum else None
+        self.lock = Lock()
+        self.unsaved = 0
+        self.segments = self.load()
+        # all-zero blocks are not written beyond the end of the .partial
+        # file as it was when we started, where it reads as zeros anyway
+        try:
+            self.holes_from = self.icbinn.stat(self.partial)[0]
+        except IcbinnError:
+            self.holes_from = 0
+
+    def load(self):
+        """Return the recorded segments, or work them out for a .partial
+        file written by a single stream"""
+        try:
+            segments = self.parse(self.icbinn.read_file(self.state_path))
+        except IcbinnError:
+            segments = None
+        if segments is not None:
+            log.info('resuming %s from recorded segments %r', self.partial,
+                     segments)
+            return segments
+        if self.icbinn.exists(self.state_path):
+            log.warning('discarding %s with invalid segment record',
+                        self.partial)
+            for path in [self.partial, self.state_path]:
+                try:
+                    self.icbinn.unlink(path)
+                except IcbinnError:
+                    pass
+            return [[0, self.size, 0]]
+        try:
+            partial_size = self.icbinn.stat(self.partial)[0]
+        except IcbinnError:
+            partial_size = 0
+        return [[0, self.size, min(partial_size, self.size)]]
+
+    def parse(self, content):
+        """Return the segments in content, or None if content is not a valid
+        record for a download of this size"""
+        try:
+            lines = content.decode('ascii').split('\n')
+            header = lines[0].split()
+            if len(header) != 2 or header[0] != 'segments':
+                return None
+            segments = [[int(x) for x in line.split()]
+                        for line in lines[1:int(header[1]) + 1]]
+        except (UnicodeDecodeError, ValueError):
+            return None
+        expected_start = 0
+        for segment in segments:
+            if (len(segment) != 3 or segment[0] != expected_start or
+                not segment[0] <= segment[2] <= segment[1]):
+                return None
+            expected_start = segment[1]
+        if expected_start != self.size or not segments:
+            return None
+        return segments
+
+    def apply_manifest(self, manifest, local_chunks=None,
+                       progress_callback=None):
+        """Check what has been written of the .partial file against the
+        digests in manifest, and arrange to fetch again any chunk which does
+        not match or was only partly written.
+
+        local_chunks maps digests to the path and offset of the same chunk
+        in files we already have; chunks not yet written are copied from
+        there rather than fetched, if they still match."""
+        written = []
+        with self.lock:
+            for start, end, done in self.segments:
+                if written and written[-1][1] == start:
+                    written[-1][1] = done
+                elif done > start:
+                    written.append([start, done])
+        segments = []
+        bad = copied = 0
+        reported = time()
+        with ExitStack() as stack:
+            files = {}
+            writer = None
+
+            def read_chunk(path, offset, length):
+                if path not in files:
+                    files[path] = stack.enter_context(
+                        self.icbinn.open(path, O_RDONLY))
+                return read_range(files[path], offset, length)
+
+            for offset, length, digest in manifest.chunks:
+                end = offset + length
+                good = False
+                if [x for x in written if x[0] <= offset and end <= x[1]]:
+                    data = read_chunk(self.partial, offset, length)
+                    good = sha256(data).hexdigest() == digest
+                    if not good:
+                        log.warning('%s bytes %d-%d do not match manifest',
+                                    self.partial, offset, end - 1)
+                        bad += 1
+                elif digest in (local_chunks or {}):
+                    data = read_chunk(*local_chunks[digest], length=length)
+                    good = sha256(data).hexdigest() == digest
+                    if good:
+                        if writer is None:
+                            writer = stack.enter_context(self.open())
+                        writer.pwrite(data, offset, self.holes_from)
+                        copied += length
+                if good and self.hasher:
+                    self.hasher.feed(offset, data)
+                if segments and (segments[-1][2] == segments[-1][1]) == good:
+                    segments[-1][1] = end
+                    if good:
+                        segments[-1][2] = end
+                else:
+                    segments.append([offset, end, end if good else offset])
+                if progress_callback and time() > reported + PROGRESS_INTERVAL:
+                    progress_callback(sum(x[2] - x[0] for x in segments))
+                    reported = time()
+        with self.lock:
+            self.segments = segments or [[0, self.size, self.size]]
+            self.save_locked()
+        log.info('checked %s against manifest: %d bad chunks; copied %d bytes '
+                 'from local files; %d of %d bytes to fetch', self.partial,
+                 bad, copied, self.size - self.done_bytes(), self.size)
+
+    def split(self, count):
+        """Split outstanding ranges until there are count of them, or they
+        get too small to be worth splitting"""
+        with self.lock:
+            while len(self.pending()) < count:
+                segment = max(self.pending() or [[0, 0, 0]],
+                              key=lambda x: x[1] - x[2])
+                if segment[1] - segment[2] < 2 * MIN_SEGMENT_SIZE:
+                    break
+                middle = segment[2] + (segment[1] - segment[2]) // 2
+                index = self.segments.index(segment)
+                self.segments[index:index + 1] = [
+                    [segment[0], middle, segment[2]],
+                    [middle, segment[1], middle]]
+
+    def pending(self):
+        """Return the segments which are not complete"""
+        return [x for x in self.segments if x[2] < x[1]]
+
+    def get(self, segment):
+        """Return a copy of segment"""
+        with self.lock:
+            return list(segment)
+
+    def done_bytes(self):
+        """Return the number of bytes written so far"""
+        with self.lock:
+            return sum(x[2] - x[0] for x in self.segments)
+
+    def open(self):
+        """Open the .partial file for writing"""
+        return self.icbinn.open(self.partial, O_WRONLY | O_CREAT,
+                                self.write_window)
+
+    def write(self, icbinn_file, segment, data):
+        """Write data at the end of what has been done of segment"""
+        offset = segment[2]
+        if self.hasher:
+            self.hasher.feed(offset, data)
+        icbinn_file.pwrite(data, offset, self.holes_from)
+        self.advance(segment, len(data))
+
+    def written_prefix(self):
+        """Return the length of the start of the file which is complete"""
+        with self.lock:
+            for segment in self.segments:
+                if segment[2] < segment[1]:
+                    return segment[2]
+            return self.size
+
+    def catch_up(self, limit):
+        """Hash up to limit bytes of the written prefix of the file which
+        were not hashed as they arrived, returning the number hashed"""
+        end = self.written_prefix()
+        if not self.hasher or self.hasher.offset >= end:
+            return 0
+        with self.icbinn.open(self.partial, O_RDONLY) as reader:
+            return self.hasher.catch_up(reader, end, limit)
+
+    def extend(self):
+        """Make the complete .partial file full size, in case all-zero blocks
+        at its end were not written"""
+        try:
+            partial_size = self.icbinn.stat(self.partial)[0]
+        except IcbinnError:
+            partial_size = 0
+        if partial_size < self.size:
+            with self.open() as icbinn_file:
+                icbinn_file.pwrite(b'\0', self.size - 1)
+
+    def verify(self):
+        """Check the complete .partial file against checksum, discarding it
+        if it does not match"""
+        if not self.hasher:
+            return
+        while self.catch_up(self.size):
+            pass
+        digest = self.hasher.hexdigest()
+        if digest != self.checksum.lower():
+            log.warning('discarding %s: SHA-256 %s does not match %s',
+                        self.partial, digest, self.checksum)
+            for path in [self.state_path, self.partial]:
+                try:
+                    self.icbinn.unlink(path)
+                except IcbinnError:
+                    pass
+            raise ChecksumMismatch('%s has SHA-256 %s, expected %s' % (
+                    self.destination, digest, self.checksum))
+        log.info('%s has expected SHA-256 %s', self.partial, digest)
+
+    def advance(self, segment, nbytes):
+        """Record that nbytes more of segment have been written, saving the
+        record every SEGMENT_CHECKPOINT_BYTES"""
+        with self.lock:
+            segment[2] += nbytes
+            self.unsaved += nbytes
+            if self.unsaved >= SEGMENT_CHECKPOINT_BYTES:
+                self.save_locked()
+
+    def save(self):
+        """Record the current segments"""
+        with self.lock:
+            self.save_locked()
+
+    def save_locked(self):
+        content = 'segments %d\n' % len(self.segments) + ''.join(
+            '%d %d %d\n' % tuple(x) for x in self.segments)
+        self.icbinn.write_file(self.state_path + '.new',
+                               content.encode('ascii'))
+        self.icbinn.rename(self.state_path + '.new', self.state_path)
+        self.unsaved = 0
+
+    def finish(self):
+        """Move the complete .partial file into place"""
+        if not self.icbinn.exists(self.partial):
+            self.icbinn.write_file(self.partial, b'')
+        try:
+            self.icbinn.unlink(self.state_path)
+        except IcbinnError:
+            pass
+        self.icbinn.rename(self.partial, self.destination)
+
+class CompressedPartialDownload(PartialDownload):
+    """Resumable state of a download of a compressed document into a
+    .partial file.
+
+    The .partial file is written in order, as a single segment. The record
+    kept next to it is the offset of the end of the last complete gzip
+    member or zstd frame in the compressed stream, and how much output it
+    decompresses to, which is where an interrupted download resumes."""
+    def __init__(self, icbinn, destination, size, compression, checksum=None,
+                 write_window=1):
+        self.compression = compression
+        self.compressed = 0
+        self.resume = (0, 0)
+        PartialDownload.__init__(self, icbinn, destination, size, checksum,
+                                 write_window)
+
+    def load(self):
+        """Return the segment to resume from, discarding any .partial file
+        which cannot be resumed"""
+        try:
+            self.resume = self.parse(self.icbinn.read_file(self.state_path))
+        except IcbinnError:
+            self.resume = None
+        if self.resume is not None:
+            log.info('resuming %s from compressed offset %d, offset %d',
+                     self.partial, *self.resume)
+            self.compressed = self.resume[0]
+            return [[0, self.size, self.resume[1]]]
+        for path in [self.partial, self.state_path]:
+            if self.icbinn.exists(path):
+                log.warning('discarding %s, which cannot be resumed', path)
+                self.icbinn.unlink(path)
+        self.resume = (0, 0)
+        return [[0, self.size, 0]]
+
+    def parse(self, content):
+        """Return the compressed and decompressed offsets in content, or
+        None if content is not a valid record for this download"""
+        try:
+            fields = content.decode('ascii').split()
+            if len(fields) != 4 or fields[:2] != ['compressed',
+                                                  self.compression]:
+                return None
+            compressed, done = int(fields[2]), int(fields[3])
+            partial_size = self.icbinn.stat(self.partial)[0]
+        except (UnicodeDecodeError, ValueError, IcbinnError):
+            return None
+        if compressed < 0 or not 0 <= done <= min(self.size, partial_size):
+            return None
+        return compressed, done
+
+    def decompressor(self):
+        """Return a new decompressor for one gzip member or zstd frame"""
+        if self.compression == COMPRESSION_GZIP:
+            return decompressobj(31)
+        return ZstdDecompressor().decompressobj()
+
+    def write_next(self, icbinn_file, data):
+        """Write decompressed data after what has been written so far"""
+        if not data:
+            return
+        segment = self.segments[0]
+        if segment[2] + len(data) > self.size:
+            raise HTTPError('%s decompresses to more than %d bytes' % (
+                    self.partial, self.size))
+        self.write(icbinn_file, segment, data)
+
+    def advance(self, segment, nbytes):
+        """Record that nbytes more have been written; the record is only
+        saved at checkpoints"""
+        with self.lock:
+            segment[2] += nbytes
+
+    def checkpoint(self, compressed):
+        """Record that the compressed stream up to compressed has been
+        written, saving the record every SEGMENT_CHECKPOINT_BYTES"""
+        with self.lock:
+            self.unsaved += self.segments[0][2] - self.resume[1]
+            self.resume = (compressed, self.segments[0][2])
+            if self.unsaved >= SEGMENT_CHECKPOINT_BYTES:
+                self.save_locked()
+
+    def save_locked(self):
+        content = 'compressed %s %d %d\n' % ((self.compression,) +
+                                              self.resume)
+        self.icbinn.write_file(self.state_path + '.new',
+                               content.encode('ascii'))
+        self.icbinn.rename(self.state_path + '.new', self.state_path)
+        self.unsaved = 0
+
+class ZstdSplitter(object):
+    """Split a zstd stream into pieces which each hold at most one block.
+
+    zstandard's decompressobj has no limit on the output of a call, like
+    the max_length of zlib's, but a block decompresses to at most
+    BLOCKSIZE_MAX bytes, so decompressing a piece at a time bounds it."""
+    def __init__(self):
+        self.header = b''
+        self.need = 4
+        self.parse = self.parse_magic
+        self.skip = 0
+        self.checksum = False
+
+    def split(self, data):
+        """Return the pieces of data, the next part of the stream. A new
+        piece starts at each frame and block header."""
+        pieces = []
+        start = offset = 0
+        while offset < len(data):
+            if self.skip:
+                step = min(self.skip, len(data) - offset)
+                self.skip -= step
+                offset += step
+                continue
+            if not self.header and offset > start:
+                pieces.append(data[start:offset])
+                start = offset
+            step = min(self.need - len(self.header), len(data) - offset)
+            self.header += bytes(data[offset:offset + step])
+            offset += step
+            if len(self.header) == self.need:
+                self.parse()
+        if offset > start:
+            pieces.append(data[start:offset])
+        return pieces
+
+    def expect(self, need, parse, keep=True):
+        """Parse the next need bytes of header, including those so far if
+        keep is set, with parse"""
+        if not keep:
+            self.header = b''
+        self.need = need
+        self.parse = parse
+
+    def parse_magic(self):
+        magic = unpack('<I', self.header)[0]
+        if magic == ZSTD_MAGIC:
+            # enough to find the size of the frame header
+            self.expect(5, self.parse_descriptor)
+        elif magic & ~0xF == ZSTD_SKIPPABLE_MAGIC:
+            self.expect(8, self.parse_skippable)
+        else:
+            raise HTTPError('compressed stream is not zstd: magic number '
+                            '0x%08x' % magic)
+
+    def parse_descriptor(self):
+        self.expect(frame_header_size(self.header), self.parse_frame_header)
+
+    def parse_frame_header(self):
+        self.checksum = get_frame_parameters(self.header).has_checksum
+        self.expect(3, self.parse_block, keep=False)
+
+    def parse_skippable(self):
+        self.skip = unpack('<I', self.header[4:])[0]
+        self.expect(4, self.parse_magic, keep=False)
+
+    def parse_block(self):
+        header = unpack('<I', self.header + b'\0')[0]
+        last, kind, size = header & 1, (header >> 1) & 3, header >> 3
+        # RLE blocks hold one byte to repeat size times
+        self.skip = 1 if kind == 1 else size
+        if last:
+            self.skip += 4 if self.checksum else 0
+            self.expect(4, self.parse_magic, keep=False)
+        else:
+            self.expect(3, self.parse_block, keep=False)
+
+@contextmanager
+def property_snapshots():
+    """Make a pass over dbus objects. Within it, get_property serves the
+    properties of each object and interface from a snapshot taken with one
+    GetAll call the first time one of them is needed. Those in
+    LIVE_PROPERTIES are always read live, since a snapshot may be minutes
+    old by the time they are read. Setting a property drops it from the
+    snapshots for its object, so that later reads of it see what xenmgr
+    made of the change, while the other properties are still served from
+    the snapshot."""
+    global PROPERTY_SNAPSHOTS
+    PROPERTY_SNAPSHOTS = {}
+    PROPERTY_SNAPSHOT_LOCKS.clear()
+    try:
+        yield
+    finally:
+        PROPERTY_SNAPSHOTS = None
+
+def property_snapshot_lock(service, path):
+    """Return the lock for the snapshots of the object at path of service,
+    so that threads working on different objects do not wait for each
+    other's GetAll calls"""
+    with PROPERTY_SNAPSHOTS_LOCK:
+        return PROPERTY_SNAPSHOT_LOCKS.setdefault((service, path), Lock())
+
+def get_property_snapshot(path, interface, service):
+    """Return the properties on interface at path from the snapshot for
+    this pass, or None if there is no pass or GetAll failed"""
+    snapshots = PROPERTY_SNAPSHOTS
+    if snapshots is None:
+        return None
+    key = (service, path, interface)
+    with property_snapshot_lock(service, path):
+        if key not in snapshots:
+            try:
+                snapshots[key] = call_proxy(
+                    service, path, 'org.freedesktop.DBus.Properties',
+                    lambda propi: propi.GetAll(interface))
+            except DBusException as exc:
+                log.info('unable to get all properties of %s at %s: %s',
+                         interface, path, exc)
+                snapshots[key] = None
+        return snapshots[key]
+
 def get_property(path, key, interface, 
                  service='com.citrix.xenclient.xenmgr'):
     """Lookup key on interface at path"""
-    obj = SystemBus().get_object(service, path)
-    propi = Interface(obj, dbus_interface='org.freedesktop.DBus.Properties')
-    return propi.Get(interface, key)
+    snapshot = None
+    if key not in LIVE_PROPERTIES:
+        snapshot = get_property_snapshot(path, interface, service)
+    if snapshot is not None:
+        # another thread may drop key from the snapshot by setting it
+        try:
+            return snapshot[key]
+        except KeyError:
+            pass
+    return call_proxy(service, path, 'org.freedesktop.DBus.Properties',
+                      lambda propi: propi.Get(interface, key))
 
 
 def set_property(path, key, value, interface, 
                  service='com.citrix.xenclient.xenmgr'):
     """Set key to value on interface at path"""
-    obj = SystemBus().get_object(service, path)
-    propi = Interface(obj, dbus_interface='org.freedesktop.DBus.Properties')
-    return str(propi.Set(interface, key, value))    
+    snapshots = PROPERTY_SNAPSHOTS
+    if snapshots is None:
+        return str(call_proxy(
+                service, path, 'org.freedesktop.DBus.Properties',
+                lambda propi: propi.Set(interface, key, value)))
+    with property_snapshot_lock(service, path):
+        res = str(call_proxy(
+                service, path, 'org.freedesktop.DBus.Properties',
+                lambda propi: propi.Set(interface, key, value)))
+        for cached, snapshot in list(snapshots.items()):
+            if cached[:2] == (service, path) and snapshot is not None:
+                snapshot.pop(key, None)
+    return res
 
 def open_xenmgr():
     """Return a dbus proxy for the main xenmgr interface"""
-    bus = SystemBus()
-    xenmgr_obj = bus.get_object('com.citrix.xenclient.xenmgr', '/')  
-    return Interface(xenmgr_obj, dbus_interface='com.citrix.xenclient.xenmgr')
+    return get_proxy('com.citrix.xenclient.xenmgr', '/',
+                     'com.citrix.xenclient.xenmgr')
 
 def open_xenmgr_unrestricted():
     """Return a dbus proxy for the main xenmgr interface"""
-    bus = SystemBus()
-    xenmgr_obj = bus.get_object('com.citrix.xenclient.xenmgr', '/')  
-    return Interface(xenmgr_obj, 
-                     dbus_interface='com.citrix.xenclient.xenmgr.unrestricted')
+    return get_proxy('com.citrix.xenclient.xenmgr', '/',
+                     'com.citrix.xenclient.xenmgr.unrestricted')
 
 def open_vm(vm_path):
     """Return a dbus proxy for the VM object"""
-    bus = SystemBus()
-    vm_obj = bus.get_object('com.citrix.xenclient.xenmgr', vm_path)  
-    return Interface(vm_obj, 
-                     dbus_interface='com.citrix.xenclient.xenmgr.vm')
+    return get_proxy('com.citrix.xenclient.xenmgr', vm_path,
+                     'com.citrix.xenclient.xenmgr.vm')
     
 def open_input_daemon():
     """Return a dbus proxy for the input daemon interface"""
-    bus = SystemBus()
-    input_obj = bus.get_object('com.citrix.xenclient.input', '/')  
-    return Interface(input_obj, dbus_interface='com.citrix.xenclient.input')
+    return get_proxy('com.citrix.xenclient.input', '/',
+                     'com.citrix.xenclient.input')
 
 def open_db():
     """Return a dbus proxy for the database (i.e. domstore) interface"""
-    bus = SystemBus()
-    db_obj = bus.get_object('com.citrix.xenclient.db', '/')  
-    return Interface(db_obj, dbus_interface='com.citrix.xenclient.db')
+    return get_proxy('com.citrix.xenclient.db', '/',
+                     'com.citrix.xenclient.db')
 
 def get_vm_property(vm_path, key, uuidmap=None):
     """Return the name of the VM with vm_path"""
@@ -554,9 +1606,7 @@ def set_nic_property(vm_path, nic_index, key, value, uuidmap):
 def map_vm_uuid(value, uuidmap, reverse):
     """Map a server VM uuid to a client VM uuid (or the reverse operation)"""
     if reverse:
-        for srv, cli in list(uuidmap.items()):
-            if cli == value:
-                return srv
+        return uuidmap.reverse.get(value)
     else:
         try:
             return uuidmap[value]
@@ -603,19 +1653,18 @@ def get_host_property(key):
 
 def host_control():
     """Return a proxy with the host control interface"""
-    host_obj = SystemBus().get_object('com.citrix.xenclient.xenmgr', '/host')
-    return Interface(host_obj, dbus_interface='com.citrix.xenclient.xenmgr.host')
+    return get_proxy('com.citrix.xenclient.xenmgr', '/host',
+                     'com.citrix.xenclient.xenmgr.host')
 
 def vm_control(vm_path):
     """Return a proxy with the VM control interface for vm_path"""
-    vm_obj = SystemBus().get_object('com.citrix.xenclient.xenmgr', vm_path)
-    return Interface(vm_obj, dbus_interface='com.citrix.xenclient.xenmgr.vm')
+    return get_proxy('com.citrix.xenclient.xenmgr', vm_path,
+                     'com.citrix.xenclient.xenmgr.vm')
 
 def disk_control(disk_path):
     """Return a proxy with the disk path interface for disk_path"""
-    disk_obj = SystemBus().get_object('com.citrix.xenclient.xenmgr', 
-                                      disk_path)    
-    return Interface(disk_obj, dbus_interface='com.citrix.xenclient.vmdisk')
+    return get_proxy('com.citrix.xenclient.xenmgr', disk_path,
+                     'com.citrix.xenclient.vmdisk')
 
 def arrange_license(license, device_uuid):
     """Update license information"""
@@ -652,17 +1701,18 @@ def arrange_xc_version(repo, download):
     upgrade_in_progress = False
     log.info('current release %s; current build %s', *current)
 
-    for name in ICBINN_STORAGE.listdir(REPO_DOWNLOAD_DIR):
+    for name, _, _ in ICBINN_STORAGE.listdir_attrs(REPO_DOWNLOAD_DIR):
         # TODO: downloading with .partial suffix isn't useful for repos
         if (repo_name is None or current == target or
-            name not in [repo_name, repo_name + '.partial']):
+            name not in [repo_name, repo_name + '.partial',
+                         repo_name + SEGMENTS_SUFFIX]):
             file_path = join(REPO_DOWNLOAD_DIR, name)
             log.info('deleting obsolete downloaded repo %s', file_path)
             ICBINN_STORAGE.unlink(file_path)
 
     # TODO: or just leave files for updatemgr to consume? (only works if
     # updatemgr polls the directory)
-    for name in ICBINN_STORAGE.listdir(REPO_HANDOVER_DIR):
+    for name, _, _ in ICBINN_STORAGE.listdir_attrs(REPO_HANDOVER_DIR):
         if repo_name is None or current == target or name != repo_name:
             file_path = join(REPO_HANDOVER_DIR, name)
 
@@ -699,7 +1749,9 @@ def arrange_xc_version(repo, download):
             if not ICBINN_STORAGE.exists(download_file):
                 log.info('downloading repo %s', repo_name)
                 download('repo/' + repo_name, download_file, repo['file_size'],
-                         'update', ICBINN_STORAGE)
+                         'update', ICBINN_STORAGE,
+                         checksum=repo.get('checksum'),
+                         compression=repo.get('compression'))
 
             if upgrade_in_progress:
                 log.info('upgrade in progress; not handing repo %s over to '
@@ -738,7 +1790,9 @@ def ensure_disk_downloaded(disk, download, icbinn,
         document = ('disk/' + disk['diskuuid'] + '.' +
                     disk.get('type', DISK_TYPE_VHD))
         download(document, destination_rel, disk['size'], 'VM disk', icbinn,
-                 progress_callback=progress_callback)
+                 progress_callback=progress_callback,
+                 checksum=disk.get('checksum'), delta=True,
+                 compression=disk.get('compression'))
     else:
         document = None
     try:
@@ -800,16 +1854,39 @@ def vhd_util(*args):
     environ['LIBVHD_ICBINN_KEY_SERVER'] = 'argo:0:4879'
     cmd = ['vhd-util'] + list(args)
     log.info("running [ %s ]", ' '.join(cmd))
-    return check_output(cmd, close_fds=True)
+    try:
+        return check_output(cmd, close_fds=True)
+    finally:
+        # vhd-util works on the files over its own icbinn connections
+        for icbinn in (ICBINN_STORAGE, ICBINN_CONFIG):
+            icbinn.clear_cache()
 
 def make_key(myconfig, nbytes):
     """Make a key given myconfig of length nbytes"""
     src = (ICBINN_URANDOM if myconfig.get('use-pseudorandomness') else
            ICBINN_RANDOM)
-    out = ''
-    for _ in range(nbytes):
-        out += ICBINN_STORAGE.rand(src, 1)
-    return out
+    return ICBINN_STORAGE.rand(src, nbytes)
+
+class KeyPool(object):
+    """Callable making keys of length nbytes given myconfig. The entropy
+    for the first count keys is read from icbinn at once, on the first
+    call."""
+    def __init__(self, myconfig, nbytes, count=1):
+        self.myconfig = myconfig
+        self.nbytes = nbytes
+        self.count = max(count, 1)
+        self.entropy = b''
+        self.lock = Lock()
+
+    def __call__(self):
+        with self.lock:
+            if len(self.entropy) < self.nbytes:
+                self.entropy = make_key(self.myconfig,
+                                        self.nbytes * self.count)
+                self.count = 1
+            key = self.entropy[:self.nbytes]
+            self.entropy = self.entropy[self.nbytes:]
+            return key
 
 def calculate_key_path(vhd_rel, length):
     """Work out path for key for vhd_rel, with given length"""
@@ -966,6 +2043,7 @@ def destroy_disk(toolstack_disk_object):
         diskcontrol.delete()
     except DBusException:
         log.warning('error deleting %r', toolstack_disk_object)
+    forget_proxies(toolstack_disk_object)
 
 
 def are_snapshots_encrypted(diskoptions, vmoptions):
@@ -989,23 +2067,30 @@ def arrange_snapshot(diskuuid, shared, vm_instance_uuid, base_rel,
     snapshot_rel = generate_snapshot_vhd_path(
         diskuuid, shared, vm_instance_uuid)
     snapshot_dom0 = ICBINN_STORAGE.mounted_path(snapshot_rel)
-    if ICBINN_STORAGE.exists(snapshot_rel):
-        log.info('already have snapshot '+snapshot_dom0)
-        verify_vhd_key(snapshot_rel)
-    else:
-        log.info("creating %s snapshot at %s", 
-                 'encrypted' if encrypt_snapshots else 'clear', 
-                 snapshot_dom0)
-        vhd_util('snapshot', '-p', base_rel, '-n', snapshot_rel)
-        if not ICBINN_STORAGE.exists(snapshot_rel):
-            raise VhdUtilSnapshotFailed(base_rel, snapshot_rel)
-        log.info('created snapshot '+ snapshot_dom0)
-        if encrypt_snapshots:
-            place_vhd_key(snapshot_rel, generate_key(), mark_vhd=True)
+    with snapshot_lock(snapshot_rel):
+        if ICBINN_STORAGE.exists(snapshot_rel):
+            log.info('already have snapshot '+snapshot_dom0)
+            verify_vhd_key(snapshot_rel)
         else:
-            log.warning('unencrypted VHD delta snapshot created')
+            log.info("creating %s snapshot at %s", 
+                     'encrypted' if encrypt_snapshots else 'clear', 
+                     snapshot_dom0)
+            vhd_util('snapshot', '-p', base_rel, '-n', snapshot_rel)
+            if not ICBINN_STORAGE.exists(snapshot_rel):
+                raise VhdUtilSnapshotFailed(base_rel, snapshot_rel)
+            log.info('created snapshot '+ snapshot_dom0)
+            if encrypt_snapshots:
+                place_vhd_key(snapshot_rel, generate_key(), mark_vhd=True)
+            else:
+                log.warning('unencrypted VHD delta snapshot created')
     return snapshot_dom0
 
+def snapshot_lock(snapshot_rel):
+    """Return the lock for the snapshot at snapshot_rel, so that VMs
+    sharing a disk do not both make its shared snapshot"""
+    with SNAPSHOT_LOCKS_LOCK:
+        return SNAPSHOT_LOCKS.setdefault(snapshot_rel, Lock())
+
 
 def arrange_disk_in_toolstack(vmpath, vmoptions,
                               disk_index, toolstack_disk_object, 
@@ -1084,18 +2169,15 @@ def arrange_disk_in_toolstack(vmpath, vmoptions,
                 lambda k, v: set_disk_property(toolstack_disk_object, k, v))})
 
 
-def arrange_vm(myconfig, vmpath, vminfo, diskmap, uuidmap, already_disks):
-    """Arrange that VM at vmpath is in state vminfo, 
-    given the disks available. """
-
-    vmc = vm_control(vmpath)
+def arrange_vm_config(vmpath, vminfo, config, uuidmap):
+    """Arrange that VM at vmpath has config, the config of vminfo without
+    the items for the synchronizer"""
     keydir = ICBINN_CONFIG.mount_point
     if get_vm_property(vmpath, 'crypto-key-dirs') != keydir:
         log.info('setting VM crypto key dirs to %s', keydir)
         set_vm_property(vmpath, 'crypto-key-dirs', keydir)
-    config, vmoptions = filter_configuration(vminfo.get('config'), 
-                                             [ENCRYPT_SNAPSHOTS])
-    config.append({'daemon': 'vm', 'key': 'name', 'value': vminfo['name']})
+    config = config + [
+        {'daemon': 'vm', 'key': 'name', 'value': vminfo['name']}]
     def configure(daemon):
         if daemon == 'vm':
             return ((lambda k: get_vm_property(vmpath, k, uuidmap)),
@@ -1117,6 +2199,22 @@ def arrange_vm(myconfig, vmpath, vminfo, diskmap, uuidmap, already_disks):
 
     set_config(config, configure)
 
+def arrange_vm(myconfig, vmpath, vminfo, diskmap, uuidmap, already_disks,
+               generate_key, disks_only=False):
+    """Arrange that VM at vmpath is in state vminfo, 
+    given the disks available. 
+
+    generate_key is called to make each disk encryption key needed.
+
+    If disks_only, the VM config is taken to have been arranged already and
+    only its disks are arranged."""
+
+    vmc = vm_control(vmpath)
+    config, vmoptions = filter_configuration(vminfo.get('config'), 
+                                             [ENCRYPT_SNAPSHOTS])
+    if not disks_only:
+        arrange_vm_config(vmpath, vminfo, config, uuidmap)
+
     for vmdisk in vminfo['disks']:
         bytes = already_disks.get(vmdisk['diskuuid'])
         if bytes in [None, 0]:
@@ -1135,116 +2233,452 @@ def arrange_vm(myconfig, vmpath, vminfo, diskmap, uuidmap, already_disks):
         target_state_disk = diskmap.get(vmdisk['diskuuid']) if vmdisk else None
         arrange_disk_in_toolstack(
             vmpath, vmoptions, disk_index, toolstack_disk_object, vmdisk, 
-            target_state_disk, lambda: make_key(myconfig, ENCRYPTION_KEY_BYTES),
-            vminfo['vm_instance_uuid'])
+            target_state_disk, generate_key, vminfo['vm_instance_uuid'])
 
     set_vm_property(vmpath, 'ready', True)
 
-def arrange_vms(myconfig, vms, disks, sync_name, already_disks, delete=True):
+def count_snapshot_keys(vms, disk_map):
+    """Count the encrypted snapshots which arranging vms may create"""
+    snapshots = set()
+    for vminfo in vms:
+        _, vmoptions = filter_configuration(vminfo.get('config'),
+                                            [ENCRYPT_SNAPSHOTS])
+        for vmdisk in vminfo['disks']:
+            disk = disk_map.get(vmdisk['diskuuid'])
+            _, diskoptions = filter_configuration(vmdisk['config'],
+                                                  [ENCRYPT_SNAPSHOTS])
+            if (disk is None or disk.get('read_only', False) or
+                not are_snapshots_encrypted(diskoptions, vmoptions)):
+                continue
+            snapshot_rel = generate_snapshot_vhd_path(
+                vmdisk['diskuuid'], disk.get('shared'),
+                vminfo['vm_instance_uuid'])
+            if not ICBINN_STORAGE.exists(snapshot_rel):
+                snapshots.add(snapshot_rel)
+    return len(snapshots)
+
+class UuidMap(dict):
+    """Map from server VM uuids to client VM uuids, with the reverse map kept
+    alongside in reverse"""
+    def __init__(self):
+        super().__init__()
+        self.reverse = {}
+
+    def __setitem__(self, server_uuid, client_uuid):
+        if server_uuid in self:
+            del self[server_uuid]
+        super().__setitem__(server_uuid, client_uuid)
+        self.reverse[client_uuid] = server_uuid
+
+    def __delitem__(self, server_uuid):
+        self.reverse.pop(self[server_uuid], None)
+        super().__delitem__(server_uuid)
+
+class VmIndex:
+    """The local VMs in the realm sync_name, found once and then kept
+    current as VMs are created and deleted.
+
+    paths maps the sync UUIDs of VMs (server VM instance UUIDs) to their
+    local paths, client_uuids maps those paths to local VM UUIDs, and
+    uuid_map maps server VM uuids to local VM UUIDs and back."""
+    def __init__(self, sync_name):
+        self.sync_name = sync_name
+        self.paths = {}
+        self.client_uuids = {}
+        self.uuid_map = UuidMap()
+        for vm_path in open_xenmgr().list_vms():
+            if get_vm_property(vm_path, 'realm') == sync_name:
+                self.paths[get_vm_property(vm_path, 'sync-uuid')] = vm_path
+        log.info('VMs in realm %s have sync UUID to local VM mapping %r', 
+                 sync_name, self.paths)
+
+    def client_uuid(self, sync_uuid):
+        """Return the local UUID of the VM with sync_uuid"""
+        vm_path = self.paths[sync_uuid]
+        if vm_path not in self.client_uuids:
+            self.client_uuids[vm_path] = get_vm_property(vm_path, 'uuid')
+        return self.client_uuids[vm_path]
+
+    def remove(self, sync_uuid):
+        """Forget the VM with sync_uuid, which has been deleted"""
+        vm_path = self.paths.pop(sync_uuid)
+        client_uuid = self.client_uuids.pop(vm_path, None)
+        if client_uuid in self.uuid_map.reverse:
+            del self.uuid_map[self.uuid_map.reverse[client_uuid]]
+
+class ActionGraph:
+    """Actions to run, each after the actions it depends on have finished.
+
+    Actions run in the order they were added wherever their dependencies
+    allow, so that running them one at a time gives the same order each
+    time."""
+    def __init__(self):
+        self.actions = {}
+
+    def add(self, name, function, after=()):
+        """Add function as the action called name, to be run once the
+        actions named in after have finished"""
+        self.actions[name] = (function, set(after))
+
+    def run(self, concurrency=1):
+        """Run the actions, up to concurrency of them at once.
+
+        Once an action fails no more are started, and the first failure in
+        the order the actions were added is raised after the others in
+        progress have finished."""
+        names = list(self.actions)
+        order = dict([(name, i) for i, name in enumerate(names)])
+        followers = dict([(name, []) for name in names])
+        waiting = {}
+        for name, (_, after) in self.actions.items():
+            for dependency in after:
+                if dependency not in self.actions:
+                    raise TargetStateError('action %r depends on unknown '
+                                           'action %r' % (name, dependency))
+                followers[dependency].append(name)
+            waiting[name] = len(after)
+        self.check_acyclic(followers, dict(waiting))
+
+        ready = [order[name] for name in names if waiting[name] == 0]
+        heapify(ready)
+
+        def finished(name):
+            for follower in followers[name]:
+                waiting[follower] -= 1
+                if waiting[follower] == 0:
+                    heappush(ready, order[follower])
+
+        if concurrency <= 1:
+            while ready:
+                name = names[heappop(ready)]
+                self.actions[name][0]()
+                finished(name)
+            return
+
+        failures = {}
+        running = {}
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            while running or (ready and not failures):
+                while ready and not failures and len(running) < concurrency:
+                    name = names[heappop(ready)]
+                    running[executor.submit(self.actions[name][0])] = name
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    if future.exception():
+                        failures[order[name]] = future.exception()
+                    else:
+                        finished(name)
+        if failures:
+            raise failures[min(failures)]
+
+    def check_acyclic(self, followers, waiting):
+        """Raise TargetStateError if some actions can never run because
+        they depend on each other"""
+        ready = [name for name, count in waiting.items() if count == 0]
+        while ready:
+            for follower in followers[ready.pop()]:
+                waiting[follower] -= 1
+                if waiting[follower] == 0:
+                    ready.append(follower)
+        stuck = [name for name, count in waiting.items() if count]
+        if stuck:
+            raise TargetStateError('actions %r depend on each other' % stuck)
+
+def vm_references(vminfo):
+    """Return the server VM uuids of the network backends of the VM
+    vminfo, and those of the other VMs its run-* properties refer to"""
+    backends = set()
+    others = set()
+    for item in vminfo.get('config') or []:
+        daemon = item.get('daemon', '')
+        key = item.get('key', '')
+        value = item.get('value')
+        if daemon.startswith('nic/') and key == 'backend-uuid':
+            backends.add(value)
+        elif (daemon == 'vm' and key.startswith('run-') and
+              isinstance(value, str) and value.startswith(RPC_PREFIX)):
+            for entry in value[len(RPC_PREFIX):].split(','):
+                entry_key, entry_sep, entry_value = entry.partition('=')
+                if entry_key == 'vm' and entry_sep == '=':
+                    others.add(entry_value)
+    return backends, others
+
+def arrange_vms(myconfig, vms, disks, sync_name, already_disks, delete=True,
+                index=None, concurrency=DEFAULT_RECONCILE_CONCURRENCY):
     """Ensure we have a VM set corresponding to vms, a list
     of VM information dictionaries. disks is a list of disk 
-    information dictionaries."""
+    information dictionaries.
+
+    index is the VmIndex for sync_name, if one has already been made.
+
+    Up to concurrency VMs are worked on at once. A VM is only arranged
+    once the VMs its config refers to exist, and once its network backends
+    have been arranged. If delete, unwanted VMs are then deleted, as
+    retire_vms does."""
     disk_map = dict([(disk['diskuuid'], disk) for disk in disks])
 
-    xenmgr = open_xenmgr()
-    xenmgr_unrestricted = open_xenmgr_unrestricted()
-    have = dict( [(get_vm_property(vm_path, 'sync-uuid'), vm_path) for 
-                  vm_path in xenmgr.list_vms() if 
-                  get_vm_property(vm_path, 'realm') == sync_name])
-    log.info('VMs in realm %s have sync UUID to local VM mapping %r', 
-             sync_name, have)
+    if index is None:
+        index = VmIndex(sync_name)
+    have = index.paths
     allvms = dict ( [(str(vminfo['vm_instance_uuid']),
                        vminfo) for vminfo in vms])
     desired = dict( [rec for rec in list(allvms.items()) if not
                      rec[1].get('removed', False)])
+    # maps server VM uuids to the server VM instance uuids of desired VMs
+    instance_uuids = dict([(vminfo['vm_uuid'], server_uuid) for
+                           server_uuid, vminfo in desired.items()])
     
-    uuid_map = {} # maps server VM uuids to local client VM UUIDs
-    for server_uuid, vminfo in list(desired.items()):
+    uuid_map = index.uuid_map # maps server VM uuids to local client VM UUIDs
+    generate_key = KeyPool(myconfig, ENCRYPTION_KEY_BYTES,
+                           count_snapshot_keys(list(desired.values()),
+                                               disk_map))
+
+    def create(server_uuid, vminfo):
         ensure_vm_exists(server_uuid, have, sync_name, vminfo['config'],
                          vminfo['name'])
-        client_uuid = get_vm_property(have[server_uuid], 'uuid')
-        uuid_map[vminfo['vm_uuid']] = client_uuid
-    log.info('uuid_map %r', uuid_map)
+        uuid_map[vminfo['vm_uuid']] = index.client_uuid(server_uuid)
+        log.info('server VM %s is local VM %s', vminfo['vm_uuid'],
+                 uuid_map[vminfo['vm_uuid']])
 
-    for server_uuid, vminfo in list(desired.items()):
+    def arrange(server_uuid, vminfo):
         log.info('ensuring %s exists', server_uuid)
         arrange_vm(myconfig, have[server_uuid], vminfo, disk_map, 
-                   uuid_map, already_disks)
+                   uuid_map, already_disks, generate_key)
         log.info('confirmed exists %s', server_uuid)
 
+    graph = ActionGraph()
+    for server_uuid, vminfo in desired.items():
+        graph.add(('create', server_uuid), partial(create, server_uuid, vminfo))
+    for server_uuid, vminfo in desired.items():
+        after = [('create', server_uuid)]
+        backends, others = vm_references(vminfo)
+        for vm_uuid in backends | others:
+            if instance_uuids.get(vm_uuid, server_uuid) != server_uuid:
+                after.append(('create', instance_uuids[vm_uuid]))
+        for vm_uuid in backends:
+            if instance_uuids.get(vm_uuid, server_uuid) != server_uuid:
+                after.append(('arrange', instance_uuids[vm_uuid]))
+        graph.add(('arrange', server_uuid),
+                  partial(arrange, server_uuid, vminfo), after)
+    graph.run(concurrency)
+
     if delete:
-        for server_uuid, vminfo in list(allvms.items()):
-            vmpath = have.get(server_uuid)
-            if vmpath and vminfo['removed']:
-                set_vm_property(vmpath, 'download-progress', -1)
-                set_vm_property(vmpath, 'ready', False)
-
-        for server_uuid, vmpath in list(have.items()):
-            vminfo = allvms.get(server_uuid)
-            graceful_delete = (vminfo and vminfo.get('removed', False) and 
-                               get_vm_property(vmpath, 'state') == 'stopped')
-            if vminfo is None or graceful_delete:
-                vmc = vm_control(vmpath)
-                log.info('destroying unwanted VM %s', server_uuid)
-                vmc.destroy()
-                client_uuid = get_vm_property(have[server_uuid], 'uuid')
-                try:
-                    xenmgr_unrestricted.unrestricted_delete_vm(client_uuid)
-                except DBusException:
-                    # The run-pre-delete property may have prevented us from
-                    # deleting the VM. Try again with it unset.
-                    set_vm_property(vmpath, 'run-pre-delete', '')
-                    xenmgr_unrestricted.unrestricted_delete_vm(client_uuid)
+        retire_vms(vms, index, concurrency)
 
     return have
 
-def delete_unused_disks(disks):
+def retire_vms(vms, index, concurrency=DEFAULT_RECONCILE_CONCURRENCY):
+    """Delete the VMs of the realm of index which are not in vms, a list of
+    VM information dictionaries, and those marked removed there which are
+    stopped. VMs marked removed are no longer ready.
+
+    Up to concurrency VMs are worked on at once."""
+    xenmgr_unrestricted = open_xenmgr_unrestricted()
+    allvms = dict([(str(vminfo['vm_instance_uuid']), vminfo)
+                   for vminfo in vms])
+
+    def retire(server_uuid, vmpath):
+        vminfo = allvms.get(server_uuid)
+        if vminfo and vminfo['removed']:
+            set_vm_property(vmpath, 'download-progress', -1)
+            set_vm_property(vmpath, 'ready', False)
+        graceful_delete = (vminfo and vminfo.get('removed', False) and 
+                           get_vm_property(vmpath, 'state') == 'stopped')
+        if vminfo is None or graceful_delete:
+            vmc = vm_control(vmpath)
+            log.info('destroying unwanted VM %s', server_uuid)
+            vmc.destroy()
+            client_uuid = index.client_uuid(server_uuid)
+            try:
+                xenmgr_unrestricted.unrestricted_delete_vm(client_uuid)
+            except DBusException:
+                # The run-pre-delete property may have prevented us from
+                # deleting the VM. Try again with it unset.
+                set_vm_property(vmpath, 'run-pre-delete', '')
+                xenmgr_unrestricted.unrestricted_delete_vm(client_uuid)
+            forget_proxies(vmpath)
+            index.remove(server_uuid)
+
+    graph = ActionGraph()
+    for server_uuid, vmpath in list(index.paths.items()):
+        vminfo = allvms.get(server_uuid)
+        if vminfo is None or vminfo.get('removed', False):
+            graph.add(server_uuid, partial(retire, server_uuid, vmpath))
+    graph.run(concurrency)
+
+def arrange_vm_disks(myconfig, vms, disks, disk_sizes, changed, index,
+                     concurrency=DEFAULT_RECONCILE_CONCURRENCY):
+    """Arrange the disks of the VMs in vms which use any of the disks whose
+    UUIDs are in changed, after arrange_vms has arranged their config.
+
+    disk_sizes maps disk UUIDs to the sizes of the disks we have, and index
+    is the VmIndex used by arrange_vms."""
+    disk_map = dict([(disk['diskuuid'], disk) for disk in disks])
+    affected = [vminfo for vminfo in vms if not vminfo.get('removed', False)
+                and [x for x in vminfo['disks'] if x['diskuuid'] in changed]]
+    log.info('arranging disks of %d VMs', len(affected))
+    generate_key = KeyPool(myconfig, ENCRYPTION_KEY_BYTES,
+                           count_snapshot_keys(affected, disk_map))
+    graph = ActionGraph()
+    for vminfo in affected:
+        server_uuid = str(vminfo['vm_instance_uuid'])
+        graph.add(server_uuid, partial(
+                arrange_vm, myconfig, index.paths[server_uuid], vminfo,
+                disk_map, index.uuid_map, disk_sizes, generate_key,
+                disks_only=True))
+    graph.run(concurrency)
+
+def delete_unused_disks(disks, keep_delta_sources=False):
     """Remove any disks and local deltas owned by this synchronizer but not
-       listed in disks"""
+       listed in disks.
+
+       If keep_delta_sources is set, complete disks with a saved manifest
+       and their manifests are retained, since downloads of other disks may
+       copy chunks from them."""
     disk_set = set([disk['diskuuid'] for disk in disks])
-    for name in ICBINN_STORAGE.listdir(DISK_DIR):
+    entries = ICBINN_STORAGE.listdir_attrs(DISK_DIR)
+    sources = set()
+    if keep_delta_sources:
+        names = set([name for name, _, _ in entries])
+        for name in names:
+            if (name.endswith(MANIFEST_SUFFIX) and
+                name[:-len(MANIFEST_SUFFIX)] in names):
+                sources.update([name, name[:-len(MANIFEST_SUFFIX)]])
+    for name, _, kind in entries:
+        if kind == ICBINN_DIRECTORY:
+            log.info('ignoring directory %s', name)
+            continue
         log.info('considering disk file %s', name)
         split_name = name.split('.', 1)
         split_base = split_name[0].split('_')
         if (len(split_name) < 2 or
             split_name[1] not in (DISK_TYPES +
-                                  [x + '.partial' for x in DISK_TYPES]) or
+                                  [x + '.partial' for x in DISK_TYPES] +
+                                  [x + SEGMENTS_SUFFIX for x in DISK_TYPES] +
+                                  [x + MANIFEST_SUFFIX for x in DISK_TYPES]) or
             split_base[0] not in disk_set):
+            if name in sources:
+                log.info('retaining old disk file %s for delta updates', name)
+                continue
             log.info('deleting old disk file %s', name)
             ICBINN_STORAGE.unlink(join(DISK_DIR, name))
         else:
             log.info('retaining disk %s', name)
 
-def arrange_disk_backing_files(disks, download, disk_progress_callback=None):
-    """Ensure that disks have been downloaded and key files created"""
-    delete_unused_disks(disks)
+def arrange_disk_backing_files(disks, download, disk_progress_callback=None,
+                               concurrency=DEFAULT_DOWNLOAD_CONCURRENCY,
+                               known=None):
+    """Ensure that disks have been downloaded and key files created
+
+    Up to concurrency disks are downloaded at once. disk_progress_callback is
+    always called from this thread.
+
+    known maps the UUIDs of disks which have already been found to their
+    sizes, as returned by an earlier call; those disks are not looked at
+    again.
+
+    Files of disks which are not in disks are deleted first, except for
+    complete disks with a saved manifest, since new versions of a disk are
+    built from chunks of the old one where possible. If download is set,
+    those are deleted once the downloads are over, whether or not they
+    succeeded."""
+    delete_unused_disks(disks, keep_delta_sources=True)
+    # list the disks at once, so that checking each of them hits the cache
+    known = known or {}
+    todo = [disk for disk in disks if not known.get(disk['diskuuid'])]
+    if todo and ICBINN_STORAGE.exists(DISK_DIR):
+        ICBINN_STORAGE.listdir_attrs(DISK_DIR)
+    try:
+        if download is None or concurrency <= 1 or len(todo) <= 1:
+            sizes = [arrange_disk_backing_file(disk, download,
+                                               disk_progress_callback)
+                     for disk in todo]
+        else:
+            sizes = arrange_disk_backing_files_concurrently(
+                todo, download, disk_progress_callback, concurrency)
+    finally:
+        if download is not None:
+            delete_unused_disks(disks)
 
     diskinfo = {}
-
     for disk in disks:
-        log.info("synchronizing disk %r", redact_disk(disk))
-        nbytes, destination_rel, just_created = \
-            ensure_disk_downloaded(disk, download, 
-                                   ICBINN_STORAGE, disk_progress_callback)
-        if just_created:
-            enckey = disk.get('encryption_key')
-            if enckey:
-                place_vhd_key(destination_rel, decode_encryption_key(
-                        enckey), mark_vhd=False)
-
+        diskinfo[disk['diskuuid']] = known.get(disk['diskuuid'])
+    for disk, nbytes in zip(todo, sizes):
         diskinfo[disk['diskuuid']] = nbytes
 
     return diskinfo
 
+def arrange_disk_backing_file(disk, download, disk_progress_callback=None):
+    """Ensure that disk has been downloaded and its key file created, and
+    return its size"""
+    log.info("synchronizing disk %r", redact_disk(disk))
+    nbytes, destination_rel, just_created = \
+        ensure_disk_downloaded(disk, download, 
+                               ICBINN_STORAGE, disk_progress_callback)
+    if just_created:
+        enckey = disk.get('encryption_key')
+        if enckey:
+            place_vhd_key(destination_rel, decode_encryption_key(
+                    enckey), mark_vhd=False)
+    return nbytes
+
+def arrange_disk_backing_files_concurrently(disks, download,
+                                            disk_progress_callback,
+                                            concurrency):
+    """Run arrange_disk_backing_file for disks on a pool of concurrency
+    threads and return their sizes in the same order as disks.
+
+    Progress from the pool is passed on to disk_progress_callback from this
+    thread. Once a disk fails no more are started, and the first failure in
+    disks order is raised after the others in progress have finished."""
+    progress = {}
+    progress_lock = Lock()
+
+    def record_progress(disk, partial):
+        with progress_lock:
+            progress[disk['diskuuid']] = (disk, partial)
+
+    def report_progress():
+        with progress_lock:
+            updates = list(progress.values())
+            progress.clear()
+        if disk_progress_callback:
+            for disk, partial in updates:
+                disk_progress_callback(disk, partial)
+
+    log.info('synchronizing %d disks, %d at a time', len(disks), concurrency)
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = [executor.submit(arrange_disk_backing_file, disk, download,
+                                   record_progress)
+                   for disk in disks]
+        pending = futures
+        while pending:
+            _, pending = wait(pending, timeout=PROGRESS_INTERVAL,
+                              return_when=FIRST_EXCEPTION)
+            report_progress()
+            if [x for x in futures if x.done() and not x.cancelled() and
+                x.exception()]:
+                for future in pending:
+                    future.cancel()
+        report_progress()
+
+    for future in futures:
+        if not future.cancelled() and future.exception():
+            raise future.exception()
+    return [future.result() for future in futures]
+
 class VmProgress:
     def __init__(self, vm_target, vm_now, disk_target, disk_now):
         self.vm_target = vm_target
         self.vm_now = vm_now
         self.disk_target = dict( [(x['diskuuid'], x) for x in disk_target])
         self.disk_now = disk_now
+        self.disk_partial = {}
         self.prev_report_t = None
 
     def update(self, disk, partial):
+        self.disk_partial[disk['diskuuid']] = partial
         now_t = time()
         if (self.prev_report_t is not None and
             now_t <= self.prev_report_t + PROGRESS_INTERVAL):
@@ -1259,8 +2693,8 @@ class VmProgress:
                 for adisk in vm['disks']:
                     adiskobj = self.disk_target[adisk['diskuuid']]
                     total += adiskobj['size']
-                    if disk['diskuuid'] == adiskobj['diskuuid']:
-                        here = partial
+                    if adisk['diskuuid'] in self.disk_partial:
+                        here = self.disk_partial[adisk['diskuuid']]
                     else:
                         if adisk['diskuuid'] in self.disk_now:
                             here = adiskobj['size']
@@ -1276,40 +2710,75 @@ class VmProgress:
     def finish(self):
         for vm in self.vm_target:
             vmpath = self.vm_now.get(vm['vm_instance_uuid'])
-            set_vm_property(vmpath, 'download-progress', 100)
+            if vmpath:
+                set_vm_property(vmpath, 'download-progress', 100)
                         
-def work_toward_state(state, download, device_uuid, sync_role, sync_name):
+def work_toward_state(state, download, device_uuid, sync_role, sync_name,
+                      defaults=None):
     """Work toward getting this machine into state.
 
     download is a callback that transfers a file from
-    the web server to a specified location."""
+    the web server to a specified location.
+
+    defaults are initial values for sync-client configuration items, which
+    the target state may override."""
     censor_vm_config(state, sync_role)
+    for icbinn in (ICBINN_STORAGE, ICBINN_CONFIG):
+        icbinn.clear_cache()
     cstate = {}
-    myconfig = MyConfig({'use-pseudorandomness':False})
+    myconfig = MyConfig(dict(MYCONFIG_DEFAULTS, **(defaults or {})))
+    for icbinn in (ICBINN_STORAGE, ICBINN_CONFIG):
+        icbinn.max_channels = max(myconfig.get('icbinn-channels'), 1)
     if sync_role == SYNC_ROLE_PLATFORM:
         arrange_license(state['license'], device_uuid)
         arrange_device(myconfig, state['config'])
+    connections = myconfig.get('download-connections')
+    download = partial(download,
+                       segments=max(myconfig.get('download-segments'), 1),
+                       connection_slots=(BoundedSemaphore(connections)
+                                         if connections > 0 else None),
+                       rate_limiter=RateLimiter(
+            myconfig.get('download-rate-limit'),
+            myconfig.get('download-transfer-rate-limit'),
+            myconfig.get('download-rate-schedule')),
+                       write_window=max(myconfig.get('icbinn-write-window'), 1))
+    if sync_role == SYNC_ROLE_PLATFORM:
         cstate['release'], cstate['build'] = arrange_xc_version(
             state['repo'], download)
 
     # find out what disks we have
     already_disks = arrange_disk_backing_files(state['disks'], None)
 
-    # get VMs ready with no disks
-    have = arrange_vms(myconfig, state['vms'], state['disks'], sync_name,
-                       already_disks, delete=False)
+    # arrange VMs, with the disks we have
+    with property_snapshots():
+        index = VmIndex(sync_name)
+        have = arrange_vms(myconfig, state['vms'], state['disks'], sync_name,
+                           already_disks, delete=False, index=index,
+                           concurrency=myconfig.get('reconcile-concurrency'))
 
-    # download disks
+    # download the disks we do not have
     vmprog = VmProgress(state['vms'], have, state['disks'], 
                         already_disks)
     cstate['disks'] = arrange_disk_backing_files(
         state['disks'], download,
-        disk_progress_callback=vmprog.update)
+        disk_progress_callback=vmprog.update,
+        concurrency=myconfig.get('download-concurrency'),
+        known=already_disks)
     vmprog.finish()
-    # populate disks in VMs
-    arrange_vms(myconfig, state['vms'], state['disks'], sync_name,
-                cstate['disks'])
-
+    # populate the downloaded disks in the VMs using them, and only then
+    # delete the VMs no longer wanted, which may be being replaced by them
+    changed = set([uuid for uuid, nbytes in cstate['disks'].items()
+                   if nbytes != already_disks.get(uuid)])
+    with property_snapshots():
+        if changed:
+            arrange_vm_disks(myconfig, state['vms'], state['disks'],
+                             cstate['disks'], changed, index,
+                             concurrency=myconfig.get('reconcile-concurrency'))
+        retire_vms(state['vms'], index,
+                   concurrency=myconfig.get('reconcile-concurrency'))
+
+    for icbinn in (ICBINN_STORAGE, ICBINN_CONFIG):
+        icbinn.log_cache_stats()
     log.info('reached target state')
     return cstate
 
@@ -1345,9 +2814,14 @@ def set_config(config, daemons):
 
     daemons is either a dictionary mapping daemon names to (get, set) callbacks
     or a function that takes a daemon name and returns (get,set) callbacks or None 
-    if that daemon name is not supported."""
+    if that daemon name is not supported.
+
+    The differences between config and the current values are all worked
+    out before any of them is applied, so nothing is set if config is
+    invalid or a current value cannot be read."""
     if config is None:
         return
+    changes = []
     for item in config:
         if type(daemons) == type({}):
             daemon_control = daemons.get(item.get('daemon'))
@@ -1376,7 +2850,7 @@ def set_config(config, daemons):
             value = item['value']
         elif isinstance(current, Boolean) or type(current) == type(True):
             value = decode_boolean(item['value'])
-        elif isinstance(current, Int32):
+        elif isinstance(current, Int32) or type(current) == type(0):
             try:
                 value = int(item['value'])
             except ValueError:
@@ -1387,11 +2861,15 @@ def set_config(config, daemons):
                  item, current, type(current), value, type(value), 
                  'MATCH' if current == value else 'DIFFERENT')
         if current != value:
-            daemon_control[1](item['key'], value)
-            log.info('set %s', item)
+            changes.append((daemon_control[1], item, value))
         else:
             log.info('already have %s', item)
 
+    log.info('%d of %d configuration items to set', len(changes), len(config))
+    for setter, item, value in changes:
+        setter(item['key'], value)
+        log.info('set %s', item)
+
 def parse_args():
     """Parse command-line arguments"""
     parser = ArgumentParser()
@@ -1445,6 +2923,12 @@ class DomstoreConfig:
                               "options: %s" % ("role", self.role,
                                                ", ".join(SYNC_ROLES)))
 
+        self.config = dict([(key, self.read_int_key(db, key,
+                                                    MYCONFIG_DEFAULTS[key])
+                             if isinstance(MYCONFIG_DEFAULTS[key], int) else
+                             self.read_key(db, key, MYCONFIG_DEFAULTS[key]))
+                            for key in DOMSTORE_CONFIG_KEYS])
+
         with NamedTemporaryFile(delete=False, mode="w+") as f:
             f.write(self.read_key(db, "cacert"))
             self.cacert_file = f.name
@@ -1457,6 +2941,18 @@ class DomstoreConfig:
             return default
         raise ConfigError("domstore key '%s' not set" % key)
 
+    def read_int_key(self, db, key, default):
+        value = self.read_key(db, key, str(default))
+        try:
+            return int(value)
+        except ValueError:
+            raise ConfigError("domstore key '%s' value '%s' is not an "
+                              "integer" % (key, value))
+
+    def config_defaults(self):
+        """Return defaults for sync-client configuration items"""
+        return dict(self.config)
+
     def clean_up(self):
         unlink(self.cacert_file)
 
@@ -1522,7 +3018,8 @@ def main():
                 log.info('target state=%s', redact_target_state(state))
                 cstate = work_toward_state(state, server.download,
                                            domstore.device_uuid, domstore.role,
-                                           args.sync_name)
+                                           args.sync_name,
+                                           domstore.config_defaults())
                 log.info('making okay status report')
                 report(STATUS_OKAY)
                 log.info('done')
@@ -1532,6 +3029,8 @@ def main():
             except Exception:
                 report(STATUS_INTERNAL_EXCEPTION)
                 raise
+            finally:
+                server.close()
     except Error as exc:
         for line in format_exc().split('\n'):
             log.error("error: %s", line)
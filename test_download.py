@@ -0,0 +1,556 @@
+#
+# Copyright (c) 2013 Citrix Systems, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+
+"""Tests for resumable downloads into icbinn files"""
+
+from gzip import compress as gzip_compress
+from hashlib import sha256
+from json import dumps
+from os import O_RDONLY, urandom
+from threading import BoundedSemaphore, Lock, current_thread
+from time import monotonic, sleep
+
+import pytest
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from sync_client import client
+
+needs_zstd = pytest.mark.skipif(zstandard is None,
+                                reason='needs the zstandard module')
+ZSTD_BLOCK_SIZE = 128 * 1024
+
+DISK_UUIDS = ['00000000-0000-0000-0000-0000000000%02d' % x for x in range(10)]
+
+def digest(data):
+    return sha256(data).hexdigest()
+
+def disk_path(tmp_path, uuid, suffix=''):
+    return tmp_path / (client.generate_disk_path(
+            uuid, client.DISK_TYPE_VHD) + suffix)
+
+def test_manifest_blocks():
+    """test fixed-size blocks cover the document, the last one short"""
+    manifest = client.Manifest({'block_size': 4, 'blocks': ['A', 'b', 'c']},
+                               10)
+    assert manifest.chunks == [(0, 4, 'a'), (4, 4, 'b'), (8, 2, 'c')]
+
+def test_manifest_chunks():
+    """test chunks of any size are taken as listed"""
+    manifest = client.Manifest({'chunks': [[0, 3, 'A'], [3, 7, 'b']]}, 10)
+    assert manifest.chunks == [(0, 3, 'a'), (3, 7, 'b')]
+
+@pytest.mark.parametrize('record', [
+    {'block_size': 4, 'blocks': ['a', 'b']},
+    {'block_size': 0, 'blocks': []},
+    {'chunks': [[0, 3, 'a'], [4, 6, 'b']]},
+    {'chunks': [[0, 3, 'a'], [3, 0, 'b'], [3, 7, 'c']]},
+    {'chunks': [[0, 3, 'a']]}])
+def test_manifest_must_cover_document(record):
+    """test manifests which do not exactly cover the document are refused"""
+    with pytest.raises(ValueError):
+        client.Manifest(record, 10)
+
+def test_read_range(storage, tmp_path, monkeypatch):
+    """test ranges are read in icbinn-sized pieces and padded with zeros"""
+    monkeypatch.setattr(client, 'ICBINN_MAXDATA', 4)
+    (tmp_path / 'file').write_bytes(b'0123456789')
+    with storage.open('file', O_RDONLY) as icbinn_file:
+        assert client.read_range(icbinn_file, 2, 7) == b'2345678'
+        assert client.read_range(icbinn_file, 6, 8) == b'6789\0\0\0\0'
+        assert client.read_range(icbinn_file, 20, 2) == b'\0\0'
+
+def test_checksum_of_segments_written_out_of_order(storage, tmp_path):
+    """test data which arrives ahead of the hash is read back to check the
+    checksum"""
+    data = urandom(1000)
+    download = client.PartialDownload(storage, 'doc', 1000,
+                                      sha256(data).hexdigest().upper())
+    download.segments = [[0, 600, 0], [600, 1000, 600]]
+    with download.open() as icbinn_file:
+        download.write(icbinn_file, download.segments[1], data[600:])
+        download.write(icbinn_file, download.segments[0], data[:600])
+    download.verify()
+    download.finish()
+    assert (tmp_path / 'doc').read_bytes() == data
+
+def test_checksum_mismatch(storage, tmp_path):
+    """test a resumed download which does not match its checksum is
+    discarded"""
+    (tmp_path / 'doc.partial').write_bytes(b'corrupt')
+    download = client.PartialDownload(storage, 'doc', 7, 'ab' * 32)
+    with pytest.raises(client.ChecksumMismatch) as info:
+        download.verify()
+    assert str(info.value) == 'doc has SHA-256 %s, expected %s' % (
+        sha256(b'corrupt').hexdigest(), 'ab' * 32)
+    assert info.value.exit_code == client.ChecksumMismatch.exit_code
+    assert not (tmp_path / 'doc.partial').exists()
+
+def test_apply_manifest_refetches_bad_chunks(storage, tmp_path):
+    """test written chunks which do not match the manifest are fetched
+    again, along with the part of the document not yet written"""
+    document = b'aaaabbbbccccdd'
+    manifest = client.Manifest({'block_size': 4, 'blocks': [
+                digest(document[x:x + 4]) for x in range(0, 14, 4)]}, 14)
+    (tmp_path / 'disk.partial').write_bytes(b'aaaaXbbbcccc')
+    download = client.PartialDownload(storage, 'disk', 14)
+    assert download.segments == [[0, 14, 12]]
+    download.apply_manifest(manifest)
+    assert download.segments == [[0, 4, 4], [4, 8, 4], [8, 12, 12],
+                                 [12, 14, 12]]
+    assert download.pending() == [[4, 8, 4], [12, 14, 12]]
+    assert (tmp_path / client.SEGMENTS_SUFFIX.join(['disk', ''])).exists()
+
+def test_apply_manifest_copies_local_chunks(storage, tmp_path):
+    """test chunks held by files with a saved manifest are copied from them
+    if they still match, and the rest are left to fetch"""
+    old = b'aaaabbbbcccc'
+    (tmp_path / 'dir').mkdir()
+    (tmp_path / 'dir' / 'old').write_bytes(old[:8] + b'XXXX')
+    (tmp_path / 'dir' / ('old' + client.MANIFEST_SUFFIX)).write_text(dumps(
+            {'block_size': 4,
+             'blocks': [digest(old[x:x + 4]) for x in range(0, 12, 4)]}))
+    new = b'bbbbccccdddd'
+    manifest = client.Manifest({'chunks': [
+                [x, 4, digest(new[x:x + 4])] for x in range(0, 12, 4)]}, 12)
+    local = client.index_local_chunks(storage, 'dir', 'dir/new')
+    assert sorted(local.values()) == [('dir/old', 0), ('dir/old', 4),
+                                      ('dir/old', 8)]
+    download = client.PartialDownload(storage, 'dir/new', 12)
+    download.apply_manifest(manifest, local)
+    assert download.pending() == [[4, 12, 4]]
+    assert (tmp_path / 'dir' / 'new.partial').read_bytes() == b'bbbb'
+
+def old_disks(tmp_path):
+    """Write files of disks not in the target state: a complete disk with a
+    manifest, one without, and a partly downloaded one"""
+    (tmp_path / client.DISK_DIR).mkdir()
+    source, plain, partial = DISK_UUIDS[5:8]
+    disk_path(tmp_path, source).write_bytes(b'old')
+    disk_path(tmp_path, source, client.MANIFEST_SUFFIX).write_text('{}')
+    disk_path(tmp_path, plain).write_bytes(b'old')
+    disk_path(tmp_path, partial, '.partial').write_bytes(b'o')
+    disk_path(tmp_path, partial, client.SEGMENTS_SUFFIX).write_text('')
+    return [disk_path(tmp_path, source),
+            disk_path(tmp_path, source, client.MANIFEST_SUFFIX)]
+
+def remaining(tmp_path):
+    return sorted(x.name for x in (tmp_path / client.DISK_DIR).iterdir())
+
+def test_unused_disks_kept_as_delta_sources(storage, tmp_path):
+    """test old disks with a manifest are kept until the downloads are over,
+    and the other files of old disks are deleted before they start"""
+    sources = old_disks(tmp_path)
+    disks = [{'diskuuid': DISK_UUIDS[0], 'size': 3}]
+    during = []
+
+    def download(document, destination_rel, size, kind, icbinn, **_):
+        during.append(remaining(tmp_path))
+        icbinn.write_file(destination_rel, b'new')
+    client.arrange_disk_backing_files(disks, None)
+    assert remaining(tmp_path) == sorted(x.name for x in sources)
+    client.arrange_disk_backing_files(disks, download)
+    assert during == [sorted(x.name for x in sources)]
+    assert remaining(tmp_path) == [disk_path(tmp_path, DISK_UUIDS[0]).name]
+
+def test_unused_disks_deleted_after_failure(storage, tmp_path):
+    """test old disks are deleted even if a download fails"""
+    old_disks(tmp_path)
+    disks = [{'diskuuid': DISK_UUIDS[0], 'size': 3}]
+
+    def download(document, destination_rel, size, kind, icbinn, **_):
+        raise client.HTTPError('failed')
+    with pytest.raises(client.HTTPError):
+        client.arrange_disk_backing_files(disks, download)
+    assert remaining(tmp_path) == []
+
+def zstd_compress(data, **kwargs):
+    return zstandard.ZstdCompressor(**kwargs).compress(data)
+
+@needs_zstd
+def test_zstd_splitter_bounds_output():
+    """test a zstd stream is split so that no piece decompresses to more
+    than a block, however it arrives"""
+    data = bytes(3 * ZSTD_BLOCK_SIZE) + urandom(300000) + b'x' * 5
+    stream = (zstd_compress(data, write_checksum=True) +
+              b'\x5a\x2a\x4d\x18\x03\x00\x00\x00abc' +
+              zstd_compress(data[:1000]))
+    for size in [1, 7, 4096, len(stream)]:
+        splitter = client.ZstdSplitter()
+        pieces = []
+        for offset in range(0, len(stream), size):
+            pieces.extend(splitter.split(
+                    memoryview(stream)[offset:offset + size]))
+        assert b''.join(pieces) == stream
+        decompressor = zstandard.ZstdDecompressor().decompressobj()
+        out = []
+        for piece in pieces:
+            if decompressor.eof:
+                decompressor = zstandard.ZstdDecompressor().decompressobj()
+            out.append(decompressor.decompress(piece))
+        assert b''.join(out) == data + data[:1000]
+        assert max(len(x) for x in out) <= ZSTD_BLOCK_SIZE
+
+@needs_zstd
+def test_zstd_splitter_rejects_other_streams():
+    """test a stream which is not zstd is refused"""
+    with pytest.raises(client.HTTPError):
+        client.ZstdSplitter().split(gzip_compress(b'data'))
+
+COMPRESSORS = {client.COMPRESSION_GZIP: gzip_compress,
+               client.COMPRESSION_ZSTD: zstd_compress}
+
+@pytest.mark.parametrize('compression', [
+        client.COMPRESSION_GZIP,
+        pytest.param(client.COMPRESSION_ZSTD, marks=needs_zstd)])
+def test_compressed_download_resumes(storage, tmp_path, http_server,
+                                     compression):
+    """test an interrupted compressed download carries on from the end of
+    the last complete member or frame"""
+    members = [urandom(100000), bytes(200000), urandom(1000)]
+    compressed = [COMPRESSORS[compression](x) for x in members]
+    document = '/disk' + client.COMPRESSION_SUFFIXES[compression]
+    http_server.documents[document] = b''.join(compressed)
+    http_server.cut[document] = len(compressed[0]) + len(compressed[1]) // 2
+    data = b''.join(members)
+    server = client.HTTPServer(http_server.url)
+
+    def download():
+        server.download_compressed('disk', 'disk', len(data), storage,
+                                   compression,
+                                   checksum=sha256(data).hexdigest())
+    with pytest.raises(client.HTTPError):
+        download()
+    assert (tmp_path / 'disk.partial').read_bytes() == members[0]
+    download()
+    assert (tmp_path / 'disk').read_bytes() == data
+    assert not (tmp_path / ('disk' + client.SEGMENTS_SUFFIX)).exists()
+    assert http_server.requests[-1][2]['Range'] == 'bytes=%d-' % len(
+        compressed[0])
+
+@pytest.mark.parametrize('compression', [
+        client.COMPRESSION_GZIP,
+        pytest.param(client.COMPRESSION_ZSTD, marks=needs_zstd)])
+def test_compressed_download_output_is_bounded(storage, tmp_path,
+                                               http_server, monkeypatch,
+                                               compression):
+    """test highly compressed data is written a bounded piece at a time,
+    and decompressing to more than the size is refused"""
+    data = bytes(8 * 1024 * 1024)
+    http_server.documents['/disk' + client.COMPRESSION_SUFFIXES[
+            compression]] = COMPRESSORS[compression](data)
+    written = []
+    write = client.CompressedPartialDownload.write
+
+    def recording_write(self, icbinn_file, segment, data):
+        written.append(len(data))
+        write(self, icbinn_file, segment, data)
+    monkeypatch.setattr(client.CompressedPartialDownload, 'write',
+                        recording_write)
+    server = client.HTTPServer(http_server.url)
+    server.download_compressed('disk', 'disk', len(data), storage,
+                               compression)
+    assert (tmp_path / 'disk').read_bytes() == data
+    assert max(written) <= client.DOWNLOAD_BLOCK_SIZE
+    with pytest.raises(client.HTTPError):
+        server.download_compressed('disk', 'small', len(data) // 2,
+                                   storage, compression)
+
+@pytest.fixture
+def small_segments(monkeypatch):
+    """Let downloads of a few KiB be split into segments"""
+    monkeypatch.setattr(client, 'MIN_SEGMENT_SIZE', 100)
+
+def test_segment_failure_cancels_others(storage, tmp_path, http_server,
+                                        small_segments):
+    """test a failed segment stops one which is still receiving, and the
+    download later resumes from where the failed segment got to"""
+    data = urandom(2000)
+    http_server.documents['/doc'] = data
+    http_server.stall[('/doc', 0)] = 100
+    http_server.cut[('/doc', 1000)] = 10
+    server = client.HTTPServer(http_server.url)
+    started = monotonic()
+    with pytest.raises(client.HTTPError):
+        server.download('doc', 'doc', 2000, 'test', storage, segments=2)
+    assert monotonic() - started < 10
+    assert sorted(x[2]['Range'] for x in http_server.requests) == [
+        'bytes=0-999', 'bytes=1000-1999']
+    server.download('doc', 'doc', 2000, 'test', storage, segments=2)
+    assert (tmp_path / 'doc').read_bytes() == data
+    assert 'bytes=1010-1999' in [x[2].get('Range')
+                                 for x in http_server.requests[2:]]
+
+def test_segment_failure_cancels_those_waiting(storage, http_server,
+                                               small_segments):
+    """test segments waiting for a connection slot when another fails give
+    up without fetching anything"""
+    http_server.documents['/doc'] = urandom(2000)
+    http_server.cut[('/doc', 0)] = http_server.cut[('/doc', 1000)] = 10
+    slots = BoundedSemaphore(2)
+    slots.acquire()
+    server = client.HTTPServer(http_server.url)
+    with pytest.raises(client.HTTPError):
+        server.download('doc', 'doc', 2000, 'test', storage, segments=2,
+                        connection_slots=slots)
+    assert len(http_server.requests) == 1
+    slots.release()
+    assert slots.acquire(timeout=0) and slots.acquire(timeout=0)
+
+def segment_record(segments):
+    return ('segments %d\n' % len(segments) + ''.join(
+            '%d %d %d\n' % tuple(x) for x in segments)).encode('ascii')
+
+@pytest.mark.parametrize('content, segments', [
+    (b'segments 2\n0 500 100\n500 1000 1000\n',
+     [[0, 500, 100], [500, 1000, 1000]]),
+    (b'segments 1\n0 1000 0\n', [[0, 1000, 0]]),
+    (b'segments 2\n0 500 100\n600 1000 600\n', None),
+    (b'segments 1\n0 900 0\n', None),
+    (b'segments 1\n0 1000 1001\n', None),
+    (b'segments 2\n0 1000 0\n', None),
+    (b'segments 0\n', None),
+    (b'garbage', None),
+    (b'\xff', None)])
+def test_parse_segment_record(storage, content, segments):
+    """test only records which exactly cover the download are accepted"""
+    download = client.PartialDownload(storage, 'doc', 1000)
+    assert download.parse(content) == segments
+
+def test_resume_from_segment_record(storage, tmp_path):
+    """test a recorded download carries on where each segment got to"""
+    (tmp_path / 'doc.partial').write_bytes(b'x' * 1000)
+    (tmp_path / ('doc' + client.SEGMENTS_SUFFIX)).write_bytes(
+        segment_record([[0, 500, 100], [500, 1000, 1000]]))
+    download = client.PartialDownload(storage, 'doc', 1000)
+    assert download.pending() == [[0, 500, 100]]
+    assert download.done_bytes() == 600
+
+def test_invalid_segment_record_discards_partial(storage, tmp_path):
+    """test a .partial file with an invalid record is started again"""
+    (tmp_path / 'doc.partial').write_bytes(b'x' * 1000)
+    (tmp_path / ('doc' + client.SEGMENTS_SUFFIX)).write_bytes(b'bad')
+    download = client.PartialDownload(storage, 'doc', 1000)
+    assert download.segments == [[0, 1000, 0]]
+    assert not (tmp_path / 'doc.partial').exists()
+
+def test_resume_single_stream_partial(storage, tmp_path):
+    """test a .partial file without a record is taken to be written from
+    the start"""
+    (tmp_path / 'doc.partial').write_bytes(b'x' * 300)
+    download = client.PartialDownload(storage, 'doc', 1000)
+    assert download.segments == [[0, 1000, 300]]
+
+def test_split(storage, small_segments):
+    """test the outstanding parts of the largest ranges are split until
+    there are enough or they get too small"""
+    download = client.PartialDownload(storage, 'doc', 1000)
+    download.segments = [[0, 500, 100], [500, 1000, 900]]
+    download.split(3)
+    assert download.segments == [[0, 300, 100], [300, 500, 300],
+                                 [500, 1000, 900]]
+    download.split(10)
+    assert download.segments == [[0, 200, 100], [200, 300, 200],
+                                 [300, 400, 300], [400, 500, 400],
+                                 [500, 1000, 900]]
+
+def test_segmented_download(storage, tmp_path, http_server, small_segments):
+    """test a document is fetched as concurrent ranges into one file"""
+    data = urandom(1000)
+    http_server.documents['/doc'] = data
+    server = client.HTTPServer(http_server.url)
+    server.download('doc', 'doc', 1000, 'test', storage, segments=4,
+                    checksum=sha256(data).hexdigest())
+    assert (tmp_path / 'doc').read_bytes() == data
+    assert sorted(x[2]['Range'] for x in http_server.requests) == [
+        'bytes=0-249', 'bytes=250-499', 'bytes=500-749', 'bytes=750-999']
+    assert not (tmp_path / ('doc' + client.SEGMENTS_SUFFIX)).exists()
+
+def test_segmented_download_resumes(storage, tmp_path, http_server):
+    """test only what the record says is missing is fetched"""
+    data = urandom(1000)
+    http_server.documents['/doc'] = data
+    (tmp_path / 'doc.partial').write_bytes(data[:100] + bytes(400) +
+                                           data[500:])
+    (tmp_path / ('doc' + client.SEGMENTS_SUFFIX)).write_bytes(
+        segment_record([[0, 500, 100], [500, 1000, 1000]]))
+    server = client.HTTPServer(http_server.url)
+    server.download('doc', 'doc', 1000, 'test', storage, segments=4,
+                    checksum=sha256(data).hexdigest())
+    assert (tmp_path / 'doc').read_bytes() == data
+    assert [x[2].get('Range') for x in http_server.requests
+            if x[1] == '/doc'] == ['bytes=100-499']
+
+@pytest.fixture
+def buffer_pools(monkeypatch):
+    """The BufferPools made by downloads, with the number of buffers in
+    each"""
+    pools = []
+    class RecordedPool(client.BufferPool):
+        def __init__(self, count, size):
+            super().__init__(count, size)
+            pools.append((self, count))
+    monkeypatch.setattr(client, 'BufferPool', RecordedPool)
+    return pools
+
+def test_segment_blocks_written_through_pool(storage, tmp_path, http_server,
+                                             small_segments, buffer_pools,
+                                             monkeypatch):
+    """test blocks are written by one thread, not those receiving them, and
+    every buffer is back in the pool once the download is done"""
+    data = urandom(1000)
+    http_server.documents['/doc'] = data
+    writers = set()
+    write = client.PartialDownload.write
+    def record_write(self, *args):
+        writers.add(current_thread())
+        return write(self, *args)
+    monkeypatch.setattr(client.PartialDownload, 'write', record_write)
+    server = client.HTTPServer(http_server.url)
+    server.download('doc', 'doc', 1000, 'test', storage, segments=4)
+    assert (tmp_path / 'doc').read_bytes() == data
+    assert len(writers) == 1 and current_thread() not in writers
+    assert [pool.idle.qsize() for pool, count in buffer_pools] == [
+        count for pool, count in buffer_pools]
+
+def test_write_failure_cancels_segments(storage, tmp_path, http_server,
+                                        icbinn_server, small_segments,
+                                        buffer_pools):
+    """test a failed icbinn write stops segments still receiving, and
+    returns their buffers, and the download later completes"""
+    data = urandom(2000)
+    http_server.documents['/doc'] = data
+    http_server.stall[('/doc', 0)] = 100
+    icbinn_server.fail['pwrite'] = 1
+    server = client.HTTPServer(http_server.url)
+    started = monotonic()
+    with pytest.raises(OSError, match='injected failure'):
+        server.download('doc', 'doc', 2000, 'test', storage, segments=2)
+    assert monotonic() - started < 10
+    assert [pool.idle.qsize() for pool, count in buffer_pools] == [
+        count for pool, count in buffer_pools]
+    server.download('doc', 'doc', 2000, 'test', storage, segments=2)
+    assert (tmp_path / 'doc').read_bytes() == data
+
+def disk_downloads(tmp_path, count):
+    (tmp_path / client.DISK_DIR).mkdir()
+    return [{'diskuuid': x, 'size': 10} for x in DISK_UUIDS[:count]]
+
+def test_disks_downloaded_concurrently(storage, tmp_path):
+    """test up to concurrency disks are downloaded at once, with progress
+    reported on the calling thread and sizes returned in disks order"""
+    disks = disk_downloads(tmp_path, 6)
+    lock = Lock()
+    active = []
+    most = []
+
+    def download(document, destination_rel, size, kind, icbinn,
+                 progress_callback=None, **_):
+        with lock:
+            active.append(document)
+            most.append(len(active))
+        sleep(0.05)
+        progress_callback(size // 2)
+        icbinn.write_file(destination_rel, b'x' * size)
+        with lock:
+            active.remove(document)
+    progress = []
+    sizes = client.arrange_disk_backing_files(
+        disks, download, lambda disk, done: progress.append(
+            (current_thread(), disk['diskuuid'], done)), concurrency=3)
+    assert sizes == dict((x, 10) for x in DISK_UUIDS[:6])
+    assert max(most) == 3
+    assert set(x[0] for x in progress) == set([current_thread()])
+    assert set(x[1] for x in progress) == set(DISK_UUIDS[:6])
+
+def test_disk_download_failure(storage, tmp_path):
+    """test the first failure in disks order is raised, and disks not yet
+    started are not downloaded once one has failed"""
+    disks = disk_downloads(tmp_path, 10)
+    started = []
+
+    def download(document, destination_rel, size, kind, icbinn, **_):
+        started.append(document)
+        if document.endswith(DISK_UUIDS[0] + '.vhd'):
+            sleep(0.2)
+            raise client.HTTPError('first')
+        if document.endswith(DISK_UUIDS[1] + '.vhd'):
+            raise client.HTTPError('second')
+        sleep(0.3)
+        icbinn.write_file(destination_rel, b'x' * size)
+    with pytest.raises(client.HTTPError) as info:
+        client.arrange_disk_backing_files(disks, download, concurrency=2)
+    assert str(info.value) == 'first'
+    assert len(started) < 10
+
+def block_manifest(data, block_size):
+    return dumps({'block_size': block_size, 'blocks': [
+                digest(data[x:x + block_size])
+                for x in range(0, len(data), block_size)]}).encode('ascii')
+
+def test_resume_checked_against_manifest(storage, tmp_path, http_server):
+    """test a resumed download fetches again the blocks of the .partial
+    file which do not match the manifest"""
+    data = urandom(1000)
+    http_server.documents['/doc'] = data
+    http_server.documents['/doc.manifest'] = block_manifest(data, 100)
+    corrupt = bytearray(data[:600])
+    corrupt[250] ^= 1
+    (tmp_path / 'doc.partial').write_bytes(corrupt)
+    server = client.HTTPServer(http_server.url)
+    server.download('doc', 'doc', 1000, 'test', storage,
+                    checksum=sha256(data).hexdigest())
+    assert (tmp_path / 'doc').read_bytes() == data
+    assert sorted(x[2]['Range'] for x in http_server.requests
+                  if x[1] == '/doc') == ['bytes=200-299', 'bytes=600-999']
+    assert not (tmp_path / 'doc.manifest').exists()
+
+@pytest.mark.parametrize('manifest', [
+    b'not json', b'{"block_size": 100, "blocks": []}', b'{"chunks": 1}'])
+def test_invalid_manifest_ignored(storage, tmp_path, http_server, manifest):
+    """test a download resumes as recorded if its manifest is not valid"""
+    data = urandom(1000)
+    http_server.documents['/doc'] = data
+    http_server.documents['/doc.manifest'] = manifest
+    (tmp_path / 'doc.partial').write_bytes(data[:600])
+    server = client.HTTPServer(http_server.url)
+    assert server.fetch_manifest('doc', 1000) is None
+    server.download('doc', 'doc', 1000, 'test', storage)
+    assert (tmp_path / 'doc').read_bytes() == data
+    assert [x[2].get('Range') for x in http_server.requests
+            if x[1] == '/doc'] == ['bytes=600-999']
+
+def test_delta_download_saves_manifest(storage, tmp_path, http_server):
+    """test a delta download copies chunks it has and keeps the manifest
+    for later updates"""
+    old, new = urandom(500), urandom(500)
+    http_server.documents['/new'] = old[:200] + new[200:]
+    http_server.documents['/new.manifest'] = block_manifest(
+        old[:200] + new[200:], 100)
+    (tmp_path / 'dir').mkdir()
+    (tmp_path / 'dir' / 'old').write_bytes(old)
+    (tmp_path / 'dir' / 'old.manifest').write_bytes(block_manifest(old, 100))
+    server = client.HTTPServer(http_server.url)
+    server.download('new', 'dir/new', 500, 'test', storage, delta=True)
+    assert (tmp_path / 'dir' / 'new').read_bytes() == old[:200] + new[200:]
+    assert [x[2].get('Range') for x in http_server.requests
+            if x[1] == '/new'] == ['bytes=200-499']
+    assert (tmp_path / 'dir' / 'new.manifest').read_bytes() == \
+        http_server.documents['/new.manifest']
@@ -0,0 +1,88 @@
+#
+# Copyright (c) 2021 Daniel P. Smith, Apertus Solutions LLC
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+
+"""Tests for hashing downloads as they arrive"""
+
+from hashlib import sha256
+from io import BytesIO
+from threading import Event, Thread, current_thread
+
+from pysynchronizer import hashing
+
+class BlockingSha(object):
+    """A sha256 whose update waits for release to be set, recording the
+    thread it runs on"""
+    def __init__(self):
+        self.sha = sha256()
+        self.release = Event()
+        self.threads = set()
+
+    def update(self, data):
+        self.threads.add(current_thread())
+        self.release.wait()
+        self.sha.update(data)
+
+    def hexdigest(self):
+        return self.sha.hexdigest()
+
+def test_digest_of_reused_buffer():
+    """test data is hashed as it was when passed in, though its buffer is
+    then reused"""
+    hasher = hashing.StreamHasher()
+    buf = bytearray(b'first')
+    hasher.update(memoryview(buf))
+    buf[:] = b'other'
+    hasher.update(buf)
+    assert hasher.hexdigest() == sha256(b'firstother').hexdigest()
+    assert hasher.hexdigest() == sha256(b'firstother').hexdigest()
+
+def test_hashing_is_off_the_receiving_thread(monkeypatch):
+    """test update returns without waiting for the hash, until the queue
+    of chunks is full"""
+    sha = BlockingSha()
+    monkeypatch.setattr(hashing, 'sha256', lambda: sha)
+    hasher = hashing.StreamHasher(queue_chunks=2)
+    for chunk in [b'a', b'b', b'c']:
+        hasher.update(chunk)
+    blocked = Thread(target=hasher.update, args=(b'd',))
+    blocked.start()
+    blocked.join(0.2)
+    assert blocked.is_alive()
+    sha.release.set()
+    blocked.join()
+    assert hasher.hexdigest() == sha256(b'abcd').hexdigest()
+    assert current_thread() not in sha.threads
+
+def test_close_stops_thread():
+    """test close waits for the queued data and stops the thread"""
+    hasher = hashing.StreamHasher()
+    hasher.update(b'data')
+    hasher.close()
+    hasher.close()
+    assert not hasher.thread.is_alive()
+    assert hasher.hexdigest() == sha256(b'data').hexdigest()
+
+def test_hashing_writer():
+    """test a HashingWriter writes and hashes the same data"""
+    out = BytesIO()
+    hasher = hashing.StreamHasher()
+    writer = hashing.HashingWriter(out, hasher)
+    writer.write(b'some ')
+    writer.write(memoryview(b'data'))
+    assert out.getvalue() == b'some data'
+    assert hasher.hexdigest() == sha256(b'some data').hexdigest()
@@ -0,0 +1,154 @@
+#
+# Copyright (c) 2013 Citrix Systems, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+
+"""Tests for talking to the sync server over pooled connections"""
+
+from base64 import b64encode
+
+import pytest
+
+from pysynchronizer import http_pool
+from sync_client import client
+
+@pytest.fixture(autouse=True)
+def no_proxy(monkeypatch):
+    """Make sure no proxy from the environment the tests run in is used"""
+    for name in ['http_proxy', 'https_proxy', 'no_proxy', 'HTTP_PROXY',
+                 'HTTPS_PROXY', 'NO_PROXY']:
+        monkeypatch.delenv(name, raising=False)
+
+def get(server, document):
+    return server.operation('get', document)
+
+def test_keep_alive(http_server):
+    """test requests reuse one connection"""
+    http_server.documents['/a'] = b'first'
+    http_server.documents['/b'] = b'second'
+    server = client.HTTPServer(http_server.url)
+    assert get(server, 'a') == b'first'
+    assert get(server, 'b') == b'second'
+    assert get(server, 'a') == b'first'
+    assert len(set(http_server.clients)) == 1
+
+def test_retry_on_closed_kept_alive_connection(http_server):
+    """test a request which fails because the server closed the idle
+    connection is retried on a new one"""
+    http_server.documents['/a'] = b'data'
+    http_server.drop_idle = True
+    server = client.HTTPServer(http_server.url)
+    assert get(server, 'a') == b'data'
+    assert get(server, 'a') == b'data'
+    assert len(set(http_server.clients)) == 2
+
+def test_failure_on_new_connection_is_not_retried(http_server):
+    """test a request which fails on a new connection raises HTTPError"""
+    http_server.documents['/a'] = b'data'
+    http_server.cut['/a'] = 0
+    server = client.HTTPServer(http_server.url)
+    with pytest.raises(client.HTTPError):
+        get(server, 'a')
+    assert len(http_server.requests) == 1
+
+def test_missing_document(http_server):
+    """test a GET refused by the server raises HTTPError"""
+    with pytest.raises(client.HTTPError):
+        get(client.HTTPServer(http_server.url), 'missing')
+
+def test_digest_challenge_answered_once(http_server):
+    """test a digest challenge is answered, and later requests are
+    authorized up front with increasing nonce counts"""
+    http_server.documents['/a'] = b'data'
+    http_server.digest = ('realm', 'device', 'secret')
+    server = client.HTTPServer(http_server.url, 'device', 'secret')
+    for _ in range(3):
+        assert get(server, 'a') == b'data'
+    assert len(http_server.requests) == 4
+    assert 'Authorization' not in http_server.requests[0][2]
+    assert [x[2]['Authorization'].split('nc=')[1][:8]
+            for x in http_server.requests[1:]] == [
+        '00000001', '00000002', '00000003']
+
+def test_digest_new_nonce(http_server):
+    """test a request refused with a new nonce is answered again"""
+    http_server.documents['/a'] = b'data'
+    http_server.digest = ('realm', 'device', 'secret')
+    server = client.HTTPServer(http_server.url, 'device', 'secret')
+    assert get(server, 'a') == b'data'
+    http_server.nonce = 'changed'
+    assert get(server, 'a') == b'data'
+    assert len(http_server.requests) == 4
+
+def test_digest_wrong_password(http_server):
+    """test a challenge is only answered once per request"""
+    http_server.documents['/a'] = b'data'
+    http_server.digest = ('realm', 'device', 'secret')
+    server = client.HTTPServer(http_server.url, 'device', 'wrong')
+    with pytest.raises(client.HTTPError):
+        get(server, 'a')
+    assert len(http_server.requests) == 2
+
+def test_http_proxy(http_server, monkeypatch):
+    """test requests for http URLs go to the proxy, naming the server"""
+    http_server.documents['/sync/a'] = b'data'
+    monkeypatch.setenv('http_proxy', http_server.url.replace(
+            'http://', 'http://user:p%40ss@'))
+    server = client.HTTPServer('http://sync.example:8080/sync')
+    assert get(server, 'a') == b'data'
+    method, path, headers = http_server.requests[0]
+    assert path == 'http://sync.example:8080/sync/a'
+    assert headers['Host'] == 'sync.example:8080'
+    assert headers['Proxy-Authorization'] == 'Basic ' + b64encode(
+        b'user:p@ss').decode('ascii')
+
+def test_http_proxy_with_digest(http_server, monkeypatch):
+    """test digest authorization works through a proxy"""
+    http_server.documents['/a'] = b'data'
+    http_server.digest = ('realm', 'device', 'secret')
+    monkeypatch.setenv('http_proxy', http_server.url)
+    server = client.HTTPServer('http://sync.example/', 'device', 'secret')
+    assert get(server, 'a') == b'data'
+
+def test_https_proxy_tunnel(http_server, monkeypatch):
+    """test connections to https URLs are tunnelled through the proxy"""
+    monkeypatch.setenv('https_proxy', http_server.url.replace(
+            'http://', 'http://user:pass@'))
+    server = client.HTTPServer('https://sync.example/')
+    with pytest.raises(client.HTTPError):
+        get(server, 'a')
+    method, path, headers = http_server.requests[0]
+    assert (method, path) == ('CONNECT', 'sync.example:443')
+    assert headers['Proxy-Authorization'] == 'Basic ' + b64encode(
+        b'user:pass').decode('ascii')
+
+def test_no_proxy(http_server, monkeypatch):
+    """test servers listed in no_proxy are connected to directly"""
+    http_server.documents['/a'] = b'data'
+    monkeypatch.setenv('http_proxy', 'http://127.0.0.1:1')
+    monkeypatch.setenv('no_proxy', 'localhost,127.0.0.1')
+    assert get(client.HTTPServer(http_server.url), 'a') == b'data'
+    assert http_server.requests[0][1] == '/a'
+
+def test_pool_is_shared_with_pysynchronizer(http_server):
+    """test the server's connections come from the pysynchronizer pool,
+    logging to this module's log"""
+    http_server.documents['/a'] = b'data'
+    server = client.HTTPServer(http_server.url)
+    assert isinstance(server.pool, http_pool.ConnectionPool)
+    assert server.pool.log is client.log
+    assert get(server, 'a') == b'data'
+    assert isinstance(server.pool.idle[0], http_pool.PooledHTTPConnection)
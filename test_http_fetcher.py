@@ -0,0 +1,157 @@
+#
+# Copyright (c) 2021 Daniel P. Smith, Apertus Solutions LLC
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+
+"""Tests for pysynchronizer's HttpFetcher"""
+
+import os
+import socket
+
+from io import BytesIO
+
+import pytest
+
+from pysynchronizer import errors, http_fetcher, http_pool, singleton, utils
+from pysynchronizer.oxt_dbus import OXTDBusApi
+
+class FakeDb(object):
+    """The domstore keys HttpFetcher reads"""
+    def __init__(self, **keys):
+        self.keys = keys
+
+    def read(self, key):
+        return self.keys.get(key.replace('-', '_'), '')
+
+@pytest.fixture
+def fetcher(monkeypatch):
+    """A new HttpFetcher, with no proxy set in the environment"""
+    for name in ['http_proxy', 'https_proxy', 'no_proxy', 'HTTP_PROXY',
+                 'HTTPS_PROXY', 'NO_PROXY']:
+        monkeypatch.delenv(name, raising=False)
+    monkeypatch.setattr(OXTDBusApi, 'open_db', staticmethod(FakeDb))
+    monkeypatch.delitem(singleton.SingletonMeta._instances,
+                        http_fetcher.HttpFetcher, raising=False)
+    yield http_fetcher.HttpFetcher()
+    singleton.SingletonMeta._instances.pop(http_fetcher.HttpFetcher, None)
+
+def test_connection_reused(fetcher, http_server):
+    """test fetches from one server share a kept-alive connection"""
+    http_server.documents['/a'] = b'first'
+    http_server.documents['/b'] = b'second'
+    assert fetcher.fetch(http_server.url + 'a') == ('', '', b'first')
+    assert fetcher.fetch(http_server.url + 'b') == ('', '', b'second')
+    assert len(set(http_server.clients)) == 1
+
+def test_retry_on_closed_kept_alive_connection(fetcher, http_server):
+    """test a fetch on a connection the server closed is retried"""
+    http_server.documents['/a'] = b'data'
+    http_server.drop_idle = True
+    for _ in range(2):
+        assert fetcher.fetch(http_server.url + 'a')[2] == b'data'
+    assert len(set(http_server.clients)) == 2
+
+def test_range_and_redirect(fetcher, http_server):
+    """test redirects are followed and ranges returned with their bounds"""
+    http_server.documents['/a'] = b'0123456789'
+    http_server.redirects['/old'] = '/a'
+    assert fetcher.fetch(http_server.url + 'old', 2, 3) == (
+        '2-4', '10', b'234')
+
+def test_error_status(fetcher, http_server):
+    """test a refused fetch raises HTTPError"""
+    with pytest.raises(errors.HTTPError):
+        fetcher.fetch(http_server.url + 'missing')
+
+def test_stream_resumes(fetcher, http_server):
+    """test stream fetches from offset into file_handle"""
+    http_server.documents['/a'] = b'0123456789'
+    out = BytesIO()
+    fetcher.stream(http_server.url + 'a', out, 4, 3)
+    assert out.getvalue() == b'456789'
+
+def test_http_proxy(fetcher, http_server, monkeypatch):
+    """test fetches of http URLs go through the proxy in the environment"""
+    http_server.documents['/a'] = b'data'
+    monkeypatch.setenv('http_proxy', http_server.url.replace(
+            'http://', 'http://user:pass@'))
+    assert fetcher.fetch('http://sync.example/a')[2] == b'data'
+    method, path, headers = http_server.requests[0]
+    assert path == 'http://sync.example:80/a'
+    assert headers['Proxy-Authorization'] == 'Basic dXNlcjpwYXNz'
+
+def test_https_proxy_tunnel(fetcher, http_server, monkeypatch):
+    """test connections to https URLs are tunnelled through the proxy"""
+    monkeypatch.setenv('https_proxy', http_server.url)
+    with pytest.raises(errors.HTTPError):
+        fetcher.fetch('https://sync.example:8443/a')
+    assert http_server.requests[0][:2] == ('CONNECT', 'sync.example:8443')
+
+def test_no_proxy(fetcher, http_server, monkeypatch):
+    """test servers listed in no_proxy are fetched from directly"""
+    http_server.documents['/a'] = b'data'
+    monkeypatch.setenv('http_proxy', 'http://127.0.0.1:1')
+    monkeypatch.setenv('no_proxy', '127.0.0.1')
+    assert fetcher.fetch(http_server.url + 'a')[2] == b'data'
+
+def test_no_size_limit_by_default(fetcher, http_server):
+    """test fetch returns bodies of any size unless given a limit"""
+    http_server.documents['/a'] = bytes(100000)
+    assert len(fetcher.fetch(http_server.url + 'a')[2]) == 100000
+    assert fetcher.fetch(http_server.url + 'a', max_size=100000)[2] == bytes(
+        100000)
+    with pytest.raises(errors.HTTPError):
+        fetcher.fetch(http_server.url + 'a', max_size=99999)
+    assert fetcher.fetch(http_server.url + 'a', 0, 10)[2] == bytes(10)
+
+def test_fetch_callback(fetcher, http_server):
+    """test a callback gets the body in chunks, whatever its size"""
+    data = bytes(range(256)) * 1000
+    http_server.documents['/a'] = data
+    chunks = []
+    assert fetcher.fetch(http_server.url + 'a', callback=lambda x:
+                         chunks.append(bytes(x)), chunk_size=4096,
+                         max_size=10)[2] == len(data)
+    assert b''.join(chunks) == data
+    assert max(len(x) for x in chunks) <= 4096
+
+def test_fetch_returns_bytes(fetcher, http_server):
+    """test fetch returns bytes whether or not the length was sent, and
+    refuses a body cut short"""
+    http_server.documents['/a'] = b'data'
+    assert type(fetcher.fetch(http_server.url + 'a')[2]) is bytes
+    assert type(fetcher.fetch(http_server.url + 'a', max_size=10)[2]) is bytes
+    http_server.cut['/a'] = 2
+    with pytest.raises(errors.HTTPError):
+        fetcher.fetch(http_server.url + 'a')
+
+def test_argo_bypassed_under_lock(fetcher, http_server, monkeypatch):
+    """test connections are made with INET_IS_ARGO unset while the lock
+    is held, and that it is set again afterwards"""
+    http_server.documents['/a'] = b'data'
+    monkeypatch.setenv('INET_IS_ARGO', '1')
+    seen = []
+    create_connection = socket.create_connection
+    def connect(*args, **kwargs):
+        seen.append((os.environ.get('INET_IS_ARGO'),
+                     utils.ARGO_INET_LOCK.locked()))
+        return create_connection(*args, **kwargs)
+    monkeypatch.setattr(socket, 'create_connection', connect)
+    assert fetcher.fetch(http_server.url + 'a')[2] == b'data'
+    assert seen == [(None, True)]
+    assert os.environ['INET_IS_ARGO'] == '1'
+    assert isinstance(list(fetcher.pools.values())[0],
+                      http_pool.ConnectionPool)
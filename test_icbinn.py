@@ -0,0 +1,283 @@
+#
+# Copyright (c) 2013 Citrix Systems, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+
+"""Test module for the icbinn client"""
+
+from errno import EACCES
+
+import pytest
+
+import pysynchronizer.errors
+from pysynchronizer.icbinn import IcbinnRemote, ICBINN_FILE, ICBINN_MAXDATA
+from pysynchronizer.icbinn import ICBINN_DIRECTORY, ICBINN_RETRIES
+from pysynchronizer.icbinn import LISTDIR_BATCH
+from sync_client import client
+
+def test_channels_grow_to_max_channels(icbinn_server):
+    """test busy channels are added to up to max_channels"""
+    icbinn = IcbinnRemote('/mnt', max_channels=2)
+    first = icbinn.acquire_channel()
+    second = icbinn.acquire_channel()
+    third = icbinn.acquire_channel()
+    assert first is not second
+    assert third in (first, second)
+    assert len(icbinn.channels) == 2
+    for channel in (first, second, third):
+        icbinn.release_channel(channel)
+    assert [x.users for x in icbinn.channels] == [0, 0]
+
+def test_idle_channel_is_reused(icbinn_server):
+    """test an idle channel is used rather than connecting another"""
+    icbinn = IcbinnRemote('/mnt', max_channels=4)
+    for _ in range(3):
+        icbinn.release_channel(icbinn.acquire_channel())
+    assert len(icbinn.channels) == 1
+    assert icbinn_server.calls['create'] == 1
+
+def test_open_window_uses_distinct_channels(icbinn_server):
+    """test a file opened with a window writes on that many channels"""
+    icbinn = IcbinnRemote('/mnt', max_channels=4)
+    with icbinn.open('f', client.O_WRONLY | client.O_CREAT, 3) as icbinn_file:
+        assert len(set(icbinn_file.channels)) == 3
+    assert [x.users for x in icbinn.channels] == [0, 0, 0]
+
+def test_errors_are_those_of_the_package(icbinn_server):
+    """test sync_client and pysynchronizer each get their own errors"""
+    with pytest.raises(pysynchronizer.errors.IcbinnError):
+        IcbinnRemote('/mnt').stat('missing')
+    with pytest.raises(client.IcbinnError):
+        client.Icbinn('/mnt').stat('missing')
+
+def test_call_reconnects_after_link_drops(icbinn_server, tmp_path):
+    """test an idempotent call is made again on a new handle"""
+    (tmp_path / 'f').write_bytes(b'abc')
+    icbinn = IcbinnRemote('/mnt')
+    icbinn_server.drop_links()
+    assert icbinn.stat('f') == (3, ICBINN_FILE)
+    assert icbinn_server.destroyed == [('handle', 1)]
+    assert icbinn.channels[0].epoch == 1
+
+def test_file_error_is_not_retried(icbinn_server):
+    """test a missing file is not taken for a dead link"""
+    icbinn = IcbinnRemote('/mnt')
+    with pytest.raises(pysynchronizer.errors.IcbinnError):
+        icbinn.stat('missing')
+    assert icbinn_server.calls['create'] == 1
+
+def test_non_idempotent_call_is_not_repeated(icbinn_server, tmp_path):
+    """test an unlink is not made again after reconnecting"""
+    (tmp_path / 'f').write_bytes(b'abc')
+    icbinn = IcbinnRemote('/mnt')
+    icbinn_server.drop_links()
+    with pytest.raises(OSError):
+        icbinn.unlink('f')
+    assert icbinn_server.calls['unlink'] == 1
+    assert icbinn_server.calls['create'] == 2
+
+def test_retries_give_up(icbinn_server, tmp_path):
+    """test a server which never answers fails after ICBINN_RETRIES"""
+    (tmp_path / 'f').write_bytes(b'abc')
+    icbinn = IcbinnRemote('/mnt')
+    icbinn_server.fail['stat'] = 1000
+    with pytest.raises(pysynchronizer.errors.IcbinnError):
+        icbinn.stat('f')
+    assert icbinn_server.calls['create'] == 1 + ICBINN_RETRIES
+
+def test_listdir_survives_link_drop(icbinn_server, tmp_path):
+    """test listdir reconnects and carries on if the link drops"""
+    for name in 'abc':
+        (tmp_path / name).write_bytes(b'')
+    icbinn = IcbinnRemote('/mnt')
+    icbinn_server.drop_links()
+    assert icbinn.listdir('.') == ['a', 'b', 'c']
+
+def test_open_file_reopens_after_reconnect(icbinn_server, tmp_path):
+    """test writes to an open file carry on after the link drops"""
+    icbinn = IcbinnRemote('/mnt')
+    with icbinn.open('f', client.O_WRONLY | client.O_CREAT, 2) as icbinn_file:
+        icbinn_file.pwrite(b'a' * ICBINN_MAXDATA, 0)
+        icbinn_server.drop_links()
+        icbinn_file.pwrite(b'b' * 2 * ICBINN_MAXDATA, ICBINN_MAXDATA)
+    assert (tmp_path / 'f').read_bytes() == (b'a' * ICBINN_MAXDATA +
+                                             b'b' * 2 * ICBINN_MAXDATA)
+
+def test_locked_file_is_not_reopened(icbinn_server, tmp_path):
+    """test a file whose lock went with a dropped link fails rather than
+    carrying on unlocked"""
+    icbinn = IcbinnRemote('/mnt')
+    with icbinn.open('f', client.O_WRONLY | client.O_CREAT) as icbinn_file:
+        icbinn_file.get_write_lock()
+        icbinn_server.drop_links()
+        with pytest.raises(pysynchronizer.errors.IcbinnError):
+            icbinn_file.pwrite(b'a', 0)
+        assert icbinn_server.calls['open'] == 1
+    assert (tmp_path / 'f').read_bytes() == b''
+
+def test_listdir_attrs(icbinn_server, tmp_path):
+    """test listdir_attrs returns sizes and types and fills the caches"""
+    (tmp_path / 'dir').mkdir()
+    (tmp_path / 'dir' / 'file').write_bytes(b'12345')
+    (tmp_path / 'dir' / 'sub').mkdir()
+    icbinn = IcbinnRemote('/mnt')
+    attrs = icbinn.listdir_attrs('dir')
+    assert [(name, kind) for name, _, kind in attrs] == [
+        ('file', ICBINN_FILE), ('sub', ICBINN_DIRECTORY)]
+    assert attrs[0][1] == 5
+    calls = dict(icbinn_server.calls)
+    assert icbinn.stat('dir/file') == (5, ICBINN_FILE)
+    assert icbinn.listdir('dir') == ['file', 'sub']
+    assert not icbinn.exists('dir/other')
+    assert icbinn_server.calls == calls
+
+def test_listdir_attrs_batches(icbinn_server, tmp_path):
+    """test listdir_attrs lists directories longer than one batch"""
+    names = ['f%03d' % x for x in range(LISTDIR_BATCH * 2 + 3)]
+    for name in names:
+        (tmp_path / name).write_bytes(b'x')
+    icbinn = IcbinnRemote('/mnt')
+    assert [x[0] for x in icbinn.listdir_attrs('.')] == names
+
+def test_listdir_attrs_skips_removed_files(icbinn_server, tmp_path,
+                                           monkeypatch):
+    """test a file removed between listing and stat is left out"""
+    for name in 'ab':
+        (tmp_path / name).write_bytes(b'x')
+    stat = icbinn_server.stat
+    def removing_stat(handle, path):
+        if path.endswith('b'):
+            (tmp_path / 'b').unlink()
+        return stat(handle, path)
+    monkeypatch.setattr(pysynchronizer.icbinn, 'icbinn_stat', removing_stat)
+    icbinn = IcbinnRemote('/mnt')
+    assert icbinn.listdir_attrs('.') == [('a', 1, ICBINN_FILE)]
+
+def test_listdir_attrs_raises_other_stat_errors(icbinn_server, tmp_path,
+                                                monkeypatch):
+    """test a stat failing other than with ENOENT is raised"""
+    (tmp_path / 'a').write_bytes(b'x')
+    def denied_stat(handle, path):
+        raise OSError(EACCES, 'denied')
+    monkeypatch.setattr(pysynchronizer.icbinn, 'icbinn_stat', denied_stat)
+    icbinn = IcbinnRemote('/mnt')
+    with pytest.raises(pysynchronizer.errors.IcbinnError):
+        icbinn.listdir_attrs('.')
+
+def test_stat_is_cached(icbinn_server, tmp_path):
+    """test stat results, including missing files, are cached"""
+    (tmp_path / 'f').write_bytes(b'abc')
+    icbinn = IcbinnRemote('/mnt')
+    for _ in range(3):
+        assert icbinn.stat('f') == (3, ICBINN_FILE)
+        assert not icbinn.exists('missing')
+    assert icbinn_server.calls['stat'] == 2
+    assert (icbinn.cache_hits, icbinn.cache_misses) == (4, 2)
+
+def test_writes_invalidate_cache(icbinn_server, tmp_path):
+    """test our own changes are seen by later stat and listdir calls"""
+    icbinn = IcbinnRemote('/mnt')
+    assert icbinn.listdir('.') == []
+    assert not icbinn.exists('f')
+    icbinn.write_file('f', b'abcd')
+    assert icbinn.stat('f') == (4, ICBINN_FILE)
+    assert icbinn.listdir('.') == ['f']
+    icbinn.rename('f', 'g')
+    assert icbinn.listdir('.') == ['g']
+    assert not icbinn.exists('f')
+    icbinn.unlink('g')
+    assert not icbinn.exists('g')
+
+def test_clear_cache(icbinn_server, tmp_path):
+    """test clear_cache makes changes made elsewhere visible"""
+    icbinn = IcbinnRemote('/mnt')
+    assert not icbinn.exists('f')
+    (tmp_path / 'f').write_bytes(b'abc')
+    assert not icbinn.exists('f')
+    icbinn.clear_cache()
+    assert icbinn.exists('f')
+
+def test_result_from_before_invalidation_is_not_cached(icbinn_server,
+                                                       tmp_path, monkeypatch):
+    """test a stat which overlapped an invalidation is not cached"""
+    (tmp_path / 'f').write_bytes(b'abc')
+    icbinn = IcbinnRemote('/mnt')
+    stat = icbinn_server.stat
+    def overlapping_stat(handle, path):
+        res = stat(handle, path)
+        (tmp_path / 'f').write_bytes(b'abcdef')
+        icbinn.invalidate('f')
+        return res
+    monkeypatch.setattr(pysynchronizer.icbinn, 'icbinn_stat',
+                        overlapping_stat)
+    assert icbinn.stat('f') == (3, ICBINN_FILE)
+    monkeypatch.setattr(pysynchronizer.icbinn, 'icbinn_stat', stat)
+    assert icbinn.stat('f') == (6, ICBINN_FILE)
+
+def test_window_writes_every_slice(icbinn_server, tmp_path):
+    """test a write spread over a window of channels lands in order"""
+    data = bytes(range(256)) * (ICBINN_MAXDATA * 5 // 256)
+    icbinn = IcbinnRemote('/mnt', max_channels=4)
+    with icbinn.open('f', client.O_WRONLY | client.O_CREAT, 4) as icbinn_file:
+        icbinn_file.pwrite(data, 0)
+    assert (tmp_path / 'f').read_bytes() == data
+    assert icbinn_server.calls['pwrite'] == 5
+
+def test_window_write_failure_reports_offsets(icbinn_server, monkeypatch):
+    """test the offsets of failed slices are raised"""
+    pwrite = icbinn_server.pwrite
+    def failing_pwrite(handle, fd, data, offset):
+        if offset == ICBINN_MAXDATA:
+            return -1
+        return pwrite(handle, fd, data, offset)
+    monkeypatch.setattr(pysynchronizer.icbinn, 'icbinn_pwrite',
+                        failing_pwrite)
+    icbinn = IcbinnRemote('/mnt', max_channels=4)
+    with icbinn.open('f', client.O_WRONLY | client.O_CREAT, 4) as icbinn_file:
+        with pytest.raises(pysynchronizer.errors.IcbinnWriteError) as info:
+            icbinn_file.pwrite(bytes(ICBINN_MAXDATA * 3), 0)
+    assert info.value.offsets == [ICBINN_MAXDATA]
+
+def test_zero_slices_past_holes_from_are_skipped(icbinn_server, tmp_path):
+    """test all-zero slices are only written before holes_from"""
+    zeros = bytes(ICBINN_MAXDATA)
+    data = zeros + zeros + b'x' * ICBINN_MAXDATA + zeros
+    icbinn = IcbinnRemote('/mnt')
+    with icbinn.open('f', client.O_WRONLY | client.O_CREAT) as icbinn_file:
+        icbinn_file.pwrite(data, 0, holes_from=ICBINN_MAXDATA)
+    # only the zero slice before holes_from and the data are written
+    assert icbinn_server.calls['pwrite'] == 2
+    assert (tmp_path / 'f').read_bytes() == data[:3 * ICBINN_MAXDATA]
+
+@pytest.mark.parametrize('tail', [b'', b'x', bytes(10)])
+def test_close_extends_over_skipped_zeros(icbinn_server, tmp_path, tail):
+    """test closing a file opened with holes_from writes the last byte of
+    all-zero data write() skipped at its end"""
+    data = b'x' * 10 + bytes(ICBINN_MAXDATA * 2) + tail
+    icbinn = IcbinnRemote('/mnt')
+    with icbinn.open('f', client.O_WRONLY | client.O_CREAT,
+                     holes_from=0) as icbinn_file:
+        icbinn_file.write(data[:ICBINN_MAXDATA])
+        icbinn_file.write(data[ICBINN_MAXDATA:])
+    assert (tmp_path / 'f').read_bytes() == data
+    assert icbinn_server.calls['pwrite'] == 2
+
+def test_zero_slices_are_written_without_holes_from(icbinn_server, tmp_path):
+    """test all-zero slices are written if holes_from is not set"""
+    icbinn = IcbinnRemote('/mnt')
+    with icbinn.open('f', client.O_WRONLY | client.O_CREAT) as icbinn_file:
+        icbinn_file.pwrite(bytes(ICBINN_MAXDATA * 2), 0)
+    assert icbinn_server.calls['pwrite'] == 2
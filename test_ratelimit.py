@@ -0,0 +1,139 @@
+#
+# Copyright (c) 2013 Citrix Systems, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+
+"""Tests for the download rate limits"""
+
+from time import struct_time
+
+import pytest
+
+from pysynchronizer import errors, ratelimit
+from sync_client import client
+
+class Clock(object):
+    """A monotonic clock which only moves when something sleeps"""
+    def __init__(self):
+        self.now = 100.0
+        self.slept = []
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, delay):
+        self.slept.append(delay)
+        self.now += delay
+
+@pytest.fixture
+def clock(monkeypatch):
+    """A Clock used by the rate limit code in place of the real time"""
+    clock = Clock()
+    monkeypatch.setattr(ratelimit, 'monotonic', clock.monotonic)
+    monkeypatch.setattr(ratelimit, 'sleep', clock.sleep)
+    return clock
+
+def at(monkeypatch, hour, minute):
+    """Make the rate limit code think it is hour:minute"""
+    monkeypatch.setattr(ratelimit, 'localtime', lambda: struct_time(
+        (2020, 1, 1, hour, minute, 0, 2, 1, 0)))
+
+def test_parse_rate_schedule():
+    """test schedule entries are turned into minutes of the day"""
+    assert ratelimit.parse_rate_schedule(
+        ' 08:30-17:00=1000, 22:00-6:15=0 ,') == [
+            (510, 1020, 1000), (1320, 375, 0)]
+    assert ratelimit.parse_rate_schedule('') == []
+
+@pytest.mark.parametrize('text', [
+    '08:00-17:00', '8-17=100', '08:00-17:00=fast', '08:00-24:00=100',
+    '24:00-06:00=100', '08:60-17:00=100'])
+def test_parse_rate_schedule_rejects(text):
+    """test invalid schedule entries, including hour 24, are rejected"""
+    with pytest.raises(errors.ConfigError):
+        ratelimit.parse_rate_schedule(text)
+
+def test_client_rejects_with_its_own_error():
+    """test sync_client gets an error with its exit code"""
+    with pytest.raises(client.ConfigError) as info:
+        client.RateLimiter(schedule='08:00-24:00=100')
+    assert info.value.exit_code == client.ConfigError.exit_code
+
+def test_unlimited(clock):
+    """test a bucket with rate 0 never waits"""
+    bucket = ratelimit.TokenBucket(0)
+    for _ in range(10):
+        bucket.consume(10 ** 9)
+    assert clock.slept == []
+
+def test_rate(clock):
+    """test a bucket spreads bytes over time at its rate"""
+    bucket = ratelimit.TokenBucket(1000)
+    bucket.consume(1000)
+    bucket.consume(500)
+    bucket.consume(500)
+    assert clock.slept == [1.0, 0.5, 0.5]
+
+def test_burst(clock):
+    """test an idle bucket saves up at most a burst of bytes"""
+    bucket = ratelimit.TokenBucket(1000)
+    clock.now += 60
+    bucket.consume(1000)
+    assert clock.slept == []
+    bucket.consume(1000)
+    assert clock.slept == [1.0]
+
+def test_set_rate(clock):
+    """test changing the rate applies to the bytes after the change"""
+    bucket = ratelimit.TokenBucket(1000)
+    bucket.consume(1000)
+    bucket.set_rate(0)
+    bucket.consume(10 ** 6)
+    bucket.set_rate(2000)
+    bucket.consume(1000)
+    assert clock.slept == [1.0, 0.5]
+
+@pytest.mark.parametrize('hour, minute, rate', [
+    (7, 59, 5), (8, 0, 100), (16, 59, 100), (17, 0, 5), (21, 59, 5),
+    (22, 0, 0), (0, 0, 0), (5, 59, 0), (6, 0, 5)])
+def test_current_rate(monkeypatch, hour, minute, rate):
+    """test the schedule applies at the times it covers, across midnight"""
+    at(monkeypatch, hour, minute)
+    limiter = ratelimit.RateLimiter(
+        rate=5, schedule='08:00-17:00=100,22:00-06:00=0')
+    assert limiter.current_rate() == rate
+
+def test_shared_and_transfer_rates(clock, monkeypatch):
+    """test each transfer is held to both its own and the shared rate"""
+    at(monkeypatch, 12, 0)
+    limiter = ratelimit.RateLimiter(rate=1000, transfer_rate=2000)
+    limiter.transfer()(1000)
+    assert clock.slept == [0.5, 0.5]
+    limiter.transfer()(1000)
+    assert clock.slept == [0.5, 0.5, 0.5, 0.5]
+
+def test_schedule_change_during_transfer(clock, monkeypatch):
+    """test a running transfer picks up a change of scheduled rate"""
+    at(monkeypatch, 7, 59)
+    limiter = ratelimit.RateLimiter(rate=1000, schedule='08:00-09:00=0')
+    throttle = limiter.transfer()
+    throttle(1000)
+    assert clock.slept == [1.0]
+    at(monkeypatch, 8, 0)
+    clock.now += ratelimit.RATE_SCHEDULE_INTERVAL + 1
+    throttle(10 ** 6)
+    assert clock.slept == [1.0]
+    assert limiter.bucket.rate == 0
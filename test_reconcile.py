@@ -0,0 +1,571 @@
+#
+# Copyright (c) 2013 Citrix Systems, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+
+"""Test module for arranging VMs"""
+
+from functools import partial
+from threading import Barrier, Lock
+from time import sleep
+
+import pytest
+
+from pysynchronizer import oxt_dbus
+from sync_client import client
+
+def test_action_graph_runs_in_order_added():
+    """test one at a time, actions run in the order added where their
+    dependencies allow"""
+    ran = []
+    graph = client.ActionGraph()
+    graph.add('a', lambda: ran.append('a'), ['c'])
+    graph.add('b', lambda: ran.append('b'))
+    graph.add('c', lambda: ran.append('c'))
+    graph.add('d', lambda: ran.append('d'), ['a', 'b'])
+    graph.run(1)
+    assert ran == ['b', 'c', 'a', 'd']
+
+def test_action_graph_respects_dependencies_concurrently():
+    """test concurrent actions start only once their dependencies finish"""
+    finished = set()
+    lock = Lock()
+    def action(name, after):
+        with lock:
+            assert after <= finished
+        sleep(0.01)
+        with lock:
+            finished.add(name)
+    graph = client.ActionGraph()
+    for i in range(10):
+        after = set(['create%d' % i])
+        graph.add('create%d' % i, lambda i=i: action('create%d' % i, set()))
+        graph.add('arrange%d' % i,
+                  lambda i=i, after=after: action('arrange%d' % i, after),
+                  after)
+    graph.run(4)
+    assert len(finished) == 20
+
+def test_action_graph_runs_independent_actions_at_once():
+    """test up to concurrency independent actions run together"""
+    barrier = Barrier(3, timeout=5)
+    graph = client.ActionGraph()
+    for name in 'abc':
+        graph.add(name, barrier.wait)
+    graph.run(3)
+
+def test_action_graph_bounds_concurrency():
+    """test no more than concurrency actions run at once"""
+    running = [0, 0]
+    lock = Lock()
+    def action():
+        with lock:
+            running[0] += 1
+            running[1] = max(running)
+        sleep(0.01)
+        with lock:
+            running[0] -= 1
+    graph = client.ActionGraph()
+    for i in range(12):
+        graph.add(i, action)
+    graph.run(3)
+    assert running[1] == 3
+
+def test_action_graph_rejects_cycles_before_running():
+    """test actions depending on each other are rejected up front"""
+    ran = []
+    graph = client.ActionGraph()
+    graph.add('a', lambda: ran.append('a'))
+    graph.add('b', lambda: ran.append('b'), ['c'])
+    graph.add('c', lambda: ran.append('c'), ['b'])
+    with pytest.raises(client.TargetStateError):
+        graph.run(2)
+    assert ran == []
+
+def test_action_graph_rejects_unknown_dependencies():
+    """test depending on an action which was not added is rejected"""
+    graph = client.ActionGraph()
+    graph.add('a', lambda: None, ['b'])
+    with pytest.raises(client.TargetStateError):
+        graph.run()
+
+def test_action_graph_stops_after_failure():
+    """test a failure stops dependent and waiting actions, lets running
+    ones finish, and is raised"""
+    ran = []
+    def fail():
+        raise client.PlatformError('failed')
+    def slow():
+        sleep(0.05)
+        ran.append('slow')
+    graph = client.ActionGraph()
+    graph.add('slow', slow)
+    graph.add('fail', fail)
+    graph.add('after', lambda: ran.append('after'), ['fail'])
+    for i in range(5):
+        graph.add(i, lambda i=i: ran.append(i), ['slow'])
+    with pytest.raises(client.PlatformError):
+        graph.run(2)
+    assert ran == ['slow']
+
+def test_action_graph_raises_first_failure_in_order_added():
+    """test the first failure in the order actions were added is raised"""
+    def fail(message, delay):
+        sleep(delay)
+        raise client.PlatformError(message)
+    graph = client.ActionGraph()
+    graph.add('a', lambda: fail('a', 0.05))
+    graph.add('b', lambda: fail('b', 0))
+    with pytest.raises(client.PlatformError) as info:
+        graph.run(2)
+    assert str(info.value) == 'a'
+
+def test_vm_references():
+    """test network backends and rpc VM references are found"""
+    vminfo = {'config': [
+            {'daemon': 'nic/0', 'key': 'backend-uuid', 'value': 'net'},
+            {'daemon': 'nic/0', 'key': 'mac', 'value': '00:11:22:33:44:55'},
+            {'daemon': 'vm', 'key': 'run-post-create',
+             'value': 'rpc:vm=peer,destination=com.example'},
+            {'daemon': 'vm', 'key': 'run-on-state-change',
+             'value': '/bin/true'},
+            {'daemon': 'vm', 'key': 'name', 'value': 'vm=name'}]}
+    assert client.vm_references(vminfo) == (set(['net']), set(['peer']))
+    assert client.vm_references({'config': None}) == (set(), set())
+
+def test_snapshots_of_different_objects_are_taken_at_once(monkeypatch):
+    """test a GetAll for one object does not hold up another's"""
+    barrier = Barrier(2, timeout=5)
+    def call_proxy(service, path, interface, call):
+        barrier.wait()
+        return {'path': path}
+    monkeypatch.setattr(client, 'call_proxy', call_proxy)
+    graph = client.ActionGraph()
+    results = {}
+    for path in ('/vm/a', '/vm/b'):
+        graph.add(path, lambda path=path: results.update(
+                {path: client.get_property(path, 'path', 'vm')}))
+    with client.property_snapshots():
+        graph.run(2)
+    assert results == {'/vm/a': '/vm/a', '/vm/b': '/vm/b'}
+
+class FakeXenmgr(object):
+    """xenmgr on a fake system bus. properties maps (path, interface) to
+    the properties of that interface of the object at path; setting a
+    property sets it on every interface of the object which has it.
+    Values set are passed through normalise first, as xenmgr may change
+    them."""
+    def __init__(self, properties, normalise=lambda key, value: value):
+        self.properties = properties
+        self.normalise = normalise
+        self.calls = []
+        self.objects = 0
+        self.stale = set()
+
+    def get_object(self, service, path):
+        self.objects += 1
+        return (service, path, self.objects)
+
+    def interface(self, obj, dbus_interface):
+        return FakeProxy(self, obj, dbus_interface)
+
+class FakeProxy(object):
+    def __init__(self, xenmgr, obj, interface):
+        self.xenmgr = xenmgr
+        self.obj = obj
+        self.path = obj[1]
+        self.interface = interface
+
+    def check(self, name):
+        self.xenmgr.calls.append((name, self.path))
+        if self.obj in self.xenmgr.stale:
+            raise client.DBusException(
+                'gone', name='org.freedesktop.DBus.Error.ServiceUnknown')
+
+    def list_vms(self):
+        self.check('list_vms')
+        return sorted(set([path for path, _ in self.xenmgr.properties]))
+
+    def GetAll(self, interface):
+        self.check('GetAll')
+        return dict(self.xenmgr.properties[(self.path, interface)])
+
+    def Get(self, interface, key):
+        self.check('Get')
+        return self.xenmgr.properties[(self.path, interface)][key]
+
+    def Set(self, interface, key, value):
+        self.check('Set')
+        for (path, _), properties in self.xenmgr.properties.items():
+            if path == self.path and key in properties:
+                properties[key] = self.xenmgr.normalise(key, value)
+
+@pytest.fixture
+def xenmgr(monkeypatch):
+    """A FakeXenmgr with a VM at /vm/a, on a fresh set of dbus proxies"""
+    fake = FakeXenmgr({
+            ('/vm/a', 'com.citrix.xenclient.xenmgr.vm'): {
+                'name': client.String('a'),
+                'memory': client.Int32(1024),
+                'stubdom': client.Boolean(False)},
+            ('/vm/a', 'com.citrix.xenclient.xenmgr.vm.unrestricted'): {
+                'name': client.String('a'),
+                'memory': client.Int32(1024),
+                'stubdom': client.Boolean(False)}})
+    monkeypatch.setattr(oxt_dbus, 'SystemBus', lambda: fake)
+    monkeypatch.setattr(oxt_dbus, 'Interface', fake.interface)
+    monkeypatch.setattr(oxt_dbus, '_objects', {})
+    monkeypatch.setattr(oxt_dbus, '_proxies', {})
+    return fake
+
+VM_DAEMONS = {'vm': (lambda k: client.get_vm_property('/vm/a', k),
+                     lambda k, v: client.set_vm_property('/vm/a', k, v))}
+
+def test_set_config_sets_only_differences(xenmgr):
+    """test only items differing from the current values are set, with
+    one GetAll for all the reads"""
+    with client.property_snapshots():
+        client.set_config([
+                {'daemon': 'vm', 'key': 'name', 'value': 'b'},
+                {'daemon': 'vm', 'key': 'memory', 'value': '2048'},
+                {'daemon': 'vm', 'key': 'stubdom', 'value': 'false'}],
+                          VM_DAEMONS)
+    properties = xenmgr.properties[
+        ('/vm/a', 'com.citrix.xenclient.xenmgr.vm')]
+    assert (properties['name'], properties['memory']) == ('b', 2048)
+    assert [x[0] for x in xenmgr.calls] == ['GetAll', 'Set', 'Set']
+
+def test_set_config_sets_nothing_if_config_invalid(xenmgr):
+    """test an invalid item stops the earlier ones being set too"""
+    with client.property_snapshots():
+        with pytest.raises(client.TargetStateError):
+            client.set_config([
+                    {'daemon': 'vm', 'key': 'name', 'value': 'b'},
+                    {'daemon': 'vm', 'key': 'memory', 'value': 'lots'}],
+                              VM_DAEMONS)
+    assert 'Set' not in [x[0] for x in xenmgr.calls]
+
+def test_set_property_reads_back_what_xenmgr_set(xenmgr):
+    """test a property set in a pass reads back as xenmgr changed it, and
+    the others are still served from the snapshot"""
+    xenmgr.normalise = lambda key, value: client.String(value.upper())
+    with client.property_snapshots():
+        client.set_vm_property('/vm/a', 'name', 'b')
+        assert client.get_vm_property('/vm/a', 'name') == 'B'
+        assert client.get_vm_property('/vm/a', 'memory') == 1024
+    assert [x[0] for x in xenmgr.calls] == ['GetAll', 'Set', 'Get']
+
+def test_set_property_drops_key_in_place(xenmgr):
+    """test setting a property removes it from the snapshot it was in
+    rather than copying the snapshot"""
+    with client.property_snapshots():
+        client.get_vm_property('/vm/a', 'name')
+        key = ('com.citrix.xenclient.xenmgr', '/vm/a',
+               'com.citrix.xenclient.xenmgr.vm')
+        snapshot = client.PROPERTY_SNAPSHOTS[key]
+        client.set_vm_property('/vm/a', 'name', 'b')
+        client.set_vm_property('/vm/a', 'memory', '2048')
+        assert client.PROPERTY_SNAPSHOTS[key] is snapshot
+        assert snapshot == {'stubdom': False}
+
+def test_dbus_proxies_are_reused(xenmgr):
+    """test proxies are made once and reused"""
+    for _ in range(5):
+        assert client.get_vm_property('/vm/a', 'name') == 'a'
+    assert xenmgr.objects == 1
+
+def test_stale_dbus_proxy_is_replaced(xenmgr):
+    """test a call on a proxy whose object has gone is made again on a
+    new proxy"""
+    client.get_vm_property('/vm/a', 'name')
+    xenmgr.stale.add(('com.citrix.xenclient.xenmgr', '/vm/a', 1))
+    assert client.get_vm_property('/vm/a', 'name') == 'a'
+    assert xenmgr.objects == 2
+
+def test_service_objects_share_proxies(xenmgr):
+    """test pysynchronizer's service objects reuse the proxies sync_client
+    made, and replace them when stale"""
+    client.get_vm_property('/vm/a', 'name')
+    vm = oxt_dbus.ServiceObject('com.citrix.xenclient.xenmgr',
+                                'com.citrix.xenclient.xenmgr.vm', '/vm/a')
+    assert vm.get_property('memory') == 1024
+    assert xenmgr.objects == 1
+    xenmgr.stale.add(('com.citrix.xenclient.xenmgr', '/vm/a', 1))
+    assert vm.get_all_properties()['name'] == 'a'
+    assert xenmgr.objects == 2
+
+def test_forget_proxies_covers_objects_below(xenmgr):
+    """test forgetting a VM's proxies forgets those of its nics too"""
+    oxt_dbus.get_proxy('com.citrix.xenclient.xenmgr', '/vm/a', 'vm')
+    oxt_dbus.get_proxy('com.citrix.xenclient.xenmgr', '/vm/a/nic/0', 'vmnic')
+    oxt_dbus.get_proxy('com.citrix.xenclient.xenmgr', '/vm/ab', 'vm')
+    oxt_dbus.forget_proxies('/vm/a')
+    assert [x[1] for x in oxt_dbus._proxies] == ['/vm/ab']
+    assert [x[1] for x in oxt_dbus._objects] == ['/vm/ab']
+
+def test_properties_are_read_once_per_pass(xenmgr):
+    """test a pass reads each object's properties with one GetAll"""
+    with client.property_snapshots():
+        for key in ('name', 'memory', 'stubdom', 'name'):
+            client.get_vm_property('/vm/a', key)
+    assert xenmgr.calls == [('GetAll', '/vm/a')]
+
+def test_properties_are_read_live_outside_a_pass(xenmgr):
+    """test outside a pass every read is a Get"""
+    client.get_vm_property('/vm/a', 'name')
+    client.get_vm_property('/vm/a', 'name')
+    assert xenmgr.calls == [('Get', '/vm/a'), ('Get', '/vm/a')]
+
+def test_vm_state_is_read_live_in_a_pass(xenmgr):
+    """test a VM started during a pass is seen to be running"""
+    properties = xenmgr.properties[('/vm/a', 'com.citrix.xenclient.xenmgr.vm')]
+    properties['state'] = client.String('stopped')
+    with client.property_snapshots():
+        assert client.get_vm_property('/vm/a', 'state') == 'stopped'
+        assert client.get_vm_property('/vm/a', 'name') == 'a'
+        properties['state'] = client.String('running')
+        assert client.get_vm_property('/vm/a', 'state') == 'running'
+    assert xenmgr.calls == [('Get', '/vm/a'), ('GetAll', '/vm/a'),
+                            ('Get', '/vm/a')]
+
+def test_failed_snapshot_falls_back_to_get(xenmgr, monkeypatch):
+    """test properties are read with Get if GetAll fails"""
+    def failing_get_all(self, interface):
+        raise client.DBusException('no', name='org.freedesktop.DBus.Error')
+    monkeypatch.setattr(FakeProxy, 'GetAll', failing_get_all)
+    with client.property_snapshots():
+        assert client.get_vm_property('/vm/a', 'name') == 'a'
+        assert client.get_vm_property('/vm/a', 'memory') == 1024
+    assert xenmgr.calls == [('Get', '/vm/a'), ('Get', '/vm/a')]
+
+def test_uuid_map_keeps_reverse_map():
+    """test the reverse map follows changes to a UuidMap"""
+    uuid_map = client.UuidMap()
+    uuid_map['s1'] = 'c1'
+    uuid_map['s2'] = 'c2'
+    uuid_map['s1'] = 'c3'
+    assert uuid_map.reverse == {'c2': 's2', 'c3': 's1'}
+    del uuid_map['s2']
+    assert uuid_map.reverse == {'c3': 's1'}
+    assert client.map_vm_uuid('c3', uuid_map, True) == 's1'
+    assert client.map_vm_uuid('c2', uuid_map, True) is None
+    assert client.map_vm_uuid('s1', uuid_map, False) == 'c3'
+    with pytest.raises(client.TargetStateError):
+        client.map_vm_uuid('s2', uuid_map, False)
+
+def test_vm_index(xenmgr):
+    """test VmIndex finds the VMs of its realm, and forgets removed ones"""
+    interface = 'com.citrix.xenclient.xenmgr.vm'
+    xenmgr.properties = {
+        ('/vm/a', interface): {'realm': 'r', 'sync-uuid': 's1', 'uuid': 'c1'},
+        ('/vm/b', interface): {'realm': 'q', 'sync-uuid': 's2', 'uuid': 'c2'},
+        ('/vm/c', interface): {'realm': 'r', 'sync-uuid': 's3', 'uuid': 'c3'}}
+    with client.property_snapshots():
+        index = client.VmIndex('r')
+        assert index.paths == {'s1': '/vm/a', 's3': '/vm/c'}
+        index.uuid_map['v1'] = index.client_uuid('s1')
+        index.uuid_map['v3'] = index.client_uuid('s3')
+        index.client_uuid('s1')
+        index.remove('s1')
+    assert index.paths == {'s3': '/vm/c'}
+    assert dict(index.uuid_map) == {'v3': 'c3'}
+    assert index.uuid_map.reverse == {'c3': 'v3'}
+    assert [x[0] for x in xenmgr.calls].count('GetAll') == 3
+
+def test_key_pool_reads_entropy_at_once(icbinn_server, storage):
+    """test a KeyPool reads the entropy for count keys in one call"""
+    generate_key = client.KeyPool(client.MyConfig(client.MYCONFIG_DEFAULTS),
+                                  64, 4)
+    keys = [generate_key() for _ in range(4)]
+    assert icbinn_server.calls['rand'] == 1
+    assert [len(x) for x in keys] == [64] * 4
+    assert len(set(keys)) == 4
+    assert len(generate_key()) == 64
+    assert icbinn_server.calls['rand'] == 2
+
+def test_key_pool_reads_nothing_unless_called(icbinn_server, storage):
+    """test a KeyPool which is never called reads no entropy"""
+    client.KeyPool(client.MyConfig(client.MYCONFIG_DEFAULTS), 64, 4)
+    assert 'rand' not in icbinn_server.calls
+
+def test_count_snapshot_keys(storage, tmp_path):
+    """test only missing encrypted snapshots need keys"""
+    vm_uuid, new, have, clear, read_only, unknown = [
+        '00000000-0000-0000-0000-00000000000%d' % x for x in range(6)]
+    disks = dict([(x, {'diskuuid': x, 'read_only': x == read_only})
+                  for x in (new, have, clear, read_only)])
+    vms = [{'vm_instance_uuid': vm_uuid, 'config': [], 'disks': [
+                {'diskuuid': new, 'config': []},
+                {'diskuuid': have, 'config': []},
+                {'diskuuid': clear, 'config': [
+                        {'daemon': 'synchronizer',
+                         'key': client.ENCRYPT_SNAPSHOTS, 'value': 'false'}]},
+                {'diskuuid': read_only, 'config': []},
+                {'diskuuid': unknown, 'config': []}]}]
+    snapshot = client.generate_snapshot_vhd_path(have, False, vm_uuid)
+    (tmp_path / client.DISK_DIR).mkdir()
+    (tmp_path / snapshot).write_bytes(b'')
+    assert client.count_snapshot_keys(vms, disks) == 1
+
+def test_shared_snapshot_made_once(storage, tmp_path, monkeypatch):
+    """test VMs sharing a disk arranged at once make its snapshot once,
+    with one key"""
+    disk, vm1, vm2 = ['00000000-0000-0000-0000-00000000000%d' % x
+                      for x in range(3)]
+    (tmp_path / client.DISK_DIR).mkdir()
+    made = []
+    def vhd_util(command, _, base_rel, __, snapshot_rel):
+        made.append(snapshot_rel)
+        sleep(0.1)
+        (tmp_path / snapshot_rel).write_bytes(b'')
+        storage.clear_cache()
+    keys = []
+    def place_vhd_key(vhd_rel, content, mark_vhd=False):
+        keys.append(vhd_rel)
+    monkeypatch.setattr(client, 'vhd_util', vhd_util)
+    monkeypatch.setattr(client, 'place_vhd_key', place_vhd_key)
+    monkeypatch.setattr(client, 'verify_vhd_key', lambda vhd_rel: None)
+    graph = client.ActionGraph()
+    for vm_uuid in (vm1, vm2):
+        graph.add(vm_uuid, partial(client.arrange_snapshot, disk, True,
+                                   vm_uuid, 'disks/base.vhd',
+                                   lambda: bytes(64)))
+    graph.run(2)
+    snapshot = client.generate_snapshot_vhd_path(disk, True, vm1)
+    assert made == [snapshot]
+    assert keys == [snapshot]
+
+DISK_UUIDS = ['00000000-0000-0000-0000-0000000000%02d' % x for x in range(10)]
+
+def fake_download(downloaded):
+    """Return a download callback which writes size bytes over icbinn and
+    records the documents downloaded in downloaded"""
+    def download(document, destination_rel, size, kind, icbinn, **_):
+        downloaded.append(document)
+        icbinn.write_file(destination_rel, b'x' * size)
+    return download
+
+def test_known_disks_are_not_looked_at_again(storage, tmp_path,
+                                             monkeypatch):
+    """test the download pass only looks at disks which were missing"""
+    disks = [{'diskuuid': x, 'size': 10} for x in DISK_UUIDS[:3]]
+    (tmp_path / client.DISK_DIR).mkdir()
+    for disk in disks[:2]:
+        (tmp_path / client.generate_disk_path(
+                disk['diskuuid'], client.DISK_TYPE_VHD)).write_bytes(b'x' * 5)
+    known = client.arrange_disk_backing_files(disks, None)
+    assert list(known.values()) == [5, 5, 0]
+    ensured = []
+    ensure_disk_downloaded = client.ensure_disk_downloaded
+    def recording_ensure_disk_downloaded(disk, *args):
+        ensured.append(disk['diskuuid'])
+        return ensure_disk_downloaded(disk, *args)
+    monkeypatch.setattr(client, 'ensure_disk_downloaded',
+                        recording_ensure_disk_downloaded)
+    downloaded = []
+    sizes = client.arrange_disk_backing_files(
+        disks, fake_download(downloaded), known=known)
+    assert sizes == dict(zip(DISK_UUIDS[:3], [5, 5, 10]))
+    assert ensured == DISK_UUIDS[2:3]
+    assert downloaded == ['disk/%s.vhd' % DISK_UUIDS[2]]
+
+def test_only_vms_with_changed_disks_are_arranged(monkeypatch):
+    """test after downloads only the VMs using a new disk are touched"""
+    arranged = []
+    def arrange_vm(myconfig, vmpath, vminfo, diskmap, uuidmap, already_disks,
+                   generate_key, disks_only=False):
+        arranged.append((vmpath, disks_only))
+    monkeypatch.setattr(client, 'arrange_vm', arrange_vm)
+    index = client.VmIndex.__new__(client.VmIndex)
+    index.paths = {'i1': '/vm/1', 'i2': '/vm/2', 'i3': '/vm/3'}
+    index.uuid_map = client.UuidMap()
+    disks = [{'diskuuid': x, 'read_only': True} for x in DISK_UUIDS[:3]]
+    vms = [{'vm_instance_uuid': 'i%d' % (x + 1), 'config': [],
+            'disks': [{'diskuuid': DISK_UUIDS[x], 'config': []}]}
+           for x in range(3)]
+    vms[2]['removed'] = True
+    client.arrange_vm_disks(client.MyConfig(client.MYCONFIG_DEFAULTS), vms,
+                            disks, {}, set(DISK_UUIDS[1:3]), index)
+    assert arranged == [('/vm/2', True)]
+
+def test_progress_finish(monkeypatch):
+    """test finishing progress marks every VM there is as complete"""
+    progress = []
+    monkeypatch.setattr(client, 'set_vm_property',
+                        lambda path, key, value: progress.append((path, value)))
+    vms = [{'vm_instance_uuid': 'i1'},
+           {'vm_instance_uuid': 'i2', 'removed': True},
+           {'vm_instance_uuid': 'i3', 'removed': True}]
+    client.VmProgress(vms, {'i1': '/vm/1', 'i2': '/vm/2'}, [], {}).finish()
+    assert progress == [('/vm/1', 100), ('/vm/2', 100)]
+
+def test_vms_retired_after_downloads(storage, monkeypatch):
+    """test unwanted VMs are only deleted once the new disks are in place,
+    so that a VM being replaced stays until its replacement is ready"""
+    steps = []
+    monkeypatch.setattr(client, 'ICBINN_CONFIG', storage)
+    monkeypatch.setattr(client, 'VmIndex', lambda sync_name: 'index')
+    def arrange_vms(myconfig, vms, disks, sync_name, already_disks,
+                    delete=True, **_):
+        steps.append(('arrange_vms', delete))
+        return {}
+    def arrange_disk_backing_files(disks, download, **_):
+        steps.append('find' if download is None else 'download')
+        return {DISK_UUIDS[0]: 0 if download is None else 10}
+    monkeypatch.setattr(client, 'arrange_vms', arrange_vms)
+    monkeypatch.setattr(client, 'arrange_disk_backing_files',
+                        arrange_disk_backing_files)
+    monkeypatch.setattr(client, 'arrange_vm_disks',
+                        lambda *args, **_: steps.append('arrange_vm_disks'))
+    monkeypatch.setattr(client, 'retire_vms',
+                        lambda vms, index, **_: steps.append('retire_vms'))
+    client.work_toward_state({'vms': [], 'disks': []},
+                             lambda *args, **kwargs: None, None,
+                             client.SYNC_ROLE_REALM, 'realm')
+    assert steps == ['find', ('arrange_vms', False), 'download',
+                     'arrange_vm_disks', 'retire_vms']
+
+def test_retire_vms(monkeypatch):
+    """test VMs the server no longer lists, and stopped VMs it marks
+    removed, are deleted, while running VMs marked removed are kept"""
+    properties = {'/vm/1': {'state': 'running'}, '/vm/2': {'state': 'stopped'},
+                  '/vm/3': {'state': 'running'}, '/vm/4': {'state': 'running'}}
+    def set_vm_property(path, key, value):
+        properties[path][key] = value
+    deleted = []
+    class FakeXenmgr(object):
+        def unrestricted_delete_vm(self, client_uuid):
+            deleted.append(client_uuid)
+
+        def destroy(self):
+            pass
+    monkeypatch.setattr(client, 'open_xenmgr_unrestricted', FakeXenmgr)
+    monkeypatch.setattr(client, 'vm_control', lambda path: FakeXenmgr())
+    monkeypatch.setattr(client, 'get_vm_property',
+                        lambda path, key: properties[path][key])
+    monkeypatch.setattr(client, 'set_vm_property', set_vm_property)
+    index = client.VmIndex.__new__(client.VmIndex)
+    index.paths = {'i1': '/vm/1', 'i2': '/vm/2', 'i3': '/vm/3', 'i4': '/vm/4'}
+    index.client_uuids = {'/vm/2': 'c2', '/vm/4': 'c4'}
+    index.uuid_map = client.UuidMap()
+    vms = [{'vm_instance_uuid': 'i1', 'removed': False},
+           {'vm_instance_uuid': 'i2', 'removed': True},
+           {'vm_instance_uuid': 'i3', 'removed': True}]
+    client.retire_vms(vms, index)
+    assert sorted(deleted) == ['c2', 'c4']
+    assert sorted(index.paths) == ['i1', 'i3']
+    assert properties['/vm/3'] == {'state': 'running', 'ready': False,
+                                   'download-progress': -1}